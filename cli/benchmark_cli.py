@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CLI_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that cost noticeable startup time when imported
+HEAVY_MODULES = ("numpy", "nltk", "torch", "sentence_transformers")
+
+SAMPLE_QUERY = "space adventure"
+SAMPLE_TEXT = "A lone pilot crosses the galaxy. She finds an ancient ship. The crew wakes up. Nobody remembers home."
+
+# (script, arguments) for each subcommand whose startup is measured
+STARTUP_COMMANDS = [
+    ("keyword_search_cli.py", ["bm25search", SAMPLE_QUERY]),
+    ("keyword_search_cli.py", ["idf", "space"]),
+    ("semantic_search_cli.py", ["chunk", SAMPLE_TEXT]),
+    ("semantic_search_cli.py", ["semantic_chunk", SAMPLE_TEXT]),
+    ("semantic_search_cli.py", ["verify_embeddings"]),
+    ("semantic_search_cli.py", ["query_cache"]),
+    ("semantic_search_cli.py", ["search", SAMPLE_QUERY]),
+    ("semantic_search_cli.py", ["search_chunked", SAMPLE_QUERY]),
+    ("hybrid_search_cli.py", ["search", SAMPLE_QUERY]),
+]
+
+
+def run_command(script: str, arguments: list[str], import_time: bool = False) -> subprocess.CompletedProcess:
+    flags = ["-X", "importtime"] if import_time else []
+    return subprocess.run([sys.executable, *flags, script, *arguments], cwd=CLI_DIR, capture_output=True, text=True)
+
+
+def loaded_heavy_modules(import_log: str) -> list[str]:
+    # -X importtime writes "import time: self | cumulative | module" for every module imported
+    loaded = set()
+    for line in import_log.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            module = line.rsplit("|", 1)[1].strip()
+            if module in HEAVY_MODULES:
+                loaded.add(module)
+    return [module for module in HEAVY_MODULES if module in loaded]
+
+
+def time_encoding(texts: list[str], workers: int, batch_size: int) -> float:
+    # Seconds to encode `texts` the way an embedding build does, once the model(s) are loaded
+    from lib.semantic_search import SemanticSearch
+    ss = SemanticSearch()
+    ss.enable_encode_pool(workers, batch_size)
+    try:
+        if ss.encode_pool is not None:
+            ss.encode_pool.warm_up()
+        else:
+            ss.model.encode(["warm up"])
+        start = time.perf_counter()
+        for batch in itertools.batched(texts, batch_size):
+            ss._encode_documents(list(batch))
+        return time.perf_counter() - start
+    finally:
+        ss.disable_encode_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    startup_parser = subparsers.add_parser("startup", help="Time each CLI subcommand from process start to exit and list the heavy modules it imports")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="Timed runs per subcommand, after one untimed warm-up run (default: 5)")
+
+    encode_parser = subparsers.add_parser("encode", help="Measure chunk encoding throughput (docs/s) for several encode worker counts")
+    encode_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare (default: 1 2 4)")
+    encode_parser.add_argument("--texts", type=int, default=4096, help="Number of movie chunks to encode (default: 4096)")
+    encode_parser.add_argument("--batch-size", type=int, default=None, help="Texts per encode call (default: ENCODE_BATCH_SIZE)")
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "startup":
+            print(f"{'command':<45} {'median ms':>10} {'min ms':>8}  heavy imports")
+            for script, arguments in STARTUP_COMMANDS:
+                # The warm-up run also fills caches (embeddings, query vectors) the timed runs rely on
+                warmup = run_command(script, arguments)
+                name = f"{script.removesuffix('_cli.py')} {arguments[0]}"
+                if warmup.returncode != 0:
+                    print(f"{name:<45} failed: {warmup.stderr.strip().splitlines()[-1] if warmup.stderr.strip() else warmup.returncode}")
+                    continue
+                imports = run_command(script, arguments, import_time=True)
+
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    run_command(script, arguments)
+                    times.append((time.perf_counter() - start) * 1000)
+                heavy = ", ".join(loaded_heavy_modules(imports.stderr)) or "-"
+                print(f"{name:<45} {statistics.median(times):>10.0f} {min(times):>8.0f}  {heavy}")
+
+        case "encode":
+            from lib.docstore import load_docstore
+            from lib.search_utils import ENCODE_BATCH_SIZE
+            from lib.semantic_search import iter_chunks
+            texts = [chunk for *_, chunk in itertools.islice(iter_chunks(load_docstore()), args.texts)]
+            batch_size = args.batch_size or ENCODE_BATCH_SIZE
+
+            print(f"{len(texts)} chunks, batch size {batch_size}, {len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()} CPUs")
+            print(f"{'workers':>7} {'seconds':>9} {'docs/s':>9} {'speedup':>8}")
+            baseline = None
+            for workers in args.workers:
+                seconds = time_encoding(texts, workers, batch_size)
+                baseline = baseline or seconds
+                print(f"{workers:>7} {seconds:>9.2f} {len(texts) / seconds:>9.1f} {baseline / seconds:>7.2f}x")
+
+        case _:
+            parser.print_help()
+
+if __name__ == "__main__":
+    main()
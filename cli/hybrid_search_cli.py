@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from lib.hybrid_cmds import cmd_hybrid_search
+from lib.hybrid_search import FUSION_METHODS
+from lib.search_utils import DEFAULT_SERVER_ADDRESS, DEFAULT_SEARCH_LIMIT, DEFAULT_HYBRID_ALPHA, DEFAULT_RRF_K
+
+def main():
+    parser = argparse.ArgumentParser(description="Hybrid Search CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    search_parser = subparsers.add_parser("search", help="Combine BM25 and semantic search with rank fusion")
+    search_parser.add_argument("query", type=str, help="search query")
+    search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    search_parser.add_argument("--method", choices=FUSION_METHODS, default="rrf", help="Reciprocal rank fusion or weighted min-max normalized scores (default: rrf)",)
+    search_parser.add_argument("--alpha", type=float, default=DEFAULT_HYBRID_ALPHA, help=f"Keyword weight for weighted fusion, semantic gets 1 - alpha (default: {DEFAULT_HYBRID_ALPHA})",)
+    search_parser.add_argument("--k", type=int, default=DEFAULT_RRF_K, help=f"RRF rank constant (default: {DEFAULT_RRF_K})",)
+    search_parser.add_argument("--chunks", action="store_true", help="Use chunk embeddings for the semantic side")
+    search_parser.add_argument("--timing", action="store_true", help="Print the latency of each retriever and of the hybrid query")
+    search_parser.add_argument("--server", type=str, nargs="?", const=DEFAULT_SERVER_ADDRESS, default=None, help=f"Send the query to a running search server instead of loading everything (default address: {DEFAULT_SERVER_ADDRESS})",)
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "search":
+            sys.exit(cmd_hybrid_search(args.query, args.limit, args.method, args.alpha, args.k, args.chunks, args.timing, args.server))
+
+        case _:
+            parser.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,14 @@
 
 import argparse
 import sys
+import time
 
-from lib.keyword_search import search_command, tokenize_text
+from lib.keyword_search import search_command, tokenize_text, get_tokenizer
 from lib.index import InvertedIndex
-from lib.search_utils import DEFAULT_SEARCH_LIMIT, BM25_K1, BM25_B
+from lib.bm25 import EXHAUSTIVE, SEARCH_STRATEGIES
+from lib.search_client import query_server
+from lib.batch_io import read_queries, stream_results, report_throughput
+from lib.search_utils import DEFAULT_SERVER_ADDRESS, DEFAULT_QUERY_BATCH_SIZE, DEFAULT_SEARCH_LIMIT, BM25_K1, BM25_B
 
 def search_and_print(idx, tokens):
     results = []
@@ -52,14 +56,19 @@ def main() -> None:
 
     #Build an index 
     build_parser = subparsers.add_parser("build", help="Build movie index and save it to disk")
+    build_parser.add_argument("--workers", type=int, default=1, help="Number of processes tokenizing in parallel, 0 for one per CPU (default: 1)",)
 
-    #Index, regardless
-    index_parser = subparsers.add_parser("index", help="Rebuild the index")
+    #Incremental indexing
+    index_parser = subparsers.add_parser("index", help="Update the index with new, changed and deleted movies")
     index_parser.add_argument(
         "--force",
         action="store_true",
         help="Force rebuilding even if index exists",
     )
+    index_parser.add_argument("--workers", type=int, default=1, help="Number of processes tokenizing new and changed movies in parallel, 0 for one per CPU (default: 1)",)
+
+    #Compact the index segments
+    subparsers.add_parser("merge", help="Merge all index segments into one, dropping deleted documents")
 
     #TermFrequency command
     tf_parser = subparsers.add_parser("tf", help="Count the instances of a term in a DocumentID")
@@ -87,8 +96,26 @@ def main() -> None:
     #Okapi BM25 search parser
     bm25_search_parser = subparsers.add_parser("bm25search", help="Search movies using full BM25 scoring")
     bm25_search_parser.add_argument("query", type=str, help="Search query")
+    bm25_search_parser.add_argument("k1", type=float, nargs='?', default=BM25_K1, help="Tunable BM25 k1 parameter")
+    bm25_search_parser.add_argument("b", type=float, nargs='?', default=BM25_B, help="Tunable BM25 b parameter")
     bm25_search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
-
+    bm25_search_parser.add_argument("--strategy", choices=SEARCH_STRATEGIES, default=EXHAUSTIVE, help=f"Exhaustive scoring, bmw (Block-Max pruning, fastest when the query has selective terms) or wand (slow pure-Python reference for the pruning rules) (default: {EXHAUSTIVE})",)
+    bm25_search_parser.add_argument("--server", type=str, nargs="?", const=DEFAULT_SERVER_ADDRESS, default=None, help=f"Send the query to a running search server instead of loading the index (default address: {DEFAULT_SERVER_ADDRESS})",)
+
+    #Many BM25 searches against one loaded index
+    batch_parser = subparsers.add_parser("batch", help="BM25 search every query in a file (one per line, or JSON objects with a query field) and stream JSONL results")
+    batch_parser.add_argument("input", type=str, nargs="?", default="-", help="Query file, - for stdin (default: -)")
+    batch_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    batch_parser.add_argument("--k1", type=float, default=BM25_K1, help="Tunable BM25 k1 parameter")
+    batch_parser.add_argument("--b", type=float, default=BM25_B, help="Tunable BM25 b parameter")
+    batch_parser.add_argument("--strategy", choices=SEARCH_STRATEGIES, default=EXHAUSTIVE, help=f"Exhaustive scoring, bmw (Block-Max pruning, fastest when the query has selective terms) or wand (slow pure-Python reference for the pruning rules) (default: {EXHAUSTIVE})",)
+    batch_parser.add_argument("--batch-size", type=int, default=DEFAULT_QUERY_BATCH_SIZE, help=f"Queries written per flush (default: {DEFAULT_QUERY_BATCH_SIZE})",)
+
+    #Compare exhaustive and pruned BM25 evaluation
+    bm25_compare_parser = subparsers.add_parser("bm25compare", help="Check that every BM25 search strategy returns the same results and compare their latency")
+    bm25_compare_parser.add_argument("query", type=str, help="Search query")
+    bm25_compare_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    bm25_compare_parser.add_argument("--repeat", type=int, default=10, help="Number of timed runs per strategy (default: 10)",)
 
     args = parser.parse_args()
 
@@ -112,23 +139,64 @@ def main() -> None:
             except FileNotFoundError as e:
                 print("Index not found, run build first")
                 sys.exit(1)
-            bm25tf = idx.get_bm25_tf(args.doc_id, args.term)            
+            bm25tf = idx.get_bm25_tf(args.doc_id, args.term, args.k1, args.b)            
             print(f"BM25 TF score of '{args.term}' in document '{args.doc_id}': {bm25tf:.2f}")
 
         case "bm25search":            
-            print("Loading index")
+            if args.server:
+                # A running search server already has the index loaded
+                print(f"Searching for: {args.query}")
+                search_results = query_server(args.server, "bm25", args.query, limit=args.limit, k1=args.k1, b=args.b, strategy=args.strategy)
+            else:
+                print("Loading index")
+                idx = InvertedIndex()
+                try:            
+                    idx.load()
+                except FileNotFoundError as e:
+                    print("Index not found, run build first")
+                    sys.exit(1)
+                print(f"Searching for: {args.query}")
+
+                search_results = idx.bm25_search(args.query, args.limit, args.k1, args.b, args.strategy)
+
+            for i, res in enumerate(search_results, 1):
+                print(f"{i}. ({res['doc_id']}) {res['title']} - Score: {res['score']:.2f}")
+
+        case "batch":
             idx = InvertedIndex()
-            try:            
+            try:
                 idx.load()
             except FileNotFoundError as e:
-                print("Index not found, run build first")
+                print("Index not found, run build first", file=sys.stderr)
                 sys.exit(1)
-            print(f"Searching for: {args.query}")
 
-            search_results = idx.bm25_search(args.query, args.limit)
+            search_batch = lambda queries: [idx.bm25_search(query, args.limit, args.k1, args.b, args.strategy) for query in queries]
+            get_tokenizer()     # Import nltk before the clock starts, so the throughput measures queries
+            report_throughput(stream_results(read_queries(args.input), search_batch, args.batch_size))
 
-            for i, res in enumerate(search_results, 1):
-                print(f"{i}. ({res['doc_id']}) {res['title']} - Score: {res['score']:.2f}")
+        case "bm25compare":
+            idx = InvertedIndex()
+            try:
+                idx.load()
+            except FileNotFoundError as e:
+                print("Index not found, run build first")
+                sys.exit(1)
+            print(f"Comparing strategies for: {args.query}")
+
+            reference = None
+            for strategy in SEARCH_STRATEGIES:
+                # Warm up once so page faults and cached length norms don't skew the first strategy
+                results = idx.bm25_search(args.query, args.limit, strategy=strategy)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    idx.bm25_search(args.query, args.limit, strategy=strategy)
+                elapsed_ms = (time.perf_counter() - start) * 1000 / max(args.repeat, 1)
+
+                ranking = [(res["doc_id"], round(res["score"], 9)) for res in results]
+                if reference is None:
+                    reference = ranking
+                status = "same results" if ranking == reference else "RESULTS DIFFER"
+                print(f"{strategy:>10}: {elapsed_ms:8.3f} ms/query - {status}")
 
             
 
@@ -139,7 +207,7 @@ def main() -> None:
             # Instantiate the class
             idx = InvertedIndex()
             # Build the index
-            idx.build()
+            idx.build(args.workers)
             # Save it to disk
             idx.save()            
 
@@ -155,8 +223,43 @@ def main() -> None:
             print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
 
         case "index":
-            print(f"Rebuilding index, force={args.force}")
-            
+            idx = InvertedIndex()
+            rebuild = args.force
+            if not rebuild:
+                try:
+                    idx.load()
+                except FileNotFoundError:
+                    rebuild = True  # No index yet
+                except ValueError as e:
+                    # Old manifest version or a damaged segment; only a full rebuild can replace it
+                    print(f"{e}")
+                    print("Run index --force to rebuild the index")
+                    sys.exit(1)
+
+            if rebuild:
+                print("Rebuilding index")
+                idx.build(args.workers)
+                idx.save()
+                print(f"Indexed {idx.num_documents()} documents")
+                return
+
+            changes = idx.update(workers=args.workers)
+            idx.save()
+            print(f"Added {changes['added']}, updated {changes['updated']}, deleted {changes['deleted']} documents")
+            print(f"{idx.num_documents()} documents in {len(idx.segments)} segment(s){' (merged)' if changes['merged'] else ''}")
+
+        case "merge":
+            idx = InvertedIndex()
+            try:
+                idx.load()
+            except FileNotFoundError as e:
+                print("Index not found, run build first")
+                sys.exit(1)
+            before = len(idx.segments)
+            idx.merge()
+            idx.save()
+            print(f"Merged {before} segment(s) into {len(idx.segments)}, {idx.num_documents()} documents")
+
         case "search":            
             print("Loading index")
             idx = InvertedIndex()
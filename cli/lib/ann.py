@@ -0,0 +1,408 @@
+import hashlib
+import heapq
+import math
+import os
+
+import numpy as np
+
+from .search_utils import top_k_indices, DEFAULT_IVF_NPROBE, DEFAULT_HNSW_M, DEFAULT_HNSW_EF_CONSTRUCTION, DEFAULT_HNSW_EF_SEARCH
+
+# Search backends selectable from the CLI; "exact" is the brute-force matrix product
+ANN_METHODS = ("exact", "ivf", "hnsw")
+
+KMEANS_ITERATIONS = 20
+KMEANS_TRAINING_POINTS_PER_LIST = 256   # k-means is trained on a sample of at most this many points per centroid
+ASSIGN_BATCH_SIZE = 8192                # Rows scored against the centroids at once, bounds the (rows x nlist) buffer
+
+
+def default_nlist(num_vectors: int) -> int:
+    # Common rule of thumb: about sqrt(N) lists keeps both the centroid scan and the probed lists small
+    return max(1, int(round(np.sqrt(num_vectors))))
+
+
+def file_fingerprint(path: str) -> str:
+    # Cheap identity of a cached embeddings file, used to notice when an index was built from stale vectors
+    st = os.stat(path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def rows_digest(vectors: np.ndarray, count: int) -> str:
+    # Content of the first `count` rows, so an index can tell embeddings appended after it was built from changed ones
+    return hashlib.sha256(np.ascontiguousarray(vectors[:count])).hexdigest()
+
+
+def exact_search(vectors: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    # Brute-force inner product search over unit-length rows, used as the recall reference
+    scores = vectors @ query
+    ids = top_k_indices(scores, k)
+    return ids, scores[ids]
+
+
+def recall_at_k(exact_ids, approx_ids) -> float:
+    # Fraction of the exact top-k that the approximate search also returned
+    exact = set(np.asarray(exact_ids).tolist())
+    if not exact:
+        return 1.0
+    return len(exact & set(np.asarray(approx_ids).tolist())) / len(exact)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # Nearest centroid (max inner product) for every row, computed in batches
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH_SIZE):
+        batch = vectors[start:start + ASSIGN_BATCH_SIZE]
+        assignments[start:start + len(batch)] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors: np.ndarray, k: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    # k-means on the unit sphere: assign by inner product, re-normalize the centroid means
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+
+        # Re-seed empty clusters with random points so every list stays usable
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = vectors[rng.choice(len(vectors), size=len(empty), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+
+    return centroids
+
+
+class IVFIndex:
+    """Inverted file ANN index over a matrix of L2-normalized vectors
+
+    A spherical k-means coarse quantizer splits the rows into `nlist` cells; each
+    cell keeps an inverted list of row IDs (stored CSR-style like the keyword
+    postings). A query is scored against the centroids, and only the rows in the
+    `nprobe` closest cells are scored exactly.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray, fingerprint: str = ""):
+        self.centroids = centroids
+        self.list_offsets = list_offsets    # Cell -> start offset into list_ids (length nlist + 1)
+        self.list_ids = list_ids            # Row IDs grouped by cell, ascending within each cell
+        self.fingerprint = fingerprint      # Identity of the embeddings the index was built from
+        self.nprobe = DEFAULT_IVF_NPROBE
+
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int | None = None, seed: int = 0, fingerprint: str = "") -> "IVFIndex":
+        nlist = min(nlist or default_nlist(len(vectors)), len(vectors))
+
+        # Train on a sample, then assign every row to its nearest centroid
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), nlist * KMEANS_TRAINING_POINTS_PER_LIST)
+        sample = vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))]
+        centroids = spherical_kmeans(sample, nlist, seed=seed)
+
+        assignments = _assign(vectors, centroids)
+        list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=nlist), out=list_offsets[1:])
+        return cls(centroids, list_offsets, list_ids, fingerprint)
+
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_ids"], str(data["fingerprint"]))
+
+
+    def save(self, path: str) -> None:
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids, fingerprint=self.fingerprint)
+
+
+    def search(self, vectors: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Top-k (row IDs, scores) for one unit-length query, probing the nprobe nearest cells
+        cells = top_k_indices(self.centroids @ query, self.nprobe)
+        candidates = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in cells])
+        candidates.sort()   # Ascending row IDs keep tie-breaking identical to exact search
+
+        scores = vectors[candidates] @ query
+        best = top_k_indices(scores, k)
+        return candidates[best], scores[best]
+
+
+def load_or_create_ivf(vectors: np.ndarray, source_path: str, index_path: str, nlist: int | None = None) -> IVFIndex:
+    # Reuse the IVF index cached next to the embeddings unless the embeddings file changed (or nlist differs)
+    fingerprint = file_fingerprint(source_path)
+    if os.path.exists(index_path):
+        index = IVFIndex.load(index_path)
+        if index.fingerprint == fingerprint and (nlist is None or len(index.centroids) == min(nlist, len(vectors))):
+            return index
+
+    index = IVFIndex.build(vectors, nlist, fingerprint=fingerprint)
+    index.save(index_path)
+    return index
+
+
+
+class HNSWIndex:
+    """Hierarchical Navigable Small World graph over a matrix of L2-normalized vectors
+
+    Every node has a random level; it is linked to up to 2*M neighbours on layer 0
+    and up to M neighbours on each layer above it. Queries descend greedily through
+    the sparse upper layers and run a best-first beam search of width ef_search on
+    layer 0. The graph lives in fixed-width int32 arrays padded with -1, so it saves
+    and loads as plain arrays and new rows can be inserted incrementally with `add`.
+    """
+
+    def __init__(self, m: int = DEFAULT_HNSW_M, ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION, seed: int = 0):
+        if m < 2:
+            raise ValueError(f"HNSW M must be at least 2, got {m}")   # Level sampling uses 1 / log(M)
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = DEFAULT_HNSW_EF_SEARCH
+        self.level_mult = 1 / math.log(m)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        self.num_nodes = 0
+        self.entry_point = -1
+        self.max_level = -1
+        self.levels = np.empty(0, dtype=np.int8)                # Node -> top layer
+        self.links0 = np.empty((0, self.m0), dtype=np.int32)    # Node -> layer 0 neighbours
+        self.upper_start = np.empty(0, dtype=np.int32)          # Node -> first row in upper_links (layer 1), -1 if none
+        self.upper_links = np.empty((0, m), dtype=np.int32)     # One row of neighbours per (node, layer >= 1)
+        self.num_upper_rows = 0
+        self.fingerprint = ""      # Identity of the embeddings file the graph was last brought up to date with
+        self.rows_digest = ""      # rows_digest of the rows in the graph
+
+
+    def _links(self, node: int, level: int) -> np.ndarray:
+        if level == 0:
+            return self.links0[node]
+        return self.upper_links[self.upper_start[node] + level - 1]
+
+    def _neighbours(self, node: int, level: int) -> np.ndarray:
+        links = self._links(node, level)
+        return links[links >= 0]
+
+    def _reserve(self, num_nodes: int, num_upper_rows: int) -> None:
+        # Grow the backing arrays geometrically so repeated inserts stay amortized O(1)
+        if num_nodes > len(self.levels):
+            capacity = max(num_nodes, 2 * len(self.levels))
+            self.levels = np.resize(self.levels, capacity)
+            self.upper_start = np.resize(self.upper_start, capacity)
+            links0 = np.full((capacity, self.m0), -1, dtype=np.int32)
+            links0[:self.num_nodes] = self.links0[:self.num_nodes]
+            self.links0 = links0
+        if num_upper_rows > len(self.upper_links):
+            capacity = max(num_upper_rows, 2 * len(self.upper_links))
+            upper_links = np.full((capacity, self.m), -1, dtype=np.int32)
+            upper_links[:self.num_upper_rows] = self.upper_links[:self.num_upper_rows]
+            self.upper_links = upper_links
+
+
+    def _search_layer(self, vectors: np.ndarray, query: np.ndarray, entry_points: list[int], ef: int, level: int) -> list[tuple[float, int]]:
+        # Best-first beam search on one layer; returns up to ef (similarity, node) pairs, best first
+        visited = set(entry_points)
+        entry_scores = vectors[entry_points] @ query
+        candidates = [(-float(s), n) for s, n in zip(entry_scores, entry_points)]   # Max-heap on similarity
+        results = [(float(s), n) for s, n in zip(entry_scores, entry_points)]       # Min-heap of the best ef so far
+        heapq.heapify(candidates)
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            neg_score, node = heapq.heappop(candidates)
+            if -neg_score < results[0][0] and len(results) >= ef:
+                break
+            fresh = [n for n in self._neighbours(node, level).tolist() if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for score, neighbour in zip((vectors[fresh] @ query).tolist(), fresh):
+                if len(results) < ef or score > results[0][0]:
+                    heapq.heappush(candidates, (-score, neighbour))
+                    heapq.heappush(results, (score, neighbour))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted(results, key=lambda item: (-item[0], item[1]))
+
+
+    def _select_neighbours(self, vectors: np.ndarray, candidates: list[tuple[float, int]], max_links: int) -> list[int]:
+        # HNSW heuristic: keep a candidate only if it is closer to the base node than to every neighbour kept so far,
+        # then top up with the best pruned candidates so nodes stay well connected
+        if len(candidates) <= max_links:
+            return [node for _, node in candidates]
+
+        nodes = [node for _, node in candidates]
+        pairwise = vectors[nodes] @ vectors[nodes].T
+        kept, pruned = [], []
+        for i, (score, node) in enumerate(candidates):
+            if len(kept) >= max_links:
+                break
+            if all(score > pairwise[i, j] for j in kept):
+                kept.append(i)
+            else:
+                pruned.append(i)
+        kept.extend(pruned[:max_links - len(kept)])
+        return [nodes[i] for i in kept]
+
+
+    def _connect(self, vectors: np.ndarray, node: int, neighbour: int, level: int) -> None:
+        # Add a back link from neighbour to node, re-selecting the neighbour's links if its row is full
+        links = self._links(neighbour, level)
+        free = np.flatnonzero(links < 0)
+        if len(free):
+            links[free[0]] = node
+            return
+
+        current = np.append(links, node)
+        scores = vectors[current] @ vectors[neighbour]
+        candidates = sorted(zip(scores.tolist(), current.tolist()), key=lambda item: (-item[0], item[1]))
+        selected = self._select_neighbours(vectors, candidates, len(links))
+        links[:] = -1
+        links[:len(selected)] = selected
+
+
+    def add(self, vectors: np.ndarray) -> None:
+        # Insert every row of `vectors` that is not in the graph yet (rows num_nodes .. len(vectors) - 1)
+        for node in range(self.num_nodes, len(vectors)):
+            level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+            self._reserve(node + 1, self.num_upper_rows + level)
+            self.levels[node] = level
+            self.links0[node] = -1
+            self.upper_start[node] = self.num_upper_rows if level > 0 else -1
+            self.upper_links[self.num_upper_rows:self.num_upper_rows + level] = -1
+            self.num_upper_rows += level
+            self.num_nodes = node + 1
+
+            if self.entry_point < 0:
+                self.entry_point, self.max_level = node, level
+                continue
+
+            query = vectors[node]
+            entry_points = [self.entry_point]
+            # Greedy descent through the layers above the new node's level
+            for lc in range(self.max_level, level, -1):
+                entry_points = [self._search_layer(vectors, query, entry_points, 1, lc)[0][1]]
+
+            for lc in range(min(level, self.max_level), -1, -1):
+                found = self._search_layer(vectors, query, entry_points, self.ef_construction, lc)
+                max_links = self.m0 if lc == 0 else self.m
+                neighbours = self._select_neighbours(vectors, found, max_links)
+                self._links(node, lc)[:len(neighbours)] = neighbours
+                for neighbour in neighbours:
+                    self._connect(vectors, node, neighbour, lc)
+                entry_points = [n for _, n in found]
+
+            if level > self.max_level:
+                self.entry_point, self.max_level = node, level
+
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, m: int = DEFAULT_HNSW_M, ef_construction: int = DEFAULT_HNSW_EF_CONSTRUCTION, fingerprint: str = "") -> "HNSWIndex":
+        index = cls(m, ef_construction)
+        index.add(vectors)
+        index.fingerprint = fingerprint
+        index.rows_digest = rows_digest(vectors, len(vectors))
+        return index
+
+
+    def extend(self, vectors: np.ndarray, fingerprint: str) -> bool:
+        # Catch up with embeddings that only gained rows since the graph was built by inserting the new rows;
+        # False (graph untouched) if any row the graph already holds has changed, which needs a rebuild
+        if self.num_nodes > len(vectors) or rows_digest(vectors, self.num_nodes) != self.rows_digest:
+            return False
+        self.add(vectors)
+        self.fingerprint = fingerprint
+        self.rows_digest = rows_digest(vectors, len(vectors))
+        return True
+
+
+    def search(self, vectors: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Top-k (row IDs, scores) for one unit-length query
+        if self.entry_point < 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=vectors.dtype)
+
+        entry_points = [self.entry_point]
+        for lc in range(self.max_level, 0, -1):
+            entry_points = [self._search_layer(vectors, query, entry_points, 1, lc)[0][1]]
+        found = self._search_layer(vectors, query, entry_points, max(self.ef_search, k), 0)[:k]
+
+        ids = np.array([node for _, node in found], dtype=np.int64)
+        return ids, vectors[ids] @ query
+
+
+    @classmethod
+    def load(cls, path: str) -> "HNSWIndex":
+        with np.load(path) as data:
+            m, ef_construction, entry_point, max_level = data["params"].tolist()
+            index = cls(m, ef_construction, int(data["seed"]) if "seed" in data else 0)
+            index.levels = data["levels"]
+            index.links0 = data["links0"]
+            index.upper_start = data["upper_start"]
+            index.upper_links = data["upper_links"]
+            index.fingerprint = str(data["fingerprint"])
+            index.rows_digest = str(data["rows_digest"]) if "rows_digest" in data else ""     # Older graphs can only be rebuilt
+        index.num_nodes = len(index.levels)
+        index.num_upper_rows = len(index.upper_links)
+        index.entry_point, index.max_level = entry_point, max_level
+        # A fresh generator would replay the levels of the first nodes for every appended row;
+        # one seeded from the graph size gives rows added after a load their own draws
+        index.rng = np.random.default_rng([index.seed, index.num_nodes])
+        return index
+
+
+    def save(self, path: str) -> None:
+        # Only the used part of the (over-allocated) arrays is written
+        np.savez(
+            path,
+            params=np.array([self.m, self.ef_construction, self.entry_point, self.max_level], dtype=np.int64),
+            levels=self.levels[:self.num_nodes],
+            links0=self.links0[:self.num_nodes],
+            upper_start=self.upper_start[:self.num_nodes],
+            upper_links=self.upper_links[:self.num_upper_rows],
+            fingerprint=self.fingerprint,
+            rows_digest=self.rows_digest,
+            seed=self.seed,
+        )
+
+
+def load_hnsw(vectors: np.ndarray, source_path: str, index_path: str) -> HNSWIndex:
+    # Graph cached next to the embeddings for querying. Rows appended to the embeddings since the last build
+    # are inserted (and the graph saved again); any other change needs an explicit build_hnsw
+    if not os.path.exists(index_path):
+        raise FileNotFoundError(f"HNSW graph not found at {index_path}, run build_hnsw first")
+    index = HNSWIndex.load(index_path)
+    fingerprint = file_fingerprint(source_path)
+    if index.fingerprint != fingerprint:
+        if not index.extend(vectors, fingerprint):
+            raise ValueError(f"The embeddings changed since the HNSW graph at {index_path} was built, run build_hnsw again")
+        index.save(index_path)
+    return index
+
+
+def build_hnsw(vectors: np.ndarray, source_path: str, index_path: str, m: int | None = None, ef_construction: int | None = None) -> HNSWIndex:
+    # Bring the cached graph up to date: extend it when rows were only appended and M / ef_construction are
+    # unchanged, otherwise build it from scratch
+    fingerprint = file_fingerprint(source_path)
+    if os.path.exists(index_path):
+        index = HNSWIndex.load(index_path)
+        # Parameters not given are kept from the cached graph
+        m, ef_construction = m or index.m, ef_construction or index.ef_construction
+        if index.m == m and index.ef_construction == ef_construction:
+            if index.fingerprint == fingerprint:
+                return index
+            if index.extend(vectors, fingerprint):
+                index.save(index_path)
+                return index
+
+    index = HNSWIndex.build(vectors, m or DEFAULT_HNSW_M, ef_construction or DEFAULT_HNSW_EF_CONSTRUCTION, fingerprint)
+    index.save(index_path)
+    return index
@@ -0,0 +1,73 @@
+import itertools
+import json
+import sys
+import time
+
+from .search_utils import DEFAULT_QUERY_BATCH_SIZE
+
+
+def parse_query_line(line: str, line_num: int) -> tuple:
+    # (query ID, query, error) for one input line; error is None when the line holds a usable query
+    if not line.startswith("{"):
+        return line_num, line, None
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        return line_num, line, f"invalid JSON: {e}"
+    if not isinstance(record, dict):
+        return line_num, line, "expected a JSON object"
+    query_id, query = record.get("id", line_num), record.get("query")
+    if query is None:
+        return query_id, None, 'missing "query"'
+    if not isinstance(query, str):
+        return query_id, query, '"query" must be a string'
+    return query_id, query, None
+
+
+def read_queries(path: str | None = None):
+    # (query ID, query, error) triples streamed from a file, or stdin for None / "-"
+    # Each line is either plain query text (ID = line number) or a JSON object with "query" and an optional "id";
+    # a line without a usable query carries an error message instead of stopping the whole run
+    stream = sys.stdin if path in (None, "-") else open(path, encoding="utf-8")
+    try:
+        for line_num, line in enumerate(stream, 1):
+            line = line.strip()
+            if line:
+                yield parse_query_line(line, line_num)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def stream_results(lines, search_batch, batch_size: int = DEFAULT_QUERY_BATCH_SIZE, out=None) -> dict:
+    """Run (query ID, query, error) triples through `search_batch` and write one JSON line per query
+
+    `search_batch` takes a list of queries and returns one result list per query.
+    Only one batch is held at a time, so memory does not grow with the input, and
+    output is flushed after every batch so consumers see results as they finish.
+    Returns the number of queries and the elapsed seconds.
+    """
+    out = out or sys.stdout
+    count = 0
+    start = time.perf_counter()
+    for batch in itertools.batched(lines, batch_size):
+        # Unreadable and empty queries get an error line instead of failing the whole batch
+        batch = [(query_id, query, error or (None if query.strip() else "query cannot be empty or white space")) for query_id, query, error in batch]
+        queries = [query for _, query, error in batch if error is None]
+        results = iter(search_batch(queries) if queries else [])
+        for query_id, query, error in batch:
+            record = {"id": query_id, "query": query}
+            if error is None:
+                record["results"] = next(results)
+            else:
+                record["error"] = error
+            out.write(json.dumps(record) + "\n")
+        out.flush()
+        count += len(batch)
+    return {"queries": count, "seconds": time.perf_counter() - start}
+
+
+def report_throughput(summary: dict) -> None:
+    # Goes to stderr so stdout stays pure JSONL
+    rate = summary["queries"] / summary["seconds"] if summary["seconds"] > 0 else 0.0
+    print(f"{summary['queries']} queries in {summary['seconds']:.2f} s ({rate:.1f} queries/s)", file=sys.stderr)
@@ -0,0 +1,133 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+from .search_utils import DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_BATCH_WAIT_MS
+
+
+def power_of_two_histogram(counts: Counter) -> dict:
+    # {"1": n, "2-3": n, "4-7": n, ...} from exact value counts, so the histogram stays short
+    buckets = {}
+    for value in sorted(counts):
+        low = 1 << (value.bit_length() - 1) if value > 0 else 0
+        high = 2 * low - 1 if low > 0 else 0
+        label = str(low) if low == high else f"{low}-{high}"
+        buckets[label] = buckets.get(label, 0) + counts[value]
+    return buckets
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls into batches handled by one background thread
+
+    A batch starts with the first waiting request and closes once it holds
+    `max_batch` requests or `max_wait_ms` has passed, whichever comes first.
+    `handler` receives the list of batched items and returns one result per item.
+    """
+
+    def __init__(self, handler, max_batch: int = DEFAULT_MAX_BATCH_SIZE, max_wait_ms: float = DEFAULT_MAX_BATCH_WAIT_MS, name: str = "batcher"):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self.batch_sizes = Counter()    # Batch size -> number of batches
+        self.queue_depths = Counter()   # Requests waiting when a batch was started -> number of batches
+        self._stopped = None            # Set once the worker thread has died, so later calls fail instead of hanging
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._lock:
+            if self._stopped is not None:
+                raise RuntimeError("batcher worker has stopped") from self._stopped
+            self._queue.put((item, future))
+        return future
+
+
+    def __call__(self, item):
+        # Blocking call: wait for the batch containing `item` and return its result
+        return self.submit(item).result()
+
+
+    def _collect(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            # Take what is already queued without waiting, then wait out the rest of max_wait
+            try:
+                remaining = deadline - time.monotonic()
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)   # Let the worker loop see the shutdown after this batch
+                break
+            batch.append(request)
+        return batch
+
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            self.queue_depths[self._queue.qsize() + 1] += 1
+            batch = self._collect(first)
+            self.batch_sizes[len(batch)] += 1
+
+            try:
+                results = list(self.handler([item for item, _ in batch]))
+                if len(results) != len(batch):
+                    # zip would leave the unmatched callers waiting forever
+                    raise RuntimeError(f"batch handler returned {len(results)} results for {len(batch)} requests")
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            except BaseException as e:
+                # KeyboardInterrupt / SystemExit end the worker thread; fail everything it would have
+                # answered so no caller blocks forever on a future, then let the exception through
+                self._fail_pending(batch, e)
+                raise
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+    def _fail_pending(self, batch: list, cause: BaseException) -> None:
+        error = RuntimeError("batcher worker has stopped")
+        error.__cause__ = cause
+        with self._lock:
+            self._stopped = cause
+            while True:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not None:
+                    batch.append(request)
+        for _, future in batch:
+            future.set_exception(error)
+
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        requests = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            "batches": batches,
+            "requests": requests,
+            "mean_batch_size": requests / batches if batches else 0.0,
+            "queue_depth": self._queue.qsize(),
+            "batch_size_histogram": power_of_two_histogram(self.batch_sizes),
+            "queue_depth_histogram": power_of_two_histogram(self.queue_depths),
+        }
+
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,360 @@
+import bisect
+import heapq
+
+import numpy as np
+
+from .search_utils import BM25_K1, BM25_B, top_k_indices
+from .segment import POSTINGS_BLOCK_SIZE
+
+# Query evaluation strategies:
+#   exhaustive  score every posting of every query term (term-at-a-time, vectorized)
+#   wand        document-at-a-time WAND, skipping documents whose summed per-term upper bounds cannot reach the top-k.
+#               A pure Python reference implementation of the pruning logic, much slower than exhaustive
+#   bmw         Block-Max pruning evaluated with NumPy: postings blocks whose upper bounds cannot reach the top-k
+#               are never decoded, and the surviving blocks are scored as arrays
+EXHAUSTIVE = "exhaustive"
+WAND = "wand"
+BLOCK_MAX_WAND = "bmw"
+SEARCH_STRATEGIES = (EXHAUSTIVE, WAND, BLOCK_MAX_WAND)
+
+# Upper bounds are inflated by a relative epsilon so float rounding never prunes a document that ties the threshold
+UPPER_BOUND_SLACK = 1 + 1e-9
+EXHAUSTED = np.iinfo(np.int64).max
+
+# Doc number intervals scored in the first round of Block-Max evaluation; every later round scores twice as many
+BLOCK_MAX_FIRST_ROUND = 8
+# Block-Max falls back to exhaustive scoring when the blocks left after pruning hold this share of the query's postings
+BLOCK_MAX_DENSE_SHARE = 0.5
+
+
+class CollectionStats:
+    """Corpus statistics over the live (not deleted) documents of every segment
+
+    Document count and average document length are computed up front; document
+    frequencies and IDFs are computed per term on first use and cached, so opening
+    an index never scans the postings.
+    """
+
+    def __init__(self, segments: list, deleted: list):
+        self.segments = segments
+        self.deleted = deleted      # Per segment: boolean tombstone mask over doc numbers, or None
+        self.num_docs = 0
+        self.total_tokens = 0
+        for segment, dead in zip(segments, deleted):
+            if dead is None:
+                self.num_docs += segment.num_documents()
+                self.total_tokens += segment.total_tokens
+            else:
+                self.num_docs += int(np.count_nonzero(~dead))
+                self.total_tokens += int(segment.doc_lengths[~dead].sum())
+        self.avg_doc_length = self.total_tokens / self.num_docs if self.num_docs else 0.0
+        self._df = {}
+
+
+    def df(self, token: str) -> int:
+        # Number of live documents containing the token, across all segments
+        if token not in self._df:
+            df = 0
+            for segment, dead in zip(self.segments, self.deleted):
+                doc_nums, _ = segment.postings(token)
+                df += len(doc_nums) if dead is None else int(np.count_nonzero(~dead[doc_nums]))
+            self._df[token] = df
+        return self._df[token]
+
+
+    def idf(self, token: str) -> float:
+        df = self.df(token)
+        return float(np.log((self.num_docs - df + 0.5) / (df + 0.5) + 1))  # 0.5 and 1 are for edge cases and smoothing
+
+
+class BM25Scorer:
+    """Vectorized Okapi BM25 over a segment's CSR postings
+
+    Corpus statistics (document count, average document length and term IDFs) come
+    from a CollectionStats shared by every segment of the index, so a document scores
+    the same whichever segment holds it. Each query term is then scored for its whole
+    postings list in one NumPy expression and accumulated into a dense per-document
+    buffer; documents in the segment's tombstone mask never make the results.
+    """
+
+    def __init__(self, segment, stats: CollectionStats | None = None, deleted: np.ndarray | None = None):
+        self.segment = segment
+        self.deleted = deleted
+        self.stats = stats if stats is not None else CollectionStats([segment], [deleted])
+        self.avg_doc_length = self.stats.avg_doc_length
+
+        # k1 * length normalization per document, cached per (k1, b) pair
+        self._length_norms = {}
+
+
+    def length_norm(self, k1: float = BM25_K1, b: float = BM25_B) -> np.ndarray:
+        key = (k1, b)
+        if key not in self._length_norms:
+            doc_lengths = self.segment.doc_lengths.astype(np.float64)
+            self._length_norms[key] = k1 * (1 - b + b * (doc_lengths / self.avg_doc_length))
+        return self._length_norms[key]
+
+
+    def term_scores(self, term_id: int, idf: float, k1: float = BM25_K1, b: float = BM25_B) -> tuple[np.ndarray, np.ndarray]:
+        # BM25 contribution of one term for every document in its postings list
+        start, end = self.segment.term_offsets[term_id], self.segment.term_offsets[term_id + 1]
+        doc_nums = self.segment.postings_docs[start:end]
+        tfs = self.segment.postings_tfs[start:end].astype(np.float64)
+        norms = self.length_norm(k1, b)[doc_nums]
+        return doc_nums, (tfs * (k1 + 1)) / (tfs + norms) * idf
+
+
+    def score(self, tokens: list[str], k1: float = BM25_K1, b: float = BM25_B) -> np.ndarray:
+        # Dense score buffer indexed by doc number; repeated query tokens count once per occurrence
+        scores = np.zeros(self.segment.num_documents(), dtype=np.float64)
+        if self.avg_doc_length == 0:
+            return scores
+
+        for token in tokens:
+            term_id = self.segment.term_table.find(token)
+            if term_id < 0:
+                continue
+            doc_nums, contributions = self.term_scores(term_id, self.stats.idf(token), k1, b)
+            # Doc numbers are unique within a postings list, so plain fancy-index addition is safe
+            scores[doc_nums] += contributions
+        if self.deleted is not None:
+            scores[self.deleted] = 0
+        return scores
+
+
+    def search(self, tokens: list[str], limit: int, k1: float = BM25_K1, b: float = BM25_B, strategy: str = EXHAUSTIVE) -> list[tuple[int, float]]:
+        # Top `limit` (doc number, score) pairs, highest score first, ties broken by lower doc number
+        # Every strategy returns exactly the same results; the pruned ones only differ in how much work they do
+        if strategy == WAND:
+            return self.search_pruned(tokens, limit, k1, b)
+        if strategy == BLOCK_MAX_WAND:
+            return self.search_block_max(tokens, limit, k1, b)
+        if strategy != EXHAUSTIVE:
+            raise ValueError(f"Unknown search strategy: {strategy} (expected one of {', '.join(SEARCH_STRATEGIES)})")
+
+        scores = self.score(tokens, k1, b)
+        # Every matching document has a strictly positive score (IDF > 0 and TF >= 1)
+        return [(int(doc_num), float(scores[doc_num])) for doc_num in top_k_indices(scores, limit) if scores[doc_num] > 0]
+
+
+    def search_block_max(self, tokens: list[str], limit: int, k1: float = BM25_K1, b: float = BM25_B) -> list[tuple[int, float]]:
+        # Block-Max top-k evaluation, a block at a time with NumPy. The doc number range is cut at the last
+        # doc of every postings block of every query term, so each interval lies inside one block per term and
+        # the sum of those blocks' upper bounds caps the score of any document in it. Intervals are scored in
+        # descending bound order, in rounds of doubling size, until the best remaining bound is below the
+        # k-th best score found; blocks that only cover pruned intervals are never read.
+        if limit <= 0 or self.avg_doc_length == 0:
+            return []
+        segment = self.segment
+        found = [(segment.term_table.find(token), token) for token in tokens]
+        term_ids = [t for t, _ in found if t >= 0]
+        if not term_ids:
+            return []
+        idfs = {t: self.stats.idf(token) for t, token in found if t >= 0}
+        norms = self.length_norm(k1, b)
+
+        terms = {}      # Distinct term ID -> (postings docs, postings TFs, block of that term covering each interval)
+        last_docs = {t: segment.block_last_docs[segment.block_offsets[t]:segment.block_offsets[t + 1]] for t in term_ids}
+        boundaries = np.unique(np.concatenate(list(last_docs.values())))
+        bounds = np.zeros(len(boundaries), dtype=np.float64)
+        for term_id in last_docs:
+            start, end = segment.term_offsets[term_id], segment.term_offsets[term_id + 1]
+            covering = np.searchsorted(last_docs[term_id], boundaries)
+            # The term has no postings past its last block, which the appended 0 stands for
+            bounds += np.append(block_upper_bounds(self, term_id, idfs[term_id], term_ids.count(term_id), k1, b), 0.0)[covering]
+            terms[term_id] = (segment.postings_docs[start:end], segment.postings_tfs[start:end], covering)
+        num_postings = sum(len(docs) for docs, _, _ in terms.values())
+
+        order = np.argsort(-bounds, kind="stable")
+        widths = np.diff(boundaries.astype(np.int64), prepend=-1)    # Doc numbers in each interval
+        selected = np.zeros(len(boundaries), dtype=bool)
+        # Documents are scored in exactly one round, the one that covers their interval, so a dense buffer
+        # adding the contributions in query token order ends up bit-identical to the exhaustive scores
+        scores = np.zeros(segment.num_documents(), dtype=np.float64)
+        best = np.empty(0, dtype=np.float64)     # Best `limit` scores so far, only used for the threshold
+        done, size = 0, BLOCK_MAX_FIRST_ROUND
+        # An interval bounded at exactly the k-th score can still hold a tie with a lower doc number
+        while done < len(order) and (len(best) < limit or bounds[order[done]] >= best.min()):
+            last_round = len(best) == limit
+            if last_round:
+                # The k-th best score so far is a lower bound on the final one: every interval that can still
+                # beat it is scored in this round, after which nothing is left above the threshold
+                size = int(np.searchsorted(-bounds[order[done:]], -best.min(), side="right"))
+            chunk = order[done:done + size]
+            done, size = done + size, size * 2
+            blocks = {}
+            for term_id, (_, _, covering) in terms.items():
+                term_blocks = np.unique(covering[chunk])
+                blocks[term_id] = term_blocks[term_blocks < len(last_docs[term_id])]
+            if last_round and sum(map(len, blocks.values())) * POSTINGS_BLOCK_SIZE >= BLOCK_MAX_DENSE_SHARE * num_postings:
+                # Too little is pruned to pay for cutting the postings up: score them whole instead
+                scores = self.score(tokens, k1, b)
+                break
+            selected[:] = False
+            selected[chunk] = True
+            inside = np.repeat(selected, widths)    # Doc number -> inside one of this round's intervals
+
+            # Postings of the blocks covering this round's intervals, cut down to documents inside them
+            scored = {}
+            for term_id, (docs, tfs, _) in terms.items():
+                rows = _block_rows(blocks[term_id], len(docs))
+                rows = rows[inside[docs[rows]]]
+                doc_nums = docs[rows]
+                tf = tfs[rows].astype(np.float64)
+                # Same arithmetic as term_scores
+                scored[term_id] = (doc_nums, (tf * (k1 + 1)) / (tf + norms[doc_nums]) * idfs[term_id])
+            for term_id in term_ids:
+                doc_nums, contributions = scored[term_id]
+                scores[doc_nums] += contributions
+
+            if not last_round:
+                candidates = np.unique(np.concatenate([doc_nums for doc_nums, _ in scored.values()]))
+                if self.deleted is not None:
+                    candidates = candidates[~self.deleted[candidates]]
+                best = np.concatenate([best, scores[candidates]])
+                best = -np.sort(-best)[:limit]
+
+        if self.deleted is not None:
+            scores[self.deleted] = 0
+        # Only the scored documents are ranked; they come out ascending, so ties still go to the lower doc number
+        candidates = np.flatnonzero(scores)
+        return [(int(candidates[i]), float(scores[candidates[i]])) for i in top_k_indices(scores[candidates], limit)]
+
+
+    def search_pruned(self, tokens: list[str], limit: int, k1: float = BM25_K1, b: float = BM25_B) -> list[tuple[int, float]]:
+        # Document-at-a-time top-k evaluation with WAND dynamic pruning; one Python iteration per candidate
+        # document, so it is kept as a readable reference for the pruning rules rather than for speed
+        if limit <= 0 or self.avg_doc_length == 0:
+            return []
+
+        found = [(t, token) for t, token in ((self.segment.term_table.find(token), token) for token in tokens) if t >= 0]
+        term_ids = [t for t, _ in found]
+        norms = self.length_norm(k1, b)
+
+        # One cursor per distinct term; a term repeated in the query counts once per occurrence
+        cursors = []
+        for term_id, token in dict(found).items():
+            cursor = _TermCursor(self, term_id, self.stats.idf(token), term_ids.count(term_id), k1, b, norms)
+            if cursor.doc != EXHAUSTED:
+                cursors.append(cursor)
+
+        heap = []           # Min-heap of (score, -doc_num): the root is the current k-th best result
+        threshold = 0.0     # Every match scores > 0, so nothing is pruned until the heap is full
+
+        while cursors:
+            cursors.sort(key=lambda c: c.doc)
+
+            # Pivot: first cursor at which the summed term upper bounds could beat the threshold
+            upper_bound = 0.0
+            pivot = -1
+            for i, cursor in enumerate(cursors):
+                upper_bound += cursor.max_score
+                if upper_bound > threshold:
+                    pivot = i
+                    break
+            if pivot < 0:
+                break
+            pivot_doc = cursors[pivot].doc
+            # Every cursor already sitting on the pivot document contributes to it
+            while pivot + 1 < len(cursors) and cursors[pivot + 1].doc == pivot_doc:
+                pivot += 1
+
+            if cursors[0].doc == pivot_doc and self.deleted is not None and self.deleted[pivot_doc]:
+                # Deleted document: step every aligned cursor past it without scoring
+                for cursor in list(cursors[:pivot + 1]):
+                    _advance(cursors, cursor, pivot_doc + 1)
+            elif cursors[0].doc == pivot_doc:
+                # All cursors up to the pivot are aligned: fully score the document
+                contributions = {}
+                for cursor in cursors[:pivot + 1]:
+                    contributions[cursor.term_id] = cursor.contribution()
+                score = 0.0
+                for term_id in term_ids:
+                    if term_id in contributions:
+                        score += contributions[term_id]
+
+                if len(heap) < limit:
+                    heapq.heappush(heap, (score, -pivot_doc))
+                elif score > heap[0][0]:
+                    # Documents arrive in ascending order, so an equal score never displaces an earlier document
+                    heapq.heapreplace(heap, (score, -pivot_doc))
+                if len(heap) == limit:
+                    threshold = heap[0][0]
+
+                for cursor in list(cursors[:pivot + 1]):
+                    _advance(cursors, cursor, pivot_doc + 1)
+            else:
+                # Move the most valuable cursor that is still behind the pivot up to the pivot document
+                behind = [c for c in cursors[:pivot] if c.doc < pivot_doc]
+                _advance(cursors, max(behind, key=lambda c: c.max_score), pivot_doc)
+
+        return [(-neg_doc, score) for score, neg_doc in sorted(heap, key=lambda item: (-item[0], -item[1]))]
+
+
+def block_upper_bounds(scorer: BM25Scorer, term_id: int, idf: float, weight: int, k1: float, b: float) -> np.ndarray:
+    # Per-block bound of a term: best TF paired with the shortest document in the block, weighted by query term count
+    segment = scorer.segment
+    block_start, block_end = segment.block_offsets[term_id], segment.block_offsets[term_id + 1]
+    max_tfs = segment.block_max_tfs[block_start:block_end].astype(np.float64)
+    min_norms = k1 * (1 - b + b * (segment.block_min_lengths[block_start:block_end] / scorer.avg_doc_length))
+    return (max_tfs * (k1 + 1)) / (max_tfs + min_norms) * idf * weight * UPPER_BOUND_SLACK
+
+
+def _block_rows(blocks: np.ndarray, num_postings: int) -> np.ndarray:
+    # Indices into a term's postings of every posting in the given blocks
+    starts = blocks.astype(np.int64) * POSTINGS_BLOCK_SIZE
+    lengths = np.minimum(starts + POSTINGS_BLOCK_SIZE, num_postings) - starts
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(int(lengths.sum()))
+
+
+def _advance(cursors: list, cursor, target: int) -> None:
+    # Move a cursor to its first document >= target, dropping it once its postings are exhausted
+    cursor.advance_to(target)
+    if cursor.doc == EXHAUSTED:
+        cursors.remove(cursor)
+
+
+class _TermCursor:
+    """Position within one query term's postings list plus its score upper bounds"""
+
+    __slots__ = ("term_id", "docs", "tfs", "pos", "doc", "max_score", "block_last_docs", "block", "k1", "idf", "norms")
+
+    def __init__(self, scorer: BM25Scorer, term_id: int, idf: float, weight: int, k1: float, b: float, norms: np.ndarray):
+        segment = scorer.segment
+        start, end = segment.term_offsets[term_id], segment.term_offsets[term_id + 1]
+        block_start, block_end = segment.block_offsets[term_id], segment.block_offsets[term_id + 1]
+
+        self.term_id = term_id
+        self.docs = segment.postings_docs[start:end]
+        self.tfs = segment.postings_tfs[start:end]
+        self.pos = 0
+        self.doc = int(self.docs[0]) if len(self.docs) else EXHAUSTED
+        self.k1 = k1
+        self.idf = idf
+        self.norms = norms
+
+        block_scores = block_upper_bounds(scorer, term_id, idf, weight, k1, b)
+        self.max_score = float(block_scores.max()) if len(block_scores) else 0.0
+        # Block metadata is small (one entry per POSTINGS_BLOCK_SIZE postings), so a plain list keeps the hot loop cheap
+        self.block_last_docs = segment.block_last_docs[block_start:block_end].tolist()
+        self.block = 0
+
+    def advance_to(self, target: int) -> None:
+        if self.doc >= target:
+            return
+        # Skip whole blocks using the block metadata, then binary search inside the landing block
+        if self.block_last_docs[self.block] < target:
+            self.block = bisect.bisect_left(self.block_last_docs, target, lo=self.block)
+            if self.block == len(self.block_last_docs):
+                self.block -= 1
+                self.pos = len(self.docs)
+                self.doc = EXHAUSTED
+                return
+            self.pos = max(self.pos, self.block * POSTINGS_BLOCK_SIZE)
+        self.pos += int(np.searchsorted(self.docs[self.pos:(self.block + 1) * POSTINGS_BLOCK_SIZE], target))
+        self.doc = int(self.docs[self.pos]) if self.pos < len(self.docs) else EXHAUSTED
+
+    def contribution(self) -> float:
+        # Exact BM25 score of the current document; same arithmetic as BM25Scorer.term_scores
+        tf = np.float64(self.tfs[self.pos])
+        return float((tf * (self.k1 + 1)) / (tf + self.norms[self.doc]) * self.idf)
@@ -0,0 +1,153 @@
+import itertools
+import mmap
+import os
+import struct
+import tempfile
+from collections.abc import Sequence
+
+import numpy as np
+
+from .ann import file_fingerprint
+from .ingest import iter_movies
+from .search_utils import CACHE_PATH, INGEST_BATCH_SIZE, movies_source
+from .segment import map_sections, write_sections
+
+# On-disk docstore layout (little endian), same section scheme as the index segments:
+#   header   magic, format version, section count, num docs, fingerprint of the movies file it was built from
+#   sections one (offset, length) pair per entry of SECTIONS, followed by the 8-byte aligned section bodies
+# Rows are in movies file order, which is also the row order of the movie embeddings.
+DOCSTORE_MAGIC = b"RAGDOCS\x00"
+DOCSTORE_VERSION = 1
+HEADER = struct.Struct("<8sIIQ64s")
+SECTIONS = (
+    ("ids", np.int64),                      # Row -> document ID
+    ("id_rows", np.uint32),                 # Rows sorted by document ID, so an ID is found by binary search
+    ("title_offsets", np.uint64),           # Row -> byte offset of the title in `titles`
+    ("titles", np.uint8),                   # UTF-8 titles, one after another
+    ("description_offsets", np.uint64),
+    ("descriptions", np.uint8),
+)
+
+# Text fields stored as columns; every hydrated document also carries its "id"
+FIELDS = ("title", "description")
+
+
+def _load_spill(path: str, dtype) -> np.ndarray:
+    # np.memmap refuses empty files
+    return np.memmap(path, dtype=dtype, mode="r") if os.path.getsize(path) else np.empty(0, dtype=dtype)
+
+
+def write_docstore(movies, path: str, fingerprint: str = "") -> None:
+    # Build a docstore file from an iterable of movies without holding them: each batch of movies is appended
+    # to one spill file per column, then the sections are written from the memory-mapped spill files.
+    # Only the per-row ids and offsets (8 bytes each) are ever in memory.
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or ".", prefix=".docstore-") as spill_dir:
+        spill_path = lambda name: os.path.join(spill_dir, name)
+        columns = ["ids"] + [f"{field}_{part}" for field in FIELDS for part in ("lengths", "text")]
+        spills = {name: open(spill_path(name), "wb") for name in columns}
+        try:
+            for batch in itertools.batched(movies, INGEST_BATCH_SIZE):
+                spills["ids"].write(np.array([movie["id"] for movie in batch], dtype=np.int64).tobytes())
+                for field in FIELDS:
+                    encoded = [movie[field].encode("utf-8") for movie in batch]
+                    spills[f"{field}_lengths"].write(np.array([len(value) for value in encoded], dtype=np.uint64).tobytes())
+                    spills[f"{field}_text"].write(b"".join(encoded))
+        finally:
+            for spill in spills.values():
+                spill.close()
+
+        ids = np.fromfile(spill_path("ids"), dtype=np.int64)
+        arrays = {"ids": ids, "id_rows": np.argsort(ids, kind="stable").astype(np.uint32)}
+        for field in FIELDS:
+            offsets = np.zeros(len(ids) + 1, dtype=np.uint64)
+            np.cumsum(np.fromfile(spill_path(f"{field}_lengths"), dtype=np.uint64), out=offsets[1:])
+            arrays[f"{field}_offsets"], arrays[f"{field}s"] = offsets, _load_spill(spill_path(f"{field}_text"), np.uint8)
+
+        header = HEADER.pack(DOCSTORE_MAGIC, DOCSTORE_VERSION, len(SECTIONS), len(ids), fingerprint.encode("ascii"))
+        write_sections(path, header, [arrays[name] for name, _ in SECTIONS])
+
+
+class DocStore(Sequence):
+    """Read-only, memory-mapped movie documents stored column by column
+
+    Behaves like the list returned by load_movies(), but a document is only
+    decoded when it is accessed, and `get` / `by_id` can decode just the fields
+    a caller needs (e.g. the title of each top-k result).
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray], fingerprint: str = "", mm: mmap.mmap | None = None):
+        for name, _ in SECTIONS:
+            setattr(self, name, arrays[name])
+        self.fingerprint = fingerprint
+        self._mmap = mm
+
+
+    @classmethod
+    def open(cls, path: str) -> "DocStore":
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < HEADER.size:
+            raise ValueError(f"Docstore file is truncated: {path}")
+        magic, version, num_sections, _, fingerprint = HEADER.unpack_from(mm, 0)
+        if magic != DOCSTORE_MAGIC or version != DOCSTORE_VERSION or num_sections != len(SECTIONS):
+            raise ValueError(f"Unsupported docstore file: {path}")
+        return cls(map_sections(mm, SECTIONS, HEADER.size), fingerprint.rstrip(b"\x00").decode("ascii"), mm)
+
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, row) -> dict:
+        # Full document at a row, like load_movies()[row]
+        if not 0 <= row < len(self.ids):
+            raise IndexError(row)
+        return self.get(row)
+
+    def field(self, row: int, name: str) -> str:
+        offsets, blob = getattr(self, f"{name}_offsets"), getattr(self, f"{name}s")
+        return blob[offsets[row]:offsets[row + 1]].tobytes().decode("utf-8")
+
+    def get(self, row: int, fields=FIELDS) -> dict:
+        # Document at a row with only the requested fields decoded
+        doc = {"id": int(self.ids[row])}
+        for name in fields:
+            doc[name] = self.field(row, name)
+        return doc
+
+    def doc_id(self, row: int) -> int:
+        return int(self.ids[row])
+
+    def row_of(self, doc_id) -> int:
+        # Row holding a document ID, or -1
+        pos = int(np.searchsorted(self.ids, doc_id, sorter=self.id_rows))
+        if pos == len(self.ids) or self.ids[self.id_rows[pos]] != doc_id:
+            return -1
+        return int(self.id_rows[pos])
+
+    def by_id(self, doc_id, fields=FIELDS) -> dict:
+        row = self.row_of(doc_id)
+        if row < 0:
+            raise KeyError(doc_id)
+        return self.get(row, fields)
+
+
+def docstore_path() -> str:
+    return os.path.join(CACHE_PATH, "docstore.bin")
+
+
+def load_docstore(path: str | None = None, source: str | None = None) -> DocStore:
+    # Open the cached docstore, rebuilding it first if the movies file changed since it was built
+    path = path or docstore_path()
+    source = source or movies_source()
+    fingerprint = file_fingerprint(source)
+    if os.path.exists(path):
+        try:
+            store = DocStore.open(path)
+            if store.fingerprint == fingerprint:
+                return store
+        except ValueError:
+            pass    # Older or damaged file: rebuild it
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_docstore(iter_movies(source), path, fingerprint)
+    return DocStore.open(path)
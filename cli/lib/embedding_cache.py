@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from .search_utils import CACHE_PATH, QUERY_CACHE_SIZE, QUERY_DISK_CACHE_SIZE
+
+SQL_KEYS_PER_STATEMENT = 500    # Keys bound per IN (...) list, well below SQLite's bound-parameter limit (999 in older builds)
+EVICTION_HEADROOM = 0.1         # Eviction trims the disk tier this fraction below disk_size, so it runs once per that many inserts
+
+
+def normalize_query_text(text: str) -> str:
+    # Queries that only differ in Unicode form or whitespace share one cache entry
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class QueryEmbeddingCache:
+    """Two-tier cache of query embeddings keyed by (model name, normalized text)
+
+    The first tier is an in-process LRU of `memory_size` entries. The second is a
+    SQLite table in CACHE_PATH shared by every process, holding at most `disk_size`
+    entries; once it grows past that the least recently used rows are evicted,
+    down to EVICTION_HEADROOM below the limit so the sort only runs now and then.
+    """
+
+    def __init__(self, model_name: str, path: str = None, memory_size: int = QUERY_CACHE_SIZE, disk_size: int = QUERY_DISK_CACHE_SIZE):
+        self.model_name = model_name
+        self.path = path or os.path.join(CACHE_PATH, "query_embeddings.sqlite3")
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._connection = None     # Opened on first use, so commands that never embed a query never touch the file
+        self._lock = threading.RLock()  # One connection shared by every thread that searches
+        self._disk_rows = None      # Upper estimate of the rows on disk: counted on open, raised by every insert
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                " model TEXT NOT NULL, text TEXT NOT NULL, embedding BLOB NOT NULL, last_used INTEGER NOT NULL,"
+                " PRIMARY KEY (model, text))"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)")
+            self._connection.commit()
+            self._disk_rows = self._connection.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        return self._connection
+
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+
+    def get_many(self, texts: list[str]) -> list:
+        # Cached embedding (or None) for each text; disk hits are promoted into the memory tier
+        with self._lock:
+            return self._get_many(texts)
+
+
+    def _get_many(self, texts: list[str]) -> list:
+        keys = [normalize_query_text(text) for text in texts]
+        results = [None] * len(keys)
+        pending = {}
+        for i, key in enumerate(keys):
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                results[i] = self._memory[key]
+                self.memory_hits += 1
+            else:
+                pending.setdefault(key, []).append(i)
+
+        if pending:
+            db = self._db()
+            rows = []
+            for chunk in _chunks(list(pending)):
+                rows += db.execute(
+                    f"SELECT text, embedding FROM query_embeddings WHERE model = ? AND text IN ({','.join('?' * len(chunk))})",
+                    [self.model_name, *chunk],
+                ).fetchall()
+            for key, blob in rows:
+                embedding = np.frombuffer(blob, dtype=np.float32)
+                self._remember(key, embedding)
+                for i in pending.pop(key):
+                    results[i] = embedding
+                    self.disk_hits += 1
+            if rows:
+                now = time.time_ns()
+                for chunk in _chunks([key for key, _ in rows]):
+                    db.execute(
+                        f"UPDATE query_embeddings SET last_used = ? WHERE model = ? AND text IN ({','.join('?' * len(chunk))})",
+                        [now, self.model_name, *chunk],
+                    )
+                db.commit()
+
+        self.misses += sum(len(indices) for indices in pending.values())
+        return results
+
+
+    def put_many(self, texts: list[str], embeddings) -> None:
+        with self._lock:
+            self._put_many(texts, embeddings)
+
+
+    def _put_many(self, texts: list[str], embeddings) -> None:
+        now = time.time_ns()
+        entries = {}
+        for text, embedding in zip(texts, embeddings):
+            key = normalize_query_text(text)
+            embedding = np.asarray(embedding, dtype=np.float32)
+            self._remember(key, embedding)
+            entries[key] = embedding.tobytes()
+
+        db = self._db()
+        db.executemany(
+            "INSERT OR REPLACE INTO query_embeddings (model, text, embedding, last_used) VALUES (?, ?, ?, ?)",
+            [(self.model_name, key, blob, now) for key, blob in entries.items()],
+        )
+        # Size-bounded: once past disk_size, drop the least recently used rows down to the headroom.
+        # Replaced rows also raise the estimate, which at worst makes an eviction check come early
+        self._disk_rows += len(entries)
+        if self._disk_rows > self.disk_size:
+            keep = self.disk_size - int(self.disk_size * EVICTION_HEADROOM)
+            db.execute(
+                "DELETE FROM query_embeddings WHERE rowid IN ("
+                " SELECT rowid FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (keep,),
+            )
+            self._disk_rows = db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        db.commit()
+
+
+    def get_or_encode(self, texts: list[str], encode) -> np.ndarray:
+        # (len(texts) x dims) embeddings; only the texts missing from both tiers are passed to `encode`, in one call.
+        # Misses are encoded by their normalized key, so a cached vector is always what a fresh encode of its key
+        # gives, whichever variant of the text happened to miss first
+        keys = [normalize_query_text(text) for text in texts]
+        results = self.get_many(keys)
+        missing = list(dict.fromkeys(key for key, result in zip(keys, results) if result is None))
+        if missing:
+            encoded = dict(zip(missing, encode(missing)))
+            self.put_many(missing, encoded.values())
+            results = [result if result is not None else np.asarray(encoded[key], dtype=np.float32) for key, result in zip(keys, results)]
+        return np.stack(results)
+
+
+    def disk_entries(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._db().execute("DELETE FROM query_embeddings")
+            self._db().commit()
+            self._disk_rows = 0
+
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+
+def _chunks(keys: list) -> list[list]:
+    return [keys[start:start + SQL_KEYS_PER_STATEMENT] for start in range(0, len(keys), SQL_KEYS_PER_STATEMENT)]
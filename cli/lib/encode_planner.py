@@ -0,0 +1,79 @@
+import sys
+
+import numpy as np
+
+MODEL_BATCH_SIZE = 32   # Texts per forward pass inside SentenceTransformer.encode, the unit every text is padded within
+
+
+def text_length(text: str) -> int:
+    # Word count as a cheap stand-in for the token count, which would need the tokenizer in this process,
+    # so every padding figure below is an estimate
+    return len(text.split())
+
+
+def padded_positions(lengths: np.ndarray, batch: int = MODEL_BATCH_SIZE) -> int:
+    # Positions computed when `lengths` go through the model in consecutive batches, each padded to its longest text
+    return sum(int(lengths[start:start + batch].max()) * len(lengths[start:start + batch]) for start in range(0, len(lengths), batch))
+
+
+def call_padded_positions(lengths: np.ndarray, call_size: int) -> int:
+    # Positions computed when `lengths` are passed to the model call_size at a time: SentenceTransformer.encode
+    # already sorts the texts of each call by length before cutting them into batches
+    return sum(padded_positions(np.sort(lengths[start:start + call_size])[::-1]) for start in range(0, len(lengths), call_size))
+
+
+class EncodePlanner:
+    """Encodes groups of unique texts longest first, in batches of similar length
+
+    Texts arrive in corpus order, where short and long chunks alternate and every
+    forward pass is padded to its longest text. The model only sorts within one
+    encode call, so the planner sorts the whole group by length, encodes it
+    batch_size texts at a time and scatters the vectors back to the group's order.
+    It also keeps the numbers behind `report`: the estimated padding of passing the
+    texts to the model batch_size at a time in corpus order (each call still sorted
+    by the model) versus the planned order, and how many repeated texts the caller
+    skipped.
+    """
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.texts = 0              # Texts encoded
+        self.duplicates = 0         # Repeated texts that were not encoded again (see add_duplicates)
+        self.tokens = 0             # Estimated tokens in the encoded texts
+        self.padded_corpus = 0      # Estimated positions computed if the texts were passed to the model in corpus order
+        self.padded_planned = 0     # Estimated positions computed in the planned order
+
+
+    def encode(self, texts: list[str], encode) -> np.ndarray:
+        lengths = np.fromiter((text_length(text) for text in texts), dtype=np.int64, count=len(texts))
+        order = np.argsort(-lengths, kind="stable")
+        self.texts += len(texts)
+        self.tokens += int(lengths.sum())
+        self.padded_corpus += call_padded_positions(lengths, self.batch_size)
+        self.padded_planned += call_padded_positions(lengths[order], self.batch_size)
+
+        vectors = None
+        for start in range(0, len(order), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            encoded = np.asarray(encode([texts[i] for i in rows]), dtype=np.float32)
+            if vectors is None:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[rows] = encoded
+        return vectors
+
+
+    def add_duplicates(self, count: int) -> None:
+        self.duplicates += count
+
+
+    def padding_ratio(self, planned: bool = True) -> float:
+        padded = self.padded_planned if planned else self.padded_corpus
+        return 1 - self.tokens / padded if padded else 0.0
+
+
+    def report(self, out=None) -> None:
+        offered = self.texts + self.duplicates
+        saved = self.duplicates / offered if offered else 0.0
+        print(f"Encode plan: {self.texts} unique texts encoded, {self.duplicates} duplicates skipped ({saved:.1%}); "
+              f"estimated padding {self.padding_ratio(planned=False):.1%} in corpus order -> {self.padding_ratio():.1%} length-sorted (from word counts, not tokens)",
+              file=out or sys.stderr, flush=True)
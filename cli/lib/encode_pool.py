@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Model of the current worker process, loaded once by _init_worker
+_worker_model = None
+
+
+def _init_worker(model_name, cpu_sets, threads):
+    # Runs once in every worker: pin the process to its own CPUs, size torch's intra-op pool to match, load the model
+    global _worker_model
+    cpus = cpu_sets.get()
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    import torch
+    torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name)
+
+
+def _encode(texts):
+    return np.asarray(_worker_model.encode(texts), dtype=np.float32)
+
+
+class EncodePool:
+    """Worker processes that each hold a copy of the model and encode slices of every batch in parallel
+
+    A single encode call leaves most cores of a large machine idle, so the texts of each batch are dealt
+    to the workers round-robin and their vectors scattered back to input order. Batches arrive sorted by
+    length (see EncodePlanner), so dealing gives every worker the same mix of long and short texts where
+    contiguous slices would leave one worker with all the long ones. Every
+    worker gets `threads_per_worker` intra-op threads (default: the available CPUs split evenly) and,
+    where the OS allows it, is pinned to its own CPUs so the workers do not compete for cores.
+    """
+
+    def __init__(self, model_name, workers, threads_per_worker=None):
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        self.workers = workers
+        self.threads = threads_per_worker or max(1, len(cpus) // workers)
+
+        # Workers are spawned, not forked, so no torch state is inherited from the parent
+        context = multiprocessing.get_context("spawn")
+        cpu_sets = context.Queue()
+        for i in range(workers):
+            # No pinning when there are fewer CPUs than workers * threads
+            cpu_sets.put(cpus[i * self.threads:(i + 1) * self.threads] if len(cpus) >= workers * self.threads else None)
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(model_name, cpu_sets, self.threads))
+
+
+    def encode(self, texts) -> np.ndarray:
+        texts = list(texts)
+        hands = [texts[i::self.workers] for i in range(min(self.workers, len(texts)))]
+        if not hands:
+            return np.empty((0, 0), dtype=np.float32)
+        # map returns the results in submission order whichever worker finishes first; worker i got texts i, i + workers, ...
+        results = list(self.pool.map(_encode, hands))
+        vectors = np.empty((len(texts), results[0].shape[1]), dtype=np.float32)
+        for i, encoded in enumerate(results):
+            vectors[i::self.workers] = encoded
+        return vectors
+
+
+    def warm_up(self) -> None:
+        # Load the model in every worker now, so the first real batch is not slowed down by it
+        list(self.pool.map(_encode, [["warm up"]] * self.workers))
+
+
+    def close(self) -> None:
+        self.pool.shutdown()
@@ -0,0 +1,54 @@
+from .hybrid_search import HybridSearch
+from .index import InvertedIndex
+from .keyword_search import get_tokenizer
+from .semantic_search import SemanticSearch, ChunkedSemanticSearch
+from .search_client import query_server
+from .docstore import load_docstore
+
+
+def cmd_hybrid_search(query, limit, method, alpha, rrf_k, chunks, timing, server=None):
+    if server:
+        #A running search server already has the index, model and embeddings loaded
+        results = query_server(server, "hybrid_search", query, limit=limit, method=method, alpha=alpha, rrf_k=rrf_k, chunks=chunks)
+        _print_results(query, method, results)
+        return 0
+
+    docs = load_docstore()
+    #Load the keyword index first, so a missing index is reported before any model load or corpus encode
+    index = InvertedIndex(docs)
+    try:
+        index.load()
+    except FileNotFoundError:
+        print("Index not found, run build first")
+        return 1
+
+    if chunks:
+        semantic = ChunkedSemanticSearch()
+        semantic.load_or_create_chunk_embeddings(docs)
+    else:
+        semantic = SemanticSearch()
+        semantic.load_or_create_embeddings(docs)
+
+    hs = HybridSearch(docs, semantic, index)
+    get_tokenizer()     #Import nltk up front, so the keyword timing measures the query and not the import
+    results = hs.search(query, limit, method, alpha, rrf_k, chunks)
+    hs.close()
+    _print_results(query, method, results)
+
+    if timing:
+        t = hs.last_timings
+        print()
+        print(f"keyword {t['keyword']:.1f} ms, semantic {t['semantic']:.1f} ms, hybrid total {t['total']:.1f} ms")
+    return 0
+
+
+def _print_results(query, method, results):
+    print(f"Query: {query}")
+    print(f"Top {len(results)} results ({method} fusion):")
+    print()
+
+    for i, res in enumerate(results, 1):
+        meta = res["metadata"]
+        print(f"{i}. {res['title']} (score: {res['score']:.4f})")
+        print(f"   keyword rank: {meta['keyword_rank'] or '-'}, semantic rank: {meta['semantic_rank'] or '-'}")
+        print(f"   {res['document'][:100]}...")
@@ -0,0 +1,134 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .docstore import DocStore
+from .index import InvertedIndex
+from .semantic_search import normalize_rows
+from .search_utils import format_search_result, top_k_from_dict, DEFAULT_SEARCH_LIMIT, DEFAULT_RRF_K, DEFAULT_HYBRID_ALPHA, HYBRID_CANDIDATE_MULTIPLIER, DOCUMENT_PREVIEW_LENGTH
+
+# Ways of fusing the keyword and semantic rankings
+FUSION_METHODS = ("rrf", "weighted")
+
+
+def rrf_fuse(rankings: list[list], k: int = DEFAULT_RRF_K) -> dict:
+    # Reciprocal rank fusion: every list adds 1 / (k + rank) for each document it contains (rank starts at 1)
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, 1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (k + rank)
+    return fused
+
+
+def min_max_normalize(scores: list[float]) -> list[float]:
+    # Rescale to [0, 1]; if every score is the same they all map to 1
+    if not scores:
+        return []
+    low, high = min(scores), max(scores)
+    if high == low:
+        return [1.0] * len(scores)
+    return [(score - low) / (high - low) for score in scores]
+
+
+def weighted_fuse(keyword_hits: list, semantic_hits: list, alpha: float = DEFAULT_HYBRID_ALPHA) -> dict:
+    # alpha * normalized keyword score + (1 - alpha) * normalized semantic score; a retriever that
+    # did not return a document contributes 0 for it
+    fused = {}
+    for weight, hits in ((alpha, keyword_hits), (1 - alpha, semantic_hits)):
+        for (doc_id, _), score in zip(hits, min_max_normalize([score for _, score in hits])):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return fused
+
+
+class HybridSearch:
+    """BM25 and semantic retrieval run side by side and fused into one ranking
+
+    The two retrievers run concurrently on a small thread pool; BM25 scoring and
+    the embedding matrix products spend most of their time in NumPy / the model,
+    outside the GIL, so a query costs about as much as the slower retriever.
+    """
+
+    def __init__(self, documents: DocStore, semantic=None, index: InvertedIndex | None = None):
+        self.documents = documents  # Same row order as the semantic searcher's embeddings
+        # SemanticSearch with movie embeddings loaded, or ChunkedSemanticSearch with chunk (and optionally movie) embeddings
+        self.semantic = semantic
+        if index is None:
+            index = InvertedIndex(documents)
+            index.load()
+        self.index = index
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hybrid")
+        self.last_timings = {}      # Milliseconds spent per retriever and in total by the last query
+
+
+    def keyword_hits(self, query: str, depth: int) -> list[tuple[int, float]]:
+        return [(res["doc_id"], res["score"]) for res in self.index.bm25_search(query, depth)]
+
+
+    def semantic_hits(self, query: str, depth: int, chunks: bool = False) -> list[tuple[int, float]]:
+        if chunks:
+            return [(res["id"], res["score"]) for res in self.semantic.search_chunks(query, depth)]
+        query_embedding = normalize_rows(self.semantic.generate_embedding(query)[np.newaxis, :])
+        ids, scores = self.semantic.nearest_rows(query_embedding, depth)[0]
+        return [(self.documents.doc_id(i), float(score)) for i, score in zip(ids, scores)]
+
+
+    def _timed(self, name: str, retriever, *args):
+        start = time.perf_counter()
+        hits = retriever(*args)
+        self.last_timings[name] = (time.perf_counter() - start) * 1000
+        return hits
+
+
+    def retrieve(self, query: str, depth: int, chunks: bool = False) -> tuple[list, list]:
+        # (keyword hits, semantic hits), each the top `depth` (doc ID, score) pairs, fetched concurrently
+        self.last_timings = {}
+        start = time.perf_counter()
+        keyword = self.pool.submit(self._timed, "keyword", self.keyword_hits, query, depth)
+        semantic = self.pool.submit(self._timed, "semantic", self.semantic_hits, query, depth, chunks)
+        hits = keyword.result(), semantic.result()
+        self.last_timings["total"] = (time.perf_counter() - start) * 1000
+        return hits
+
+
+    def search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT, method: str = "rrf", alpha: float = DEFAULT_HYBRID_ALPHA, rrf_k: int = DEFAULT_RRF_K, chunks: bool = False) -> list[dict]:
+        # chunks=True ranks the semantic side by chunk embeddings (search_chunks) instead of movie embeddings
+        if method not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method: {method} (expected one of {', '.join(FUSION_METHODS)})")
+
+        # Documents ranked below limit * HYBRID_CANDIDATE_MULTIPLIER by both retrievers are too far down to make the fused top `limit`
+        keyword_hits, semantic_hits = self.retrieve(query, limit * HYBRID_CANDIDATE_MULTIPLIER, chunks)
+        if method == "rrf":
+            fused = rrf_fuse([[doc_id for doc_id, _ in keyword_hits], [doc_id for doc_id, _ in semantic_hits]], rrf_k)
+        else:
+            fused = weighted_fuse(keyword_hits, semantic_hits, alpha)
+
+        keyword_ranks = {doc_id: (rank, score) for rank, (doc_id, score) in enumerate(keyword_hits, 1)}
+        semantic_ranks = {doc_id: (rank, score) for rank, (doc_id, score) in enumerate(semantic_hits, 1)}
+
+        results = []
+        for doc_id, score in top_k_from_dict(fused, limit):
+            # Only the fused top `limit` documents are decoded
+            row = self.documents.row_of(doc_id)
+            if row < 0:
+                continue    # Still in a stale keyword index but no longer in the movies file
+            doc = self.documents.get(row)
+            keyword_rank, keyword_score = keyword_ranks.get(doc_id, (None, None))
+            semantic_rank, semantic_score = semantic_ranks.get(doc_id, (None, None))
+            results.append(
+                format_search_result(
+                    doc_id=doc_id,
+                    title=doc["title"],
+                    document=doc["description"][:DOCUMENT_PREVIEW_LENGTH],
+                    score=score,
+                    keyword_rank=keyword_rank,
+                    keyword_score=keyword_score,
+                    semantic_rank=semantic_rank,
+                    semantic_score=semantic_score,
+                )
+            )
+        return results
+
+
+    def close(self) -> None:
+        self.pool.shutdown()
@@ -1,148 +1,315 @@
+import itertools
+import json
 import math
 import os
-import pickle
-from collections import defaultdict, Counter
-from .keyword_search import tokenize_text
-from .search_utils import load_movies, CACHE_PATH, BM25_K1, BM25_B
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, deque
+from collections.abc import Mapping
+
+import numpy as np
+
+from .keyword_search import tokenize_text, get_tokenizer
+from .docstore import DocStore, load_docstore
+from .search_utils import CACHE_PATH, BM25_K1, BM25_B, MAX_INDEX_SEGMENTS, INGEST_BATCH_SIZE
+from .segment import Segment, document_hash, merge_segments
+from .bm25 import BM25Scorer, CollectionStats, EXHAUSTIVE
+
+INDEX_FORMAT_VERSION = 1
 
 
 class InvertedIndex:
-    def __init__(self):                
-        self.index = defaultdict(set)   # Dictionary that maps tokens (strings) to sets of document IDs (integers)
-        self.doc_lengths = {}           # Dictionary that tracks the length of each document
-        self.docmap = {}                # Dictionary that maps document IDs (int) to their full document object
-        self.term_frequencies = {}      # Dictionary of document IDs to Counter objects
+    """BM25 index made of immutable segments plus per-segment tombstones
+
+    `build` writes a single segment. `add_documents` / `delete_documents` (and
+    `update`, which diffs against movies.json) never rewrite existing segments:
+    new and changed documents go into a fresh segment and the old versions are
+    marked deleted in their segment's tombstone bitmap. `merge` compacts all
+    segments back into one. Queries run over every segment using statistics of
+    the live documents of the whole index. Segments only keep a content hash of
+    each document; titles and descriptions are read from the docstore.
+    """
+
+    def __init__(self, documents: DocStore | None = None):
+        self._documents = documents  # Docstore the results are hydrated from, opened on first use if not given
+        self.segments = []          # Immutable segments, oldest first (see segment.py for the layout)
+        self.deleted = []           # Per segment: boolean tombstone mask over its doc numbers, or None if nothing is deleted
+        self.segment_files = []     # Per segment: file name in index_dir, None until saved
+        self.tombstone_files = []   # Per segment: tombstone file name, None if not saved (or nothing deleted)
+        self.next_segment = 0       # Counter used to name new segment files
+        self.generation = 0         # Incremented on every save
         # File paths
-        self.index_path = os.path.join(CACHE_PATH, "index.pkl")
-        self.docmap_path = os.path.join(CACHE_PATH, "docmap.pkl")
-        self.termfreq_path = os.path.join(CACHE_PATH, "term_frequencies.pkl")
-        self.doc_lengths_path = os.path.join(CACHE_PATH, "doc_lengths.pkl")
-
-
-
-    def __add_document(self, doc_id, text):
-        # Tokenise the input text
-        tokens = tokenize_text(text)
-        
-        # Make sure this doc_id has a Counter
-        if doc_id not in self.term_frequencies:
-            self.term_frequencies[doc_id] = Counter()
-        
-        for token in tokens:
-            # Add each token to the index with the document ID
-            self.index[token].add(doc_id)
-            # Increment the frequency counter for the term observed, in the specific document
-            # The Counter wrapper handles instantiating at 0 and has some methods that might be helpful too            
-            self.term_frequencies[doc_id][token] += 1       # Increment count
-        
-        # Store the number of tokens in this document
-        self.doc_lengths[doc_id] = sum(self.term_frequencies[doc_id].values()) #self.tokens_in_doc(doc_id)
+        self.index_dir = os.path.join(CACHE_PATH, "index")
+        self.index_path = os.path.join(self.index_dir, "segments.json")     # Manifest listing the live segment and tombstone files
+        self._refresh()
+
+
+    def _refresh(self):
+        # Recompute global statistics, per-segment scorers and the doc ID lookup after segments or tombstones change
+        self.stats = CollectionStats(self.segments, self.deleted)
+        self.scorers = [BM25Scorer(segment, self.stats, dead) for segment, dead in zip(self.segments, self.deleted)]
+
+        ids, owners, numbers = [], [], []
+        for i, (segment, dead) in enumerate(zip(self.segments, self.deleted)):
+            rows = np.arange(segment.num_documents()) if dead is None else np.flatnonzero(~dead)
+            ids.append(segment.doc_ids[rows].astype(np.int64))
+            owners.append(np.full(len(rows), i, dtype=np.int32))
+            numbers.append(rows)
+        # Live document IDs (ascending) and the segment / doc number holding each one
+        if len(ids) == 1:
+            # A single segment is already sorted by document ID
+            self.doc_ids, self._doc_segments, self._doc_numbers = ids[0], owners[0], numbers[0]
+        else:
+            ids = np.concatenate(ids + [np.empty(0, dtype=np.int64)])
+            order = np.argsort(ids, kind="stable")
+            self.doc_ids = ids[order]
+            self._doc_segments = np.concatenate(owners + [np.empty(0, dtype=np.int32)])[order]
+            self._doc_numbers = np.concatenate(numbers + [np.empty(0, dtype=np.int64)])[order]
+        self.docmap = LiveDocMap(self)
+
+
+    @property
+    def documents(self) -> DocStore:
+        if self._documents is None:
+            self._documents = load_docstore()
+        return self._documents
+
+
+    @property
+    def doc_lengths(self):
+        # Number of tokens of each live document, aligned with doc_ids
+        return np.array([self.segments[s].doc_lengths[n] for s, n in zip(self._doc_segments.tolist(), self._doc_numbers.tolist())], dtype=np.int64)
+
+
+    def locate(self, doc_id) -> tuple[int, int]:
+        # (segment index, doc number) of the live version of a document; KeyError if it is not indexed
+        pos = int(np.searchsorted(self.doc_ids, doc_id))
+        if pos == len(self.doc_ids) or self.doc_ids[pos] != doc_id:
+            raise KeyError(doc_id)
+        return int(self._doc_segments[pos]), int(self._doc_numbers[pos])
+
 
     def __get_avg_doc_length(self) -> float:
-        if len(self.doc_lengths) == 0:
-            return 0.0
-        return sum(self.doc_lengths.values()) / len(self.doc_lengths)
-    
-    
-    def build(self):
-        # Iterate over all of the movies and add them to both the index and the docmap            
-        # Load movie data
-        movies = load_movies()
-
-        # Iterate over all movies and add them to the index and docmap
-        for m in movies:
-            doc_id = m["id"]
-            # When adding the movie data to the index with __add_document(), concatenate the title and the description and use that as the input text
-            text = f"{m['title']} {m['description']}"
-            self.docmap[doc_id] = m
-            self.__add_document(doc_id, text)
+        return self.stats.avg_doc_length
+
+
+    def build(self, workers=1):
+        # Full rebuild: every movie goes into one fresh segment, replacing all existing segments
+        os.makedirs(self.index_dir, exist_ok=True)
+        name = self._new_segment_file()
+        self.segments = [build_segment_streaming(self.documents, os.path.join(self.index_dir, name), workers)]
+        self.deleted = [None]
+        self.segment_files = [name]
+        self.tombstone_files = [None]
+        self._refresh()
+
+
+    def add_documents(self, movies) -> None:
+        # Index new or changed documents in a fresh segment; older versions of the same IDs are tombstoned
+        movies = list(movies)
+        if not movies:
+            return
+        self._tombstone([m["id"] for m in movies])
+        self.segments.append(build_segment(movies))
+        self.deleted.append(None)
+        self.segment_files.append(None)
+        self.tombstone_files.append(None)
+        self._refresh()
+
+
+    def delete_documents(self, doc_ids) -> int:
+        # Tombstone the live versions of the given documents; returns how many were found
+        deleted = self._tombstone(doc_ids)
+        self._refresh()
+        return deleted
+
+
+    def _tombstone(self, doc_ids) -> int:
+        count = 0
+        for doc_id in doc_ids:
+            try:
+                seg, doc_num = self.locate(doc_id)
+            except KeyError:
+                continue
+            if self.deleted[seg] is None:
+                self.deleted[seg] = np.zeros(self.segments[seg].num_documents(), dtype=bool)
+            elif not self.deleted[seg].flags.writeable:
+                self.deleted[seg] = self.deleted[seg].copy()
+            self.deleted[seg][doc_num] = True
+            self.tombstone_files[seg] = None    # Needs a new tombstone file on the next save
+            count += 1
+        return count
+
+
+    def update(self, movies=None, workers=1) -> dict:
+        # Bring the index in line with movies.json, only indexing documents that are new or changed.
+        # The movies are streamed: each batch is looked up against the live doc IDs with one searchsorted,
+        # and new or changed movies flow straight into build_segment_streaming, so no whole-corpus dict is built.
+        movies = self.documents if movies is None else movies
+        seen = array("q")       # IDs of every movie in the input
+        changed = array("q")    # IDs of the movies indexed into the new segment
+        counts = {"added": 0}
+
+        def changed_movies():
+            for batch in itertools.batched(movies, INGEST_BATCH_SIZE):
+                ids = np.fromiter((m["id"] for m in batch), dtype=np.int64, count=len(batch))
+                seen.extend(ids.tolist())
+                pos = np.searchsorted(self.doc_ids, ids)
+                found = pos < len(self.doc_ids)
+                found[found] = self.doc_ids[pos[found]] == ids[found]
+                for movie, p, is_found in zip(batch, pos.tolist(), found.tolist()):
+                    if not is_found:
+                        counts["added"] += 1
+                    # Segments keep a hash of the JSON of each movie, so any edit changes it
+                    elif int(self.segments[self._doc_segments[p]].doc_hashes[self._doc_numbers[p]]) == document_hash(movie):
+                        continue
+                    changed.append(movie["id"])
+                    yield movie
+
+        stream = changed_movies()
+        first = next(stream, None)
+        segment = None
+        if first is not None:
+            os.makedirs(self.index_dir, exist_ok=True)
+            name = self._new_segment_file()
+            segment = build_segment_streaming(itertools.chain([first], stream), os.path.join(self.index_dir, name), workers)
+
+        # Old versions of changed movies and movies no longer in the input are tombstoned before the new segment joins
+        removed = self.doc_ids[~np.isin(self.doc_ids, np.frombuffer(seen, dtype=np.int64))]
+        self._tombstone(changed)
+        self._tombstone(removed.tolist())
+        if segment is not None:
+            self.segments.append(segment)
+            self.deleted.append(None)
+            self.segment_files.append(name)
+            self.tombstone_files.append(None)
+        self._refresh()
+
+        merged = len(self.segments) > MAX_INDEX_SEGMENTS
+        if merged:
+            self.merge()
+        return {"added": counts["added"], "updated": len(changed) - counts["added"], "deleted": len(removed), "merged": merged}
+
+
+    def merge(self) -> None:
+        # Compact every segment into one, dropping tombstoned documents
+        if len(self.segments) == 1 and self.deleted[0] is None:
+            return
+        # The merged segment is written straight to a new file; the manifest only lists it after `save`
+        os.makedirs(self.index_dir, exist_ok=True)
+        name = self._new_segment_file()
+        self.segments = [merge_segments(self.segments, self.deleted, os.path.join(self.index_dir, name))]
+        self.deleted = [None]
+        self.segment_files = [name]
+        self.tombstone_files = [None]
+        self._refresh()
+
+
+    def _new_segment_file(self) -> str:
+        # Next unused segment file name; files on disk are skipped so a live segment is never overwritten
+        while True:
+            name = f"_{self.next_segment}.seg"
+            self.next_segment += 1
+            if not os.path.exists(os.path.join(self.index_dir, name)):
+                return name
 
 
     def load(self):
-        # Load the various elements from disk using pickle
-        
-        # Raise an error if the files don't exist
+        # Memory-map every segment listed in the manifest; nothing beyond the headers is read until a query touches it
+
+        # Raise an error if the file doesn't exist
         if not os.path.exists(self.index_path):
             raise FileNotFoundError(f"Index file not found: {self.index_path}")
 
-        if not os.path.exists(self.docmap_path):
-            raise FileNotFoundError(f"Docmap file not found: {self.docmap_path}")
-        
-        if not os.path.exists(self.termfreq_path):
-            raise FileNotFoundError(f"Term frequencies file not found: {self.termfreq_path}")
-        
-        if not os.path.exists(self.doc_lengths_path):
-            raise FileNotFoundError(f"Term frequencies file not found: {self.doc_lengths_path}")
-
-        # Load index
-        with open(self.index_path, "rb") as f:
-            self.index = pickle.load(f)
-
-        # Load docmap
-        with open(self.docmap_path, "rb") as f:
-            self.docmap = pickle.load(f)
-
-        # Load term frequencies
-        with open(self.termfreq_path, "rb") as f:
-            self.term_frequencies = pickle.load(f)
-
-        # Load document lengths
-        with open(self.doc_lengths_path, "rb") as f:
-            self.doc_lengths = pickle.load(f)
-        
-    
+        with open(self.index_path, "r") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported index manifest version in {self.index_path}, run build again")
+
+        self.segments, self.deleted, self.segment_files, self.tombstone_files = [], [], [], []
+        for entry in manifest["segments"]:
+            segment = Segment.open(os.path.join(self.index_dir, entry["file"]))
+            dead = None
+            if entry["tombstones"]:
+                bits = np.load(os.path.join(self.index_dir, entry["tombstones"]))
+                dead = np.unpackbits(bits, count=segment.num_documents()).astype(bool)
+                dead.flags.writeable = False    # Copied before the first new deletion
+            self.segments.append(segment)
+            self.deleted.append(dead)
+            self.segment_files.append(entry["file"])
+            self.tombstone_files.append(entry["tombstones"])
+        self.next_segment = manifest["next_segment"]
+        self.generation = manifest["generation"]
+        self._refresh()
 
 
     def save(self):
-        # Save the various elements to disk using the pickle modules dump function
+        # Write new segments and tombstones, then atomically swap in a manifest that lists them.
+        # Existing files are never modified, so a reader always sees a complete index.
         # Create the cache directory if it doesn't exist
-        os.makedirs(CACHE_PATH, exist_ok=True)
-
-        # Save index
-        with open(self.index_path, "wb") as f:
-            pickle.dump(self.index, f)
-
-        # Save docmap
-        with open(self.docmap_path, "wb") as f:
-            pickle.dump(self.docmap, f)        
-
-        # Save term frequencies
-        with open(self.termfreq_path, "wb") as f:
-            pickle.dump(self.term_frequencies, f)        
-
-        # Save document lengths
-        with open(self.doc_lengths_path, "wb") as f:
-            pickle.dump(self.doc_lengths, f)        
-
-
-
-    def bm25(self, doc_id, term):
-        bm25_tf = self.get_bm25_tf(doc_id, term)
+        os.makedirs(self.index_dir, exist_ok=True)
+        self.generation += 1
+
+        for i, segment in enumerate(self.segments):
+            if self.segment_files[i] is None:
+                self.segment_files[i] = self._new_segment_file()
+                segment.write(os.path.join(self.index_dir, self.segment_files[i]))
+            if self.tombstone_files[i] is None and self.deleted[i] is not None:
+                self.tombstone_files[i] = f"{os.path.splitext(self.segment_files[i])[0]}_{self.generation}.del.npy"
+                np.save(os.path.join(self.index_dir, self.tombstone_files[i]), np.packbits(self.deleted[i]))
+
+        manifest = {
+            "version": INDEX_FORMAT_VERSION,
+            "generation": self.generation,
+            "next_segment": self.next_segment,
+            "segments": [{"file": f, "tombstones": t} for f, t in zip(self.segment_files, self.tombstone_files)],
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.index_dir, prefix=".tmp-", suffix=".json")
+        os.fchmod(fd, 0o644)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        # Remove segment and tombstone files the new manifest no longer references
+        referenced = set(self.segment_files) | {t for t in self.tombstone_files if t}
+        for name in os.listdir(self.index_dir):
+            if name.startswith("_") and name not in referenced:
+                os.remove(os.path.join(self.index_dir, name))
+
+
+
+    def bm25(self, doc_id, term, k1=BM25_K1, b=BM25_B):
+        bm25_tf = self.get_bm25_tf(doc_id, term, k1, b)
         bm25_idf = self.get_bm25_idf(term)
         return bm25_tf * bm25_idf
 
 
 
-    def bm25_search(self, query, limit):
+    def bm25_search(self, query, limit, k1=BM25_K1, b=BM25_B, strategy=EXHAUSTIVE):
+        # strategy selects exhaustive scoring, Block-Max pruning or the reference WAND (see bm25.py); results are identical
+        # Stemmed exactly once; the scorers take these stems as they are, since stemming a stem again
+        # can change it ("hous" -> "hou") and miss its postings
         queries = tokenize_text(query)
-        
-        scores = {}
-
-        for token in queries:
-            for doc_id in self.index[token]:
-                doc_bm25 = self.bm25(doc_id, token)
-                # Make sure this doc_id exists in the dictionary
-                if doc_id not in scores:
-                    scores[doc_id] = 0
-                scores[doc_id] += doc_bm25
-
-        sorted_top5_scores = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
-        
+
+        # Top `limit` of every segment (scored with index-wide statistics), merged; ties go to the lower doc ID
+        hits = []
+        for segment, scorer in zip(self.segments, self.scorers):
+            hits.extend((score, int(segment.doc_ids[doc_num])) for doc_num, score in scorer.search(queries, limit, k1, b, strategy))
+        hits.sort(key=lambda hit: (-hit[0], hit[1]))
+
         return_data = []
-        for doc_id, score in sorted_top5_scores:
+        for score, doc_id in hits[:limit]:
+            doc = self.docmap.get(doc_id)   # None if the movie left the movies file since the last `index`
             return_data.append({
                 "doc_id": doc_id,
-                "title": self.docmap[doc_id]["title"],
+                "title": doc["title"] if doc else "",
                 "score": score
             })
 
@@ -151,25 +318,19 @@ class InvertedIndex:
 
 
     def get_bm25_idf(self, term: str) -> float:
-        tokens = tokenize_text(term)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        num_docs_with_term = len(self.index[token]) 
-        num_docs_without_term = len(self.docmap) - num_docs_with_term
-        bm25_idf = math.log((num_docs_without_term + 0.5) / (num_docs_with_term + 0.5) + 1)  # 0.5 and 1 are for edge cases and smoothing
-        return bm25_idf
-    
+        # Unseen terms get the same smoothing formula with a document frequency of 0
+        return self.stats.idf(self.__single_token(term))
+
     def get_bm25_tf(self, doc_id, term, k1=BM25_K1, b=BM25_B):
         tf = self.get_tf(doc_id, term)
+        return self.__bm25_tf_value(tf, self.get_doc_length(doc_id), self.__get_avg_doc_length(), k1, b)
+
+    def __bm25_tf_value(self, tf, doc_len, avg_len, k1=BM25_K1, b=BM25_B):
         if tf == 0:         #Guard againt TF = 0
             return 0.0
-        
-        avg_len = self.__get_avg_doc_length()
+
         if avg_len == 0:
             return 0.0      # empty index / no lengths
-        
-        doc_len = self.get_doc_length(doc_id)
 
         # Length normalization factor
         length_norm = 1 - b + b * (doc_len / avg_len)
@@ -177,69 +338,165 @@ class InvertedIndex:
         normalised_tf = (tf * (k1 + 1)) / (tf + k1 * length_norm)
         #bm25tf = (tf * (k1+1))/ (tf + k1)  # Formula without length normalisation
         return normalised_tf
-        
 
-    def get_doc_length(self, doc_id: int) -> int:        
-        return self.doc_lengths[doc_id]
-    
+
+    def get_doc_length(self, doc_id: int) -> int:
+        seg, doc_num = self.locate(doc_id)
+        return int(self.segments[seg].doc_lengths[doc_num])
+
     def get_documents(self, token: str):
-        # Get the set of document ID's for a given token (set it to lowercase)
+        # Get the document ID's for a given token (set it to lowercase)
         # Return them as a list, sorted in ascending order
         token = token.lower()
-        return sorted(self.index.get(token, set()))
-    
+        found = []
+        for segment, doc_nums, _ in self.__live_postings(token):
+            found.append(segment.doc_ids[doc_nums])
+        if len(found) == 1:
+            return found[0].tolist()    # Postings of one segment are already sorted
+        return sorted(np.concatenate(found + [np.empty(0, dtype=np.int64)]).tolist())
+
     def get_idf(self, term: str) -> float:
-        tokens = tokenize_text(term)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        doc_count = len(self.docmap)
-        num_docs_with_term = len(self.index[token])
+        token = self.__single_token(term)
+        doc_count = self.num_documents()
+        num_docs_with_term = self.num_documents_with_token(token)
         return math.log((doc_count + 1) / (num_docs_with_term + 1))
 
     def get_tf(self, doc_id: int, term: str) -> int:
-        tokens = tokenize_text(term)
-        if len(tokens) != 1:
-            raise ValueError("term must be a single token")
-        token = tokens[0]
-        return self.term_frequencies[doc_id][token]
-    
+        token = self.__single_token(term)
+        seg, doc_num = self.locate(doc_id)
+        doc_nums, tfs = self.segments[seg].postings(token)
+        # Binary search the sorted postings list for this document
+        pos = int(np.searchsorted(doc_nums, doc_num))
+        if pos < len(doc_nums) and doc_nums[pos] == doc_num:
+            return int(tfs[pos])
+        return 0
+
     def get_tf_idf(self, doc_id: int, term: str) -> float:
         tf = self.get_tf(doc_id, term)
         idf = self.get_idf(term)
         return tf * idf
-    
-    
-    
+
+
+    def __single_token(self, term: str) -> str:
+        tokens = tokenize_text(term)
+        if len(tokens) != 1:
+            raise ValueError("term must be a single token")
+        return tokens[0]
+
+    def __live_postings(self, token: str):
+        # (segment, doc numbers, term frequencies) for a token in every segment, tombstoned documents removed
+        for segment, dead in zip(self.segments, self.deleted):
+            doc_nums, tfs = segment.postings(token)
+            if dead is not None:
+                live = ~dead[doc_nums]
+                doc_nums, tfs = doc_nums[live], tfs[live]
+            yield segment, doc_nums, tfs
+
+
 
     def num_documents(self):
         # Number of documents in the index
-        return len(self.docmap)
-    
+        return len(self.doc_ids)
+
     def num_documents_with_token(self, token):
         # Number of documents that contain the specific token (term)
-        return len(self.index.get(token, set()))   
-    
+        return self.stats.df(token)
+
     def num_unique_tokens(self):
-        # Number of unique tokens (terms) in the index
-        return len(self.index)    
-    
+        # Number of unique tokens (terms) in the index (terms of deleted documents count until the next merge)
+        if len(self.segments) == 1:
+            return self.segments[0].num_terms()
+        return len(set().union(*(segment.term_table for segment in self.segments)))
+
     def tokens_in_doc(self, doc_id):
         # Number of tokens (terms) in a specific document
-        return sum(self.term_frequencies[doc_id].values())
+        return self.get_doc_length(doc_id)
 
     def total_token_usage(self, token):
         # Total number of times a given token (term) is found in every document
-        return sum(
-            counter.get(token, 0)
-            for counter in self.term_frequencies.values()
-        )
-    
+        return sum(int(tfs.sum()) for _, _, tfs in self.__live_postings(token))
+
     def total_tokens(self):
         # Total number of tokens (terms) across all documents
-        return sum(
-            sum(counter.values())
-            for counter in self.term_frequencies.values()
-        )
+        return self.stats.total_tokens
+
 
-    
+def build_segment(movies) -> Segment:
+    # Iterate over the movies and add them to a new segment (postings plus stored documents)
+    # Sorted by ID so doc numbers follow document ID order
+    movies = sorted(movies, key=lambda m: m["id"])
+
+    # When adding the movie data to the index, concatenate the title and the description and use that as the input text
+    all_tokens = get_tokenizer().tokenize_many(f"{m['title']} {m['description']}" for m in movies)
+
+    # Accumulate postings per term before packing them into the flat arrays
+    term_docs = {}
+    term_tfs = {}
+    doc_lengths = []
+    for doc_num, tokens in enumerate(all_tokens):
+        # Store the number of tokens in this document
+        doc_lengths.append(len(tokens))
+
+        for token, tf in Counter(tokens).items():
+            if token not in term_docs:
+                term_docs[token] = []
+                term_tfs[token] = []
+            # Doc numbers are visited in ascending order, so each postings list stays sorted
+            term_docs[token].append(doc_num)
+            term_tfs[token].append(tf)
+
+    return Segment.from_postings(term_docs, term_tfs, [m["id"] for m in movies], doc_lengths, movies)
+
+
+def build_segment_streaming(movies, path: str, workers=1, batch_size=INGEST_BATCH_SIZE) -> Segment:
+    # Index an iterable of movies into a segment file at `path`, batch by batch: each batch becomes a small
+    # run segment that is written to a spill directory next to `path` and memory-mapped, so only the batches
+    # in flight are ever held as Python objects, and merge_segments streams the runs into the output file.
+    # Tokenizing and stemming dominate build time, so with several workers the batches are indexed by a pool
+    # of worker processes. Doc numbers and term IDs are assigned in sorted order by the final merge of the
+    # runs, so the result is identical to a single in-memory build whatever the batch size or worker count.
+    workers = workers if workers > 0 else os.cpu_count() or 1
+    batches = (list(batch) for batch in itertools.batched(movies, batch_size))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or ".", prefix=".runs-") as run_dir:
+        runs = []
+
+        def spill(run: Segment) -> None:
+            path = os.path.join(run_dir, f"{len(runs):06d}.seg")
+            run.write(path)
+            runs.append(Segment.open(path))
+
+        if workers <= 1:
+            for batch in batches:
+                spill(build_segment(batch))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                # Submit as the input is read, keeping at most two batches per worker in flight
+                pending = deque()
+                for batch in batches:
+                    pending.append(pool.submit(build_segment, batch))
+                    if len(pending) >= 2 * workers:
+                        spill(pending.popleft().result())
+                while pending:
+                    spill(pending.popleft().result())
+
+        if not runs:
+            build_segment([]).write(path)
+            return Segment.open(path)
+        return merge_segments(runs, [None] * len(runs), path)
+
+
+class LiveDocMap(Mapping):
+    """Read-only mapping of document ID -> document over the live documents of every segment, hydrated from the docstore"""
+
+    def __init__(self, index: InvertedIndex):
+        self.index = index
+
+    def __getitem__(self, doc_id):
+        self.index.locate(doc_id)   # KeyError unless the document is live in the index
+        return self.index.documents.by_id(doc_id)
+
+    def __iter__(self):
+        return iter(self.index.doc_ids.tolist())
+
+    def __len__(self) -> int:
+        return len(self.index.doc_ids)
@@ -0,0 +1,68 @@
+import json
+import re
+
+# Movie files ending in one of these hold one JSON object per line; anything else is {"movies": [...]}
+JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+
+READ_SIZE = 1 << 20     # Characters read per step by the streaming JSON reader
+
+
+def iter_movies(path: str):
+    # Yield movies one at a time from a JSONL file or from the "movies" array of a JSON file,
+    # without ever holding the parsed file in memory
+    if path.endswith(JSONL_EXTENSIONS):
+        yield from iter_jsonl(path)
+    else:
+        yield from iter_json_array(path, "movies")
+
+
+def iter_jsonl(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_json_array(path: str, key: str):
+    # Incremental reader for {"key": [item, item, ...]}: items are decoded one by one with raw_decode
+    # from a buffer that is refilled as it runs out, so memory is bounded by READ_SIZE plus one item
+    decoder = json.JSONDecoder()
+    array_start = re.compile(rf'"{re.escape(key)}"\s*:\s*\[')
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = f.read(READ_SIZE)
+        match = array_start.search(buffer)
+        while match is None:
+            more = f.read(READ_SIZE)
+            if not more:
+                raise ValueError(f'No "{key}" array in {path}')
+            buffer += more
+            match = array_start.search(buffer)
+        pos = match.end()
+
+        while True:
+            # Skip to the next item (or the closing bracket), reading more text when the buffer runs out
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buffer):
+                    break
+                buffer, pos = f.read(READ_SIZE), 0
+                if not buffer:
+                    raise ValueError(f'Unterminated "{key}" array in {path}')
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The item runs past the end of the buffer
+                more = f.read(READ_SIZE)
+                if not more:
+                    raise
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield item
+            pos = end
+            if pos > READ_SIZE:
+                buffer, pos = buffer[pos:], 0
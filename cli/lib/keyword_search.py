@@ -1,17 +1,75 @@
 import string
+from functools import lru_cache
 
-from .search_utils import DEFAULT_SEARCH_LIMIT, load_movies, load_stopwords
-from nltk.stem import PorterStemmer
+from .docstore import load_docstore
+from .search_utils import DEFAULT_SEARCH_LIMIT, STEM_CACHE_SIZE, load_stopwords
+
+
+# Translation table that deletes all punctuation, built once at import time
+PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+    #1st arg: characters to replace  (not used here)
+    #2nd arg: characters to replace them with  (not used here)
+    #3rd arg: characters to delete  (this is what we are using)
+
+
+class Tokenizer:
+    """Reusable tokenizer pipeline: lowercase -> strip punctuation -> split -> drop stopwords -> stem
+
+    The stopword list is loaded once into a frozenset and the stopword check plus
+    Porter stem of each distinct word is memoized in a bounded LRU cache, so
+    repeated words (the common case in a corpus) cost a single dict lookup.
+    """
+
+    def __init__(self, stopwords=None, cache_size: int = STEM_CACHE_SIZE):
+        if stopwords is None:
+            stopwords = load_stopwords()
+        self.stopwords = frozenset(stopwords)
+
+        # Stems are used to allow concept matches such as runs, running and ran instead of precise text matches.
+        # Imported here because importing nltk takes seconds and commands that never tokenize shouldn't pay for it
+        from nltk.stem import PorterStemmer
+        self.stemmer = PorterStemmer()
+        self._normalize_word = lru_cache(maxsize=cache_size)(self.__normalize_word)
+
+    def __normalize_word(self, word: str) -> str | None:
+        # Blocked words (eg 'the') map to None so they are dropped by the caller
+        if word in self.stopwords:
+            return None
+        return self.stemmer.stem(word)
+
+    def tokenize(self, text: str) -> list[str]:
+        normalize = self._normalize_word
+        valid_tokens = []
+        # str.split() with no arguments never yields empty strings
+        for word in preprocess_text(text).split():
+            token = normalize(word)
+            if token is not None:
+                valid_tokens.append(token)
+        return valid_tokens
+
+    def tokenize_many(self, texts) -> list[list[str]]:
+        return [self.tokenize(text) for text in texts]
+
+    def cache_info(self):
+        return self._normalize_word.cache_info()
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer() -> Tokenizer:
+    # Shared process-wide tokenizer so the stopwords file is only read once
+    return Tokenizer()
 
 
 def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
-    movies = load_movies()
+    docs = load_docstore()
+    tokenizer = get_tokenizer()
+    query_tokens = tokenizer.tokenize(query)
     results = []
-    for movie in movies:
-        query_tokens = tokenize_text(query)
-        title_tokens = tokenize_text(movie["title"])
+    for row in range(len(docs)):
+        # Only titles are decoded while scanning; matches are hydrated in full
+        title_tokens = tokenizer.tokenize(docs.field(row, "title"))
         if has_matching_token(query_tokens, title_tokens):
-            results.append(movie)
+            results.append(docs[row])
             if len(results) >= limit:
                 break
 
@@ -28,34 +86,13 @@ def has_matching_token(query_tokens: list[str], title_tokens: list[str]) -> bool
 
 def preprocess_text(text: str) -> str:
     text = text.lower()
-    text = text.translate(str.maketrans("", "", string.punctuation))
-        #1st arg: characters to replace  (not used here)
-        #2nd arg: characters to replace them with  (not used here)
-        #3rd arg: characters to delete  (this is what we are using)
+    text = text.translate(PUNCTUATION_TABLE)
     return text
 
 
 def tokenize_text(text: str) -> list[str]:
-    text = preprocess_text(text)
-    tokens = text.split()
-    valid_tokens = []
-
-    # Load the list of words that we do not consider to be a match
-    stop_words = load_stopwords()
-
-    # Create an instance of PorterStemmer from nltk.stem
-    # Stems are used to allow concept matches such as runs, running and ran instead of precise text matches
-    stemmer = PorterStemmer()
-
-    for token in tokens:
-        # For each word in the list
-        if token:
-            # Make sure it exists (ie not empty)
-            if token not in stop_words:
-                # Then make sure it is not in the blocked words list (eg 'The')
-                # and only then add it to the allowed list.
-                valid_tokens.append(stemmer.stem(token))
-
+    return get_tokenizer().tokenize(text)
 
-    return valid_tokens
 
+def tokenize_many(texts) -> list[list[str]]:
+    return get_tokenizer().tokenize_many(texts)
@@ -0,0 +1,159 @@
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from .ann import file_fingerprint
+from .search_utils import top_k_indices, DEFAULT_RESCORE_OVERSAMPLE
+
+# Embedding storage modes: "none" keeps float32 vectors in RAM; the others keep a compact
+# code matrix in RAM and rescore candidates against the memory-mapped float32 vectors
+QUANTIZATION_MODES = ("none", "int8", "binary")
+
+SCORE_BATCH_SIZE = 65536    # Code rows decoded per step, bounds the temporary float32 buffer
+
+
+class _QuantizedStore(ABC):
+    """Two-stage search: approximate scores from quantized codes, exact rescoring of the best candidates
+
+    `search` has the same signature as the ANN indexes in ann.py, so a store can be
+    plugged in wherever an ANN index is used. Subclasses provide the codes: their
+    approximate scores and their size.
+    """
+
+    def __init__(self, fingerprint: str = ""):
+        self.fingerprint = fingerprint
+        self.oversample = DEFAULT_RESCORE_OVERSAMPLE   # Candidates fetched per requested result
+
+    @abstractmethod
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # Estimated inner product of the query with every row
+        ...
+
+    def search(self, vectors: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Top-k (row IDs, exact scores) for one unit-length query
+        candidates = top_k_indices(self.approximate_scores(query), k * self.oversample)
+        candidates.sort()   # Ascending row IDs keep reads sequential and tie-breaking identical to exact search
+
+        scores = vectors[candidates] @ query
+        best = top_k_indices(scores, k)
+        return candidates[best], scores[best]
+
+    @abstractmethod
+    def nbytes(self) -> int:
+        # Size of the codes kept in RAM
+        ...
+
+
+class Int8Store(_QuantizedStore):
+    """Per-dimension scalar quantization: x ~= offset + scale * code, with int8 codes"""
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, offset: np.ndarray, fingerprint: str = ""):
+        super().__init__(fingerprint)
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, fingerprint: str = "") -> "Int8Store":
+        # Map each dimension's [min, max] range onto the 256 int8 levels
+        low = vectors.min(axis=0).astype(np.float32)
+        high = vectors.max(axis=0).astype(np.float32)
+        scale = np.maximum(high - low, np.finfo(np.float32).tiny) / 255
+        offset = low + 128 * scale
+
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), SCORE_BATCH_SIZE):
+            batch = vectors[start:start + SCORE_BATCH_SIZE]
+            codes[start:start + len(batch)] = np.clip(np.rint((batch - offset) / scale), -128, 127)
+        return cls(codes, scale, offset, fingerprint)
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # x . q ~= offset . q + code . (scale * q)
+        base = float(self.offset @ query)
+        scaled_query = (self.scale * query).astype(np.float32)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), SCORE_BATCH_SIZE):
+            batch = self.codes[start:start + SCORE_BATCH_SIZE]
+            scores[start:start + len(batch)] = batch.astype(np.float32) @ scaled_query + base
+        return scores
+
+    @classmethod
+    def load(cls, path: str) -> "Int8Store":
+        with np.load(path) as data:
+            return cls(data["codes"], data["scale"], data["offset"], str(data["fingerprint"]))
+
+    def save(self, path: str) -> None:
+        np.savez(path, codes=self.codes, scale=self.scale, offset=self.offset, fingerprint=self.fingerprint)
+
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+
+class BinaryStore(_QuantizedStore):
+    """1-bit sign quantization searched by Hamming distance (popcount of XOR)
+
+    Signs are taken relative to the per-dimension mean, so dimensions that are
+    positive for every vector still split the collection in half.
+    """
+
+    def __init__(self, bits: np.ndarray, center: np.ndarray, fingerprint: str = ""):
+        super().__init__(fingerprint)
+        self.bits = bits        # Packed sign bits, one row of ceil(dims / 8) bytes per vector
+        self.center = center
+
+    def pack(self, vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(vectors > self.center, axis=-1)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, fingerprint: str = "") -> "BinaryStore":
+        store = cls(np.empty((len(vectors), (vectors.shape[1] + 7) // 8), dtype=np.uint8), vectors.mean(axis=0, dtype=np.float64).astype(np.float32), fingerprint)
+        for start in range(0, len(vectors), SCORE_BATCH_SIZE):
+            batch = vectors[start:start + SCORE_BATCH_SIZE]
+            store.bits[start:start + len(batch)] = store.pack(batch)
+        return store
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        # Fewer differing sign bits = more similar, so the score is the negated Hamming distance
+        query_bits = self.pack(query)
+        if self.bits.shape[1] % 8 == 0:
+            # Popcount 64 bits at a time when the row width allows it
+            words = self.bits.view(np.uint64)
+            distances = np.bitwise_count(words ^ query_bits.view(np.uint64)).sum(axis=1, dtype=np.int32)
+        else:
+            distances = np.bitwise_count(self.bits ^ query_bits).sum(axis=1, dtype=np.int32)
+        return -distances
+
+    @classmethod
+    def load(cls, path: str) -> "BinaryStore":
+        with np.load(path) as data:
+            return cls(data["bits"], data["center"], str(data["fingerprint"]))
+
+    def save(self, path: str) -> None:
+        np.savez(path, bits=self.bits, center=self.center, fingerprint=self.fingerprint)
+
+    def nbytes(self) -> int:
+        return self.bits.nbytes + self.center.nbytes
+
+
+QUANTIZED_STORES = {"int8": Int8Store, "binary": BinaryStore}
+
+
+def quantized_store_path(embeddings_path: str, mode: str) -> str:
+    # movie_embeddings.npy -> movie_embeddings_int8.npz, stored next to the float32 vectors
+    return f"{os.path.splitext(embeddings_path)[0]}_{mode}.npz"
+
+
+def load_or_create_quantized_store(vectors: np.ndarray, source_path: str, mode: str) -> _QuantizedStore:
+    # Reuse the quantized codes cached next to the embeddings unless the embeddings file changed
+    store_class = QUANTIZED_STORES[mode]
+    store_path = quantized_store_path(source_path, mode)
+    fingerprint = file_fingerprint(source_path)
+    if os.path.exists(store_path):
+        store = store_class.load(store_path)
+        if store.fingerprint == fingerprint:
+            return store
+
+    store = store_class.build(vectors, fingerprint)
+    store.save(store_path)
+    return store
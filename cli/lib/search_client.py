@@ -0,0 +1,72 @@
+import http.client
+import json
+import socket
+import sys
+
+# Addresses are "host:port" for TCP or "unix:/path/to/socket" for a Unix domain socket
+UNIX_PREFIX = "unix:"
+SERVER_TIMEOUT = 60     # Seconds a client waits for a response
+
+# Kept apart from search_server.py so the CLIs' --server option doesn't import the model or the index
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class SearchClient:
+    """Thin client for a running search server; each method mirrors a SearchService method"""
+
+    def __init__(self, address: str, timeout: float = SERVER_TIMEOUT):
+        if address.startswith(UNIX_PREFIX):
+            self.connection = _UnixHTTPConnection(address[len(UNIX_PREFIX):], timeout)
+        else:
+            host, port = address.rsplit(":", 1)
+            self.connection = http.client.HTTPConnection(host, int(port), timeout=timeout)
+
+    def _request(self, method: str, path: str, params: dict | None = None) -> dict:
+        body = json.dumps(params).encode("utf-8") if params is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise ValueError(data.get("error", f"Server returned HTTP {response.status}"))
+        return data
+
+    def bm25(self, query: str, **params) -> list[dict]:
+        return self._request("POST", "/bm25", {"query": query, **params})["results"]
+
+    def semantic_search(self, query: str, **params) -> list[dict]:
+        return self._request("POST", "/semantic", {"query": query, **params})["results"]
+
+    def chunked_search(self, query: str, **params) -> list[dict]:
+        return self._request("POST", "/chunked", {"query": query, **params})["results"]
+
+    def hybrid_search(self, query: str, **params) -> list[dict]:
+        return self._request("POST", "/hybrid", {"query": query, **params})["results"]
+
+    def health(self) -> dict:
+        return self._request("GET", "/health")
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def query_server(address: str, endpoint: str, query: str, **params) -> list[dict]:
+    # One request to a running server, for the CLIs' --server option
+    client = SearchClient(address)
+    try:
+        return getattr(client, endpoint)(query, **params)
+    except OSError as e:
+        print(f"Search server not reachable at {address}: {e}")
+        sys.exit(1)
+    finally:
+        client.close()
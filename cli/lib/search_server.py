@@ -0,0 +1,204 @@
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .bm25 import EXHAUSTIVE, SEARCH_STRATEGIES
+from .hybrid_search import HybridSearch, FUSION_METHODS
+from .index import InvertedIndex
+from .keyword_search import get_tokenizer
+from .semantic_search import ChunkedSemanticSearch, CHUNK_AGGREGATIONS
+from .search_client import UNIX_PREFIX
+from .docstore import load_docstore
+from .search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_AGGREGATION, DEFAULT_CHUNK_TOP_N, DEFAULT_HYBRID_ALPHA, DEFAULT_RRF_K, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_BATCH_WAIT_MS, BM25_K1, BM25_B
+
+
+class SearchService:
+    """Everything a query needs, loaded once and shared by every request
+
+    The model, the embedding matrices, the parsed movies and the index segments
+    stay in memory, so a request only pays for the search itself.
+    """
+
+    def __init__(self, quantization: str = "none", max_batch: int = DEFAULT_MAX_BATCH_SIZE, max_wait_ms: float = DEFAULT_MAX_BATCH_WAIT_MS):
+        start = time.perf_counter()
+        self.documents = load_docstore()
+        self.index = InvertedIndex(self.documents)
+        self.index.load()
+        get_tokenizer()     # Import nltk now rather than inside the first request
+        # One searcher (and so one model) holds both the movie and the chunk embeddings
+        self.semantic = ChunkedSemanticSearch(quantization=quantization)
+        self.semantic.load_or_create_embeddings(self.documents)
+        self.semantic.load_or_create_chunk_embeddings(self.documents)
+        if max_batch > 1:
+            # Request threads hand their queries to one batcher, so concurrent queries share a model call
+            self.semantic.enable_batching(max_batch, max_wait_ms)
+        self.hybrid = HybridSearch(self.documents, self.semantic, self.index)
+        self.load_seconds = time.perf_counter() - start
+        self.requests = 0
+        self._requests_lock = threading.Lock()     # Request threads bump the counter concurrently
+
+
+    def bm25(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT, k1: float = BM25_K1, b: float = BM25_B, strategy: str = EXHAUSTIVE) -> list[dict]:
+        return self.index.bm25_search(query, limit, k1, b, strategy)
+
+    def semantic_search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
+        return self.semantic.search(query, limit)
+
+    def chunked_search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT, aggregation: str = DEFAULT_CHUNK_AGGREGATION, top_n: int = DEFAULT_CHUNK_TOP_N) -> list[dict]:
+        return self.semantic.search_chunks(query, limit, aggregation, top_n)
+
+    def hybrid_search(self, query: str, limit: int = DEFAULT_SEARCH_LIMIT, method: str = "rrf", alpha: float = DEFAULT_HYBRID_ALPHA, rrf_k: int = DEFAULT_RRF_K, chunks: bool = False) -> list[dict]:
+        return self.hybrid.search(query, limit, method, alpha, rrf_k, chunks)
+
+    def count_request(self) -> None:
+        with self._requests_lock:
+            self.requests += 1
+
+    def health(self) -> dict:
+        return {
+            "documents": len(self.documents),
+            "index_segments": len(self.index.segments),
+            "load_seconds": round(self.load_seconds, 3),
+            "requests": self.requests,
+            "query_cache": self.semantic.query_cache.stats(),
+            "batching": self.semantic.batcher.stats() if self.semantic.batcher is not None else None,
+        }
+
+
+# Request path -> SearchService method; the JSON body supplies the keyword arguments
+ENDPOINTS = {
+    "/bm25": "bm25",
+    "/semantic": "semantic_search",
+    "/chunked": "chunked_search",
+    "/hybrid": "hybrid_search",
+}
+
+
+# Request parameter -> (type, lowest allowed, highest allowed); None leaves that side open
+NUMERIC_PARAMETERS = {
+    "limit": (int, 1, None),
+    "top_n": (int, 1, None),
+    "rrf_k": (int, 0, None),
+    "k1": (float, 0.0, None),
+    "b": (float, 0.0, 1.0),
+    "alpha": (float, 0.0, 1.0),
+}
+
+# Request parameter -> allowed values
+CHOICE_PARAMETERS = {
+    "strategy": SEARCH_STRATEGIES,
+    "aggregation": CHUNK_AGGREGATIONS,
+    "method": FUSION_METHODS,
+}
+
+
+def coerce_number(name: str, value, kind: type, low, high):
+    # JSON numbers or numeric strings; booleans and fractional values for integer parameters are rejected
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise ValueError
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number, got {value!r}") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{name} must be finite, got {value!r}")
+    if kind is int:
+        if number != int(number):
+            raise ValueError(f"{name} must be an integer, got {value!r}")
+        number = int(number)
+    if low is not None and number < low:
+        raise ValueError(f"{name} must be at least {low}, got {value!r}")
+    if high is not None and number > high:
+        raise ValueError(f"{name} must be at most {high}, got {value!r}")
+    return number
+
+
+def validate_params(params) -> dict:
+    # Checked up front so a bad request gets a clear 400 instead of an empty result or a Python error from deep in a search
+    if not isinstance(params, dict):
+        raise ValueError("request body must be a JSON object")
+    params = dict(params)
+    if not isinstance(params.get("query"), str):
+        raise ValueError("query is required and must be a string")
+    for name, (kind, low, high) in NUMERIC_PARAMETERS.items():
+        if name in params:
+            params[name] = coerce_number(name, params[name], kind, low, high)
+    for name, choices in CHOICE_PARAMETERS.items():
+        if name in params and params[name] not in choices:
+            raise ValueError(f"Unknown {name}: {params[name]!r} (expected one of {', '.join(choices)})")
+    if "chunks" in params and not isinstance(params["chunks"], bool):
+        raise ValueError("chunks must be true or false")
+    return params
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # Keep-alive, so a client can send many queries over one connection
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, self.server.service.health())
+        else:
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        method = ENDPOINTS.get(self.path)
+        if method is None:
+            self._reply(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            params = validate_params(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}"))
+            start = time.perf_counter()
+            results = getattr(self.server.service, method)(**params)
+            self.server.service.count_request()
+            self._reply(200, {"results": results, "elapsed_ms": (time.perf_counter() - start) * 1000})
+        except (TypeError, ValueError, KeyError) as e:
+            # Bad parameters (unknown argument, empty query, unknown strategy, ...)
+            self._reply(400, {"error": str(e)})
+        except Exception as e:
+            # Anything else is a server-side failure; answer it so the client is not left waiting on the connection
+            self.log_error("%s failed: %r", self.path, e)
+            traceback.print_exc()
+            self._reply(500, {"error": f"Internal error: {type(e).__name__}: {e}"})
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Replace a socket file left behind by a previous run
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+        self.server_name, self.server_port = "localhost", 0
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(address: str, service: SearchService):
+    if address.startswith(UNIX_PREFIX):
+        server = ThreadingUnixHTTPServer(address[len(UNIX_PREFIX):], SearchRequestHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host, int(port)), SearchRequestHandler)
+    server.service = service
+    return server
@@ -1,19 +1,49 @@
-import json
+import heapq
 import os
 from typing import Any
 
+import numpy as np
+
+from .ingest import iter_movies
+
 DEFAULT_SEARCH_LIMIT = 5
 DEFAULT_CHUNK_LIMIT = 200
 DEFAULT_SEMANTIC_CHUNK_SIZE = 4
 DEFAULT_CHUNK_OVERLAP = 1
+DEFAULT_CHUNK_AGGREGATION = "max"   #How chunk scores are combined into a movie score (max, mean or top_n_sum)
+DEFAULT_CHUNK_TOP_N = 2             #Number of best chunks summed by the top_n_sum aggregation
+DEFAULT_IVF_NPROBE = 8              #Number of IVF cells scanned per query (higher = better recall, slower)
+DEFAULT_HNSW_M = 16                 #HNSW links per node on the upper layers (2 * M on layer 0)
+DEFAULT_HNSW_EF_CONSTRUCTION = 100  #HNSW beam width while inserting nodes
+DEFAULT_HNSW_EF_SEARCH = 50         #HNSW beam width at query time (higher = better recall, slower)
+DEFAULT_RESCORE_OVERSAMPLE = 8      #Quantized search rescores limit * this many candidates against the float32 vectors
+ANN_CANDIDATE_MULTIPLIER = 4        #Chunk ANN search fetches limit * this many chunks to find candidate movies
+QUERY_CACHE_SIZE = 1024             #Query embeddings kept in the in-process LRU
+QUERY_DISK_CACHE_SIZE = 100000      #Query embeddings kept in the on-disk cache before the least recently used are evicted
+DEFAULT_RRF_K = 60                  #Reciprocal rank fusion constant: score = sum of 1 / (k + rank)
+DEFAULT_HYBRID_ALPHA = 0.5          #Weight of the keyword score in weighted hybrid search (1 - alpha goes to semantic)
+HYBRID_CANDIDATE_MULTIPLIER = 10    #Hybrid search fetches limit * this many results from each retriever before fusing
+DEFAULT_MAX_BATCH_SIZE = 32         #Most concurrent queries encoded and scored together by the micro-batcher
+DEFAULT_MAX_BATCH_WAIT_MS = 2.0     #Longest the micro-batcher holds a query back waiting for others to join its batch
+DEFAULT_QUERY_BATCH_SIZE = 64       #Queries read, encoded and scored together by the batch subcommands
+DEFAULT_SERVER_ADDRESS = "127.0.0.1:8765"  #Search server address, "host:port" or "unix:/path/to/socket"
+DEFAULT_RECALL_K = 10
+DEFAULT_RECALL_QUERIES = 100
 
 DOCUMENT_PREVIEW_LENGTH = 100
 SCORE_PRECISION = 3
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 CACHE_PATH = os.path.join(PROJECT_ROOT, "cache")
+MOVIES_PATH = os.path.join(PROJECT_ROOT, "data", "movies.json")
+MOVIES_JSONL_PATH = os.path.join(PROJECT_ROOT, "data", "movies.jsonl")    #Used instead of movies.json when present
+INGEST_BATCH_SIZE = 10000   #Movies read, tokenized and spilled to disk together when building the docstore and the index
+ENCODE_BATCH_SIZE = 1024    #Texts per model call when (re)building embeddings
+EMBED_SHARD_SIZE = 8192     #Newly encoded texts per checkpoint shard, so an interrupted embedding build resumes from the last shard
+MAX_INDEX_SEGMENTS = 10     #Incremental index updates merge all segments once there are more than this
 BM25_K1 = 1.5   #BM25 TermFreq saturation tuning factor
 BM25_B = 0.75   #BM25 DocumentLength normalisation factor (Longer documents are penalised, shorter documents are boosted)
+STEM_CACHE_SIZE = 65536     #Max number of distinct words whose stopword check + stem is memoized by the tokenizer
 
 
 
@@ -41,14 +71,63 @@ def format_search_result(doc_id: str, title: str, document: str, score: float, *
 
 
 
-def load_movies() -> list[dict]:
-    data_path = os.path.join(PROJECT_ROOT, "data", "movies.json")
-    with open(data_path, "r") as f:
-        data = json.load(f)
-    return data["movies"]
+def top_k_from_dict(scores: dict, k: int) -> list[tuple[Any, float]]:
+    """Select the k highest scoring entries of a key -> score dictionary
+
+    Uses a bounded heap, so the cost is O(N log k) instead of sorting every entry.
+
+    Args:
+        scores: Mapping of key (e.g. document ID) to score
+        k: Number of entries to return
+
+    Returns:
+        (key, score) pairs, highest score first, ties broken by ascending key
+    """
+    if k <= 0:
+        return []
+    return heapq.nsmallest(k, scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Select the indices of the k highest values of a 1-D score array
+
+    Uses np.argpartition to find the k-th best score in O(N), then only sorts the
+    entries at or above it, so the cost is O(N + k log k).
+
+    Args:
+        scores: 1-D array of scores
+        k: Number of indices to return
+
+    Returns:
+        Indices ordered by score descending, ties broken by ascending index
+    """
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.intp)
+
+    if k < n:
+        kth_best = scores[np.argpartition(scores, n - k)[n - k]]
+        # Keep every entry tied with the k-th best so the lowest indices win ties deterministically
+        candidates = np.flatnonzero(scores >= kth_best)
+    else:
+        candidates = np.arange(n)
+
+    order = np.lexsort((candidates, -scores[candidates]))[:k]
+    return candidates[order]
+
+
+
+def movies_source() -> str:
+    # The movies file to ingest: data/movies.jsonl (one movie per line) if it exists, else data/movies.json
+    return MOVIES_JSONL_PATH if os.path.exists(MOVIES_JSONL_PATH) else MOVIES_PATH
+
+
+def load_movies(data_path: str | None = None) -> list[dict]:
+    # Every movie in memory at once; builds stream them with ingest.iter_movies and searches read the docstore
+    return list(iter_movies(data_path or movies_source()))
 
 
-def load_stopwords() -> list[dict]:
+def load_stopwords() -> list[str]:
     stopwords_path = os.path.join(PROJECT_ROOT, "data", "stopwords.txt")
     with open(stopwords_path) as f:        
         return f.read().splitlines()
\ No newline at end of file
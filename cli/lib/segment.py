@@ -0,0 +1,428 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# Postings are stored in compressed sparse row (CSR) layout:
+#   term ID t owns the slice term_offsets[t]:term_offsets[t+1] of postings_docs / postings_tfs
+# Doc numbers are dense internal row numbers (0..N-1) assigned in ascending document ID order,
+# so every postings slice is sorted by both doc number and document ID.
+DOC_DTYPE = np.uint32
+TF_DTYPE = np.uint16
+OFFSET_DTYPE = np.uint64
+MAX_TF = np.iinfo(TF_DTYPE).max
+
+# Each postings list is cut into fixed-size blocks; per-block maxima give the score upper bounds used by WAND / Block-Max pruning
+POSTINGS_BLOCK_SIZE = 64
+
+# Postings buffered by merge_segments before they are appended to the output's spill files
+MERGE_FLUSH_POSTINGS = 1 << 20
+
+# On-disk segment layout (all little endian):
+#   header   magic, format version, section count, num docs, num terms, num postings, total tokens
+#   sections one (offset, length) pair per entry of SECTIONS, followed by the 8-byte aligned section bodies
+SEGMENT_MAGIC = b"RAGSEG\x00\x00"
+SEGMENT_VERSION = 3
+HEADER = struct.Struct("<8sIIQQQQ")
+SECTION_ENTRY = struct.Struct("<QQ")
+SECTION_ALIGNMENT = 8
+SECTIONS = (
+    ("term_str_offsets", OFFSET_DTYPE),     # Term ID -> byte offset of the term string in `terms`
+    ("terms", np.uint8),                    # UTF-8 term strings, sorted bytewise so term IDs can be binary searched
+    ("term_offsets", OFFSET_DTYPE),         # Term ID -> start offset into the postings arrays
+    ("postings_docs", DOC_DTYPE),
+    ("postings_tfs", TF_DTYPE),
+    ("block_offsets", OFFSET_DTYPE),        # Term ID -> index of its first postings block
+    ("block_last_docs", DOC_DTYPE),         # Last doc number in each block
+    ("block_max_tfs", TF_DTYPE),            # Highest term frequency in each block
+    ("block_min_lengths", DOC_DTYPE),       # Shortest document length in each block
+    ("doc_ids", DOC_DTYPE),                 # Doc number -> document ID
+    ("doc_lengths", DOC_DTYPE),             # Doc number -> number of tokens
+    ("doc_hashes", np.uint64),              # Doc number -> content hash of the indexed document (documents themselves live in the docstore)
+)
+
+
+def document_hash(doc: dict) -> int:
+    # 64-bit hash of a document's JSON, enough for `update` to notice edits without storing the document
+    return int.from_bytes(hashlib.blake2b(json.dumps(doc).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _pack_strings(strings: list[bytes]) -> tuple[np.ndarray, np.ndarray]:
+    # Concatenate byte strings into one blob plus an offsets array of length len(strings) + 1
+    offsets = np.zeros(len(strings) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(np.fromiter((len(s) for s in strings), dtype=OFFSET_DTYPE, count=len(strings)), out=offsets[1:])
+    blob = np.frombuffer(b"".join(strings), dtype=np.uint8)
+    return offsets, blob
+
+
+def map_sections(mm: mmap.mmap, sections, table_offset: int) -> dict[str, np.ndarray]:
+    # Zero-copy views of every section listed in the (offset, length) table that starts at table_offset
+    arrays = {}
+    for i, (name, dtype) in enumerate(sections):
+        offset, length = SECTION_ENTRY.unpack_from(mm, table_offset + i * SECTION_ENTRY.size)
+        count = length // np.dtype(dtype).itemsize
+        arrays[name] = np.frombuffer(mm, dtype=dtype, count=count, offset=offset) if count else np.empty(0, dtype=dtype)
+    return arrays
+
+
+def write_sections(path: str, header: bytes, arrays: list[np.ndarray]) -> None:
+    # Write header, section table and 8-byte aligned section bodies to a temp file in the same directory,
+    # then atomically rename it into place
+    position = len(header) + SECTION_ENTRY.size * len(arrays)
+    entries = []
+    for array in arrays:
+        position += -position % SECTION_ALIGNMENT
+        entries.append((position, array.nbytes))
+        position += array.nbytes
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.splitext(path)[1])
+    os.fchmod(fd, 0o644)    # mkstemp creates owner-only files
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            for offset, length in entries:
+                f.write(SECTION_ENTRY.pack(offset, length))
+            for (offset, _), array in zip(entries, arrays):
+                f.write(b"\x00" * (offset - f.tell()))
+                f.write(memoryview(np.ascontiguousarray(array)).cast("B"))    # No copy, even for memory-mapped arrays
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _block_stats(term_offsets: np.ndarray, postings_docs: np.ndarray, postings_tfs: np.ndarray, doc_lengths: np.ndarray) -> dict[str, np.ndarray]:
+    # Max TF and min document length per block are enough to bound BM25 for any k1 / b,
+    # since the BM25 term score grows with TF and shrinks with document length
+    df = np.diff(term_offsets).astype(np.int64)
+    blocks_per_term = -(-df // POSTINGS_BLOCK_SIZE)
+    block_offsets = np.zeros(len(df) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(blocks_per_term, out=block_offsets[1:])
+
+    num_blocks = int(block_offsets[-1])
+    if num_blocks == 0:
+        return {
+            "block_offsets": block_offsets,
+            "block_last_docs": np.empty(0, dtype=DOC_DTYPE),
+            "block_max_tfs": np.empty(0, dtype=TF_DTYPE),
+            "block_min_lengths": np.empty(0, dtype=DOC_DTYPE),
+        }
+
+    # Posting index where each block starts: term start + block number within the term * block size
+    block_in_term = np.arange(num_blocks, dtype=np.int64) - np.repeat(block_offsets[:-1].astype(np.int64), blocks_per_term)
+    block_starts = np.repeat(term_offsets[:-1].astype(np.int64), blocks_per_term) + block_in_term * POSTINGS_BLOCK_SIZE
+    block_ends = np.append(block_starts[1:], len(postings_docs))
+
+    return {
+        "block_offsets": block_offsets,
+        "block_last_docs": postings_docs[block_ends - 1].astype(DOC_DTYPE),
+        "block_max_tfs": np.maximum.reduceat(postings_tfs, block_starts).astype(TF_DTYPE),
+        "block_min_lengths": np.minimum.reduceat(doc_lengths[postings_docs], block_starts).astype(DOC_DTYPE),
+    }
+
+
+class TermTable:
+    """Sorted term dictionary backed by a string blob, looked up by binary search"""
+
+    def __init__(self, offsets: np.ndarray, blob: np.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id: int) -> bytes:
+        return self.blob[self.offsets[term_id]:self.offsets[term_id + 1]].tobytes()
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self[term_id].decode("utf-8")
+
+    def find(self, token: str) -> int:
+        # Return the term ID for a token, or -1 if it is not in the dictionary
+        key = token.encode("utf-8")
+        term_id = bisect.bisect_left(self, key)
+        if term_id < len(self) and self[term_id] == key:
+            return term_id
+        return -1
+
+
+def find_doc_number(doc_ids: np.ndarray, doc_id) -> int:
+    # Document IDs are sorted, so the doc number is found by binary search (-1 if missing)
+    pos = int(np.searchsorted(doc_ids, doc_id))
+    if pos == len(doc_ids) or doc_ids[pos] != doc_id:
+        return -1
+    return pos
+
+
+class Segment:
+    """Immutable postings + document lengths + document content hashes for a set of documents
+
+    A segment is either built in memory with `from_postings` or opened from disk with
+    `open`, in which case every array is a zero-copy view over a read-only mmap and
+    pages are only faulted in for the terms and documents that are actually touched.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray], total_tokens: int, mm: mmap.mmap | None = None):
+        for name, _ in SECTIONS:
+            setattr(self, name, arrays[name])
+        self.total_tokens = total_tokens
+        self.term_table = TermTable(self.term_str_offsets, self.terms)
+        self._mmap = mm
+
+
+    @classmethod
+    def empty(cls) -> "Segment":
+        return cls.from_postings({}, {}, [], [], [])
+
+
+    @classmethod
+    def from_postings(cls, term_docs: dict, term_tfs: dict, doc_ids, doc_lengths, documents) -> "Segment":
+        # term_docs / term_tfs map each token to its (ascending) doc numbers and term frequencies
+        # Assign term IDs in sorted (bytewise) term order and lay the postings out contiguously
+        encoded = sorted((term.encode("utf-8"), term) for term in term_docs)
+
+        df = np.fromiter((len(term_docs[t]) for _, t in encoded), dtype=OFFSET_DTYPE, count=len(encoded))
+        term_offsets = np.zeros(len(encoded) + 1, dtype=OFFSET_DTYPE)
+        np.cumsum(df, out=term_offsets[1:])
+
+        total = int(term_offsets[-1])
+        postings_docs = np.empty(total, dtype=DOC_DTYPE)
+        postings_tfs = np.empty(total, dtype=TF_DTYPE)
+        for term_id, (_, term) in enumerate(encoded):
+            start, end = term_offsets[term_id], term_offsets[term_id + 1]
+            postings_docs[start:end] = term_docs[term]
+            postings_tfs[start:end] = np.minimum(term_tfs[term], MAX_TF)
+
+        doc_hashes = np.fromiter((document_hash(doc) for doc in documents), dtype=np.uint64, count=len(documents))
+        return cls.from_csr([key for key, _ in encoded], term_offsets, postings_docs, postings_tfs, doc_ids, doc_lengths, doc_hashes)
+
+
+    @classmethod
+    def from_csr(cls, terms: list[bytes], term_offsets, postings_docs, postings_tfs, doc_ids, doc_lengths, doc_hashes) -> "Segment":
+        # Assemble a segment from already laid out arrays (terms sorted bytewise, postings in CSR order)
+        term_str_offsets, term_blob = _pack_strings(terms)
+        doc_lengths = np.asarray(doc_lengths, dtype=DOC_DTYPE)
+        arrays = {
+            "term_str_offsets": term_str_offsets,
+            "terms": term_blob,
+            "term_offsets": np.asarray(term_offsets, dtype=OFFSET_DTYPE),
+            "postings_docs": np.asarray(postings_docs, dtype=DOC_DTYPE),
+            "postings_tfs": np.asarray(postings_tfs, dtype=TF_DTYPE),
+            "doc_ids": np.asarray(doc_ids, dtype=DOC_DTYPE),
+            "doc_lengths": doc_lengths,
+            "doc_hashes": np.asarray(doc_hashes, dtype=np.uint64),
+        }
+        arrays.update(_block_stats(arrays["term_offsets"], arrays["postings_docs"], arrays["postings_tfs"], doc_lengths))
+        return cls(arrays, int(doc_lengths.sum()))
+
+
+    @classmethod
+    def open(cls, path: str) -> "Segment":
+        # Map the file read-only; only the header is parsed, every section is a lazy view
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(mm) < HEADER.size:
+            raise ValueError(f"Index file is truncated: {path}")
+        magic, version, num_sections, _, _, _, total_tokens = HEADER.unpack_from(mm, 0)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"Not an index segment file: {path}")
+        if version != SEGMENT_VERSION or num_sections != len(SECTIONS):
+            raise ValueError(f"Unsupported index format version {version} in {path}, run build again")
+
+        return cls(map_sections(mm, SECTIONS, HEADER.size), total_tokens, mm)
+
+
+    def write(self, path: str) -> None:
+        header = HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(SECTIONS), self.num_documents(),
+                             self.num_terms(), self.num_postings(), self.total_tokens)
+        write_sections(path, header, [np.ascontiguousarray(getattr(self, name), dtype=dtype) for name, dtype in SECTIONS])
+
+
+    def postings(self, token: str) -> tuple[np.ndarray, np.ndarray]:
+        # Views into the postings arrays (doc numbers, term frequencies) for a token
+        term_id = self.term_table.find(token)
+        if term_id < 0:
+            return self.postings_docs[:0], self.postings_tfs[:0]
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.postings_docs[start:end], self.postings_tfs[start:end]
+
+    def doc_number(self, doc_id) -> int:
+        doc_num = find_doc_number(self.doc_ids, doc_id)
+        if doc_num < 0:
+            raise KeyError(doc_id)
+        return doc_num
+
+    def num_documents(self) -> int:
+        return len(self.doc_ids)
+
+    def num_terms(self) -> int:
+        return len(self.term_table)
+
+    def num_postings(self) -> int:
+        return len(self.postings_docs)
+
+
+class _SectionSpill:
+    """One output section being appended to a temp file while a merge runs"""
+
+    def __init__(self, path: str, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.file = open(path, "wb")
+        self.count = 0
+
+    def append(self, array) -> None:
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        self.file.write(memoryview(array).cast("B"))
+        self.count += len(array)
+
+    def finish(self) -> np.ndarray:
+        # Map the finished section back read-only (np.memmap refuses empty files)
+        self.file.close()
+        return np.memmap(self.path, dtype=self.dtype, mode="r") if self.count else np.empty(0, dtype=self.dtype)
+
+
+def _scratch_array(path: str, dtype, size: int) -> np.ndarray:
+    # Writable array backed by a file, so per-document outputs do not have to fit in memory
+    return np.memmap(path, dtype=dtype, mode="w+", shape=(size,)) if size else np.empty(0, dtype=dtype)
+
+
+def _live_numbers(live_ids: list[np.ndarray]) -> list[np.ndarray]:
+    # New doc number of every live document: its rank in ascending document ID order over all segments,
+    # i.e. how many live IDs of every segment sort before it. Each segment's IDs are already sorted.
+    numbers = []
+    for s, ids in enumerate(live_ids):
+        rank = np.zeros(len(ids), dtype=np.int64)
+        for t, other in enumerate(live_ids):
+            before = np.searchsorted(other, ids, side="left")
+            if t != s and np.any(np.searchsorted(other, ids, side="right") > before):
+                raise ValueError("A document ID is live in more than one segment")
+            rank += before
+        numbers.append(rank)
+    return numbers
+
+
+def _term_entries(s: int, segment: Segment):
+    # (term bytes, segment index, term ID) in the segment's sorted term order
+    for term_id in range(segment.num_terms()):
+        yield segment.term_table[term_id], s, term_id
+
+
+def merge_segments(segments: list[Segment], deleted: list, path: str) -> Segment:
+    """Compact the live documents of several segments into one new segment file at `path`
+
+    Documents are renumbered in ascending document ID order over all segments and
+    tombstoned documents (and terms that only they contained) are dropped. The term
+    dictionaries are merged with a heap over the segments' sorted term tables, and
+    for every term the (already sorted) postings runs of the segments holding it are
+    remapped and interleaved. Postings are written to per-section spill files every
+    MERGE_FLUSH_POSTINGS postings and the output file is assembled from those files,
+    so memory holds one flush worth of postings plus the per-document renumbering
+    tables, never the whole postings lists of the inputs.
+    """
+    live_ids = [segment.doc_ids if dead is None else segment.doc_ids[~dead] for segment, dead in zip(segments, deleted)]
+    numbers = _live_numbers(live_ids)
+    num_docs = sum(len(ids) for ids in live_ids)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path) or ".", prefix=".merge-") as spill_dir:
+        spill_path = lambda name: os.path.join(spill_dir, name)
+
+        # Per-document sections, scattered into place; remaps[s] maps old doc numbers to new ones (-1 if deleted)
+        doc_ids = _scratch_array(spill_path("doc_ids"), DOC_DTYPE, num_docs)
+        doc_lengths = _scratch_array(spill_path("doc_lengths"), DOC_DTYPE, num_docs)
+        doc_hashes = _scratch_array(spill_path("doc_hashes"), np.uint64, num_docs)
+        remaps = []
+        for segment, dead, ids, rank in zip(segments, deleted, live_ids, numbers):
+            rows = slice(None) if dead is None else ~dead
+            doc_ids[rank] = ids
+            doc_lengths[rank] = segment.doc_lengths[rows]
+            doc_hashes[rank] = segment.doc_hashes[rows]
+            remap = np.full(segment.num_documents(), -1, dtype=np.int64)
+            remap[rows] = rank
+            remaps.append(remap)
+
+        spills = {name: _SectionSpill(spill_path(name), dtype) for name, dtype in SECTIONS
+                  if name not in ("doc_ids", "doc_lengths", "doc_hashes")}
+        for name in ("term_str_offsets", "term_offsets", "block_offsets"):
+            spills[name].append([0])
+        written = {"terms": 0, "term_bytes": 0, "postings": 0, "blocks": 0}
+        pending_terms, pending_docs, pending_tfs = [], [], []
+
+        def flush():
+            # Lay out the pending terms like from_csr does, offset by everything written so far
+            if not pending_terms:
+                return
+            docs = np.concatenate(pending_docs)
+            tfs = np.concatenate(pending_tfs)
+            term_offsets = np.zeros(len(pending_terms) + 1, dtype=OFFSET_DTYPE)
+            np.cumsum(np.fromiter((len(d) for d in pending_docs), dtype=OFFSET_DTYPE, count=len(pending_docs)), out=term_offsets[1:])
+            term_str_offsets, term_blob = _pack_strings(pending_terms)
+            blocks = _block_stats(term_offsets, docs, tfs, doc_lengths)
+
+            spills["term_str_offsets"].append(term_str_offsets[1:] + written["term_bytes"])
+            spills["terms"].append(term_blob)
+            spills["term_offsets"].append(term_offsets[1:] + written["postings"])
+            spills["postings_docs"].append(docs)
+            spills["postings_tfs"].append(tfs)
+            spills["block_offsets"].append(blocks["block_offsets"][1:] + written["blocks"])
+            for name in ("block_last_docs", "block_max_tfs", "block_min_lengths"):
+                spills[name].append(blocks[name])
+
+            written["terms"] += len(pending_terms)
+            written["term_bytes"] += len(term_blob)
+            written["postings"] += len(docs)
+            written["blocks"] += int(blocks["block_offsets"][-1])
+            pending_terms.clear()
+            pending_docs.clear()
+            pending_tfs.clear()
+
+        pending_postings = 0
+        merged_terms = heapq.merge(*(_term_entries(s, segment) for s, segment in enumerate(segments)))
+        for term, entries in itertools.groupby(merged_terms, key=lambda entry: entry[0]):
+            run_docs, run_tfs = [], []
+            for _, s, term_id in entries:
+                start, end = segments[s].term_offsets[term_id], segments[s].term_offsets[term_id + 1]
+                docs = remaps[s][segments[s].postings_docs[start:end]]
+                keep = docs >= 0
+                run_docs.append(docs[keep])
+                run_tfs.append(segments[s].postings_tfs[start:end][keep])
+            docs = np.concatenate(run_docs)
+            if len(docs) == 0:
+                continue    # Only deleted documents contained this term
+            tfs = np.concatenate(run_tfs)
+            if len(run_docs) > 1:
+                # Each run is sorted; a stable mergesort of the concatenated runs interleaves them
+                order = np.argsort(docs, kind="stable")
+                docs, tfs = docs[order], tfs[order]
+
+            pending_terms.append(term)
+            pending_docs.append(docs)
+            pending_tfs.append(tfs)
+            pending_postings += len(docs)
+            if pending_postings >= MERGE_FLUSH_POSTINGS:
+                flush()
+                pending_postings = 0
+        flush()
+
+        for array in (doc_ids, doc_lengths, doc_hashes):
+            if isinstance(array, np.memmap):
+                array.flush()
+        arrays = {name: spill.finish() for name, spill in spills.items()}
+        arrays.update(doc_ids=doc_ids, doc_lengths=doc_lengths, doc_hashes=doc_hashes)
+
+        header = HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, len(SECTIONS), num_docs, written["terms"],
+                             written["postings"], int(doc_lengths.sum(dtype=np.uint64)))
+        write_sections(path, header, [arrays[name] for name, _ in SECTIONS])
+    return Segment.open(path)
@@ -1,5 +1,13 @@
+import time
+
+import numpy as np
+
 from .semantic_search import SemanticSearch, ChunkedSemanticSearch, semantic_chunk
-from .search_utils import load_movies
+from .search_client import query_server
+from .batch_io import read_queries, stream_results, report_throughput
+from .docstore import load_docstore
+from .search_utils import ENCODE_BATCH_SIZE, DEFAULT_IVF_NPROBE, DEFAULT_HNSW_EF_SEARCH, DEFAULT_RESCORE_OVERSAMPLE
+from .ann import exact_search, recall_at_k
 
 
 
@@ -24,12 +32,17 @@ def cmd_chunk(text, chunk_size, overlap):
 
 
 
-def cmd_embed_chunks():
+def cmd_embed_chunks(workers=1, batch_size=ENCODE_BATCH_SIZE):
     css = ChunkedSemanticSearch()
+    css.enable_encode_pool(workers, batch_size)
 
-    docs = load_movies()
-    embeddings = css.load_or_create_chunk_embeddings(docs)
+    docs = load_docstore()
+    try:
+        embeddings = css.load_or_create_chunk_embeddings(docs)
+    finally:
+        css.disable_encode_pool()
     print(f"Generated {len(embeddings)} chunked embeddings")
+    print(f"Encoded {css.last_sync['encoded']} new or changed chunks, reused {css.last_sync['reused']}, dropped {css.last_sync['dropped']}")
 
 
 
@@ -52,12 +65,28 @@ def cmd_embed_text(text):
 
 
 
-def cmd_search(query, limit):
-    ss = SemanticSearch()
-    
-    docs = load_movies()
-    ss.load_or_create_embeddings(docs)
-    results = ss.search(query, limit)
+def cmd_search(query, limit, ann="exact", nprobe=DEFAULT_IVF_NPROBE, ef_search=DEFAULT_HNSW_EF_SEARCH, quantization="none", oversample=DEFAULT_RESCORE_OVERSAMPLE, server=None):
+    if server:
+        #A running search server already has the model and embeddings loaded
+        results = query_server(server, "semantic_search", query, limit=limit)
+    else:
+        ss = SemanticSearch(quantization=quantization)
+
+        docs = load_docstore()
+        ss.load_or_create_embeddings(docs)
+        if quantization != "none":
+            ss.ann_index.oversample = oversample
+        if ann == "ivf":
+            ivf = ss.load_or_create_ivf()
+            ivf.nprobe = nprobe
+        elif ann == "hnsw":
+            try:
+                hnsw = ss.load_hnsw()
+            except (FileNotFoundError, ValueError) as e:
+                print(e)
+                return 1
+            hnsw.ef_search = ef_search
+        results = ss.search(query, limit)
 
     print(f"Query: {query}")
     print(f"Top {len(results)} results:")
@@ -67,12 +96,27 @@ def cmd_search(query, limit):
         print(f"{i}. {res['title']} (score: {res['score']:.4f})\n   {res['description'][:100]}...")
 
 
-def cmd_search_chunked(query, limit):
-    css = ChunkedSemanticSearch()
-    
-    docs = load_movies()
-    css.load_or_create_chunk_embeddings(docs)
-    results = css.search_chunks(query, limit)
+def cmd_search_chunked(query, limit, aggregation, top_n, ann="exact", nprobe=DEFAULT_IVF_NPROBE, ef_search=DEFAULT_HNSW_EF_SEARCH, quantization="none", oversample=DEFAULT_RESCORE_OVERSAMPLE, server=None):
+    if server:
+        results = query_server(server, "chunked_search", query, limit=limit, aggregation=aggregation, top_n=top_n)
+    else:
+        css = ChunkedSemanticSearch(quantization=quantization)
+
+        docs = load_docstore()
+        css.load_or_create_chunk_embeddings(docs)
+        if quantization != "none":
+            css.chunk_ann_index.oversample = oversample
+        if ann == "ivf":
+            ivf = css.load_or_create_chunk_ivf()
+            ivf.nprobe = nprobe
+        elif ann == "hnsw":
+            try:
+                hnsw = css.load_chunk_hnsw()
+            except (FileNotFoundError, ValueError) as e:
+                print(e)
+                return 1
+            hnsw.ef_search = ef_search
+        results = css.search_chunks(query, limit, aggregation, top_n)
 
     print(f"Query: {query}")
     print(f"Top {len(results)} results:")
@@ -83,6 +127,124 @@ def cmd_search_chunked(query, limit):
         print(f"   {res['document'][:100]}...")
 
 
+def cmd_batch(input_path, limit, chunks, aggregation, top_n, batch_size, quantization="none"):
+    #Load the model and embeddings once, then stream JSONL results for every query in the input
+    searcher = _load_searcher(chunks, quantization)
+    if chunks:
+        search_batch = lambda queries: searcher.search_chunks_many(queries, limit, aggregation, top_n)
+    else:
+        search_batch = lambda queries: searcher.search_many(queries, limit)
+    report_throughput(stream_results(read_queries(input_path), search_batch, batch_size))
+
+
+def _load_searcher(chunks, quantization="none"):
+    #Movie-level or chunk-level searcher with its embeddings loaded
+    docs = load_docstore()
+    if chunks:
+        css = ChunkedSemanticSearch(quantization=quantization)
+        css.load_or_create_chunk_embeddings(docs)
+        return css
+    ss = SemanticSearch(quantization=quantization)
+    ss.load_or_create_embeddings(docs)
+    return ss
+
+
+def _report_recall(vectors, k, num_queries, index, setting, values):
+    #Recall@k and latency of `index` against exact search, for each value of one query-time setting
+    #Use a fixed random sample of stored vectors as queries so runs are comparable
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+
+    start = time.perf_counter()
+    exact_ids = [exact_search(vectors, query, k)[0] for query in queries]
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    print(f"{'exact':>14}: recall@{k} 1.000  {exact_ms:8.3f} ms/query")
+    for value in values:
+        setattr(index, setting, value)
+        start = time.perf_counter()
+        approx_ids = [index.search(vectors, query, k)[0] for query in queries]
+        approx_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        recall = np.mean([recall_at_k(e, a) for e, a in zip(exact_ids, approx_ids)])
+        print(f"{f'{setting}={value}':>14}: recall@{k} {recall:.3f}  {approx_ms:8.3f} ms/query")
+
+
+def cmd_build_ivf(chunks, nlist):
+    searcher = _load_searcher(chunks)
+    if chunks:
+        ivf, path = searcher.load_or_create_chunk_ivf(nlist), searcher.chunk_ivf_path
+    else:
+        ivf, path = searcher.load_or_create_ivf(nlist), searcher.ivf_path
+
+    sizes = np.diff(ivf.list_offsets)
+    print(f"IVF index with {len(sizes)} lists over {len(ivf.list_ids)} vectors saved to {path}")
+    print(f"List sizes: min {sizes.min()}, mean {sizes.mean():.1f}, max {sizes.max()}")
+
+
+def cmd_ivf_recall(chunks, k, nprobes, num_queries, nlist):
+    searcher = _load_searcher(chunks)
+    if chunks:
+        vectors, ivf = searcher.chunk_embeddings, searcher.load_or_create_chunk_ivf(nlist)
+    else:
+        vectors, ivf = searcher.embeddings, searcher.load_or_create_ivf(nlist)
+
+    print(f"{min(num_queries, len(vectors))} queries, {len(vectors)} vectors, {len(ivf.centroids)} lists, k={k}")
+    _report_recall(vectors, k, num_queries, ivf, "nprobe", nprobes)
+
+
+def cmd_build_hnsw(chunks, m, ef_construction):
+    searcher = _load_searcher(chunks)
+    start = time.perf_counter()
+    if chunks:
+        hnsw, path = searcher.build_chunk_hnsw(m, ef_construction), searcher.chunk_hnsw_path
+    else:
+        hnsw, path = searcher.build_hnsw(m, ef_construction), searcher.hnsw_path
+
+    print(f"HNSW graph over {hnsw.num_nodes} vectors (M={hnsw.m}, ef_construction={hnsw.ef_construction}, {hnsw.max_level + 1} layers) saved to {path}")
+    print(f"Ready in {time.perf_counter() - start:.1f}s")
+
+
+def cmd_hnsw_recall(chunks, k, ef_searches, num_queries):
+    searcher = _load_searcher(chunks)
+    if chunks:
+        vectors, hnsw = searcher.chunk_embeddings, searcher.build_chunk_hnsw()
+    else:
+        vectors, hnsw = searcher.embeddings, searcher.build_hnsw()
+
+    print(f"{min(num_queries, len(vectors))} queries, {len(vectors)} vectors, M={hnsw.m}, k={k}")
+    _report_recall(vectors, k, num_queries, hnsw, "ef_search", ef_searches)
+
+
+def cmd_query_cache(clear, queries):
+    ss = SemanticSearch()
+    cache = ss.query_cache
+
+    if clear:
+        cache.clear()
+        print(f"Cleared query embedding cache at {cache.path}")
+        return
+
+    #Embed the given queries twice to show which tier answers them
+    for _ in range(2 if queries else 0):
+        ss.encode_queries(queries)
+    print(f"Query embedding cache: {cache.disk_entries()} entries on disk (max {cache.disk_size}) at {cache.path}")
+    if queries:
+        stats = cache.stats()
+        print(f"Memory hits: {stats['memory_hits']}, disk hits: {stats['disk_hits']}, misses: {stats['misses']} (hit rate {stats['hit_rate']:.1%})")
+
+
+def cmd_quantized_recall(chunks, mode, k, oversamples, num_queries):
+    searcher = _load_searcher(chunks, quantization=mode)
+    if chunks:
+        vectors, store = searcher.chunk_embeddings, searcher.chunk_ann_index
+    else:
+        vectors, store = searcher.embeddings, searcher.ann_index
+
+    print(f"{min(num_queries, len(vectors))} queries, {len(vectors)} vectors, {mode} codes, k={k}")
+    print(f"Memory: {store.nbytes() / 2**20:.1f} MiB quantized vs {vectors.nbytes / 2**20:.1f} MiB float32 (memory-mapped)")
+    _report_recall(vectors, k, num_queries, store, "oversample", oversamples)
+
+
 def cmd_semantic_chunk(text, max_chunk_size, overlap):    
     chunks = semantic_chunk(text, max_chunk_size, overlap)
 
@@ -92,16 +254,21 @@ def cmd_semantic_chunk(text, max_chunk_size, overlap):
 
 
 
-def cmd_verify_embeddings():
+def cmd_verify_embeddings(workers=1, batch_size=ENCODE_BATCH_SIZE):
     ss = SemanticSearch()
+    ss.enable_encode_pool(workers, batch_size)
 
-    #Load the documents from movies.json into a list.
-    documents = load_movies()
+    #Open the documents of movies.json (memory-mapped docstore)
+    documents = load_docstore()
 
-    embeddings = ss.load_or_create_embeddings(documents)
+    try:
+        embeddings = ss.load_or_create_embeddings(documents)
+    finally:
+        ss.disable_encode_pool()
 
     print(f"Number of docs:   {len(documents)}")
     print(f"Embeddings shape: {embeddings.shape[0]} vectors in {embeddings.shape[1]} dimensions")
+    print(f"Encoded {ss.last_sync['encoded']} new or changed documents, reused {ss.last_sync['reused']}, dropped {ss.last_sync['dropped']}")
 
 
 def cmd_verify_model():
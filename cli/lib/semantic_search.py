@@ -1,61 +1,131 @@
+import hashlib
 import json
 import numpy as np
 import os
 import re
-
-
-from .search_utils import CACHE_PATH, load_movies, format_search_result, DOCUMENT_PREVIEW_LENGTH
-from sentence_transformers import SentenceTransformer
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+
+from .search_utils import CACHE_PATH, ENCODE_BATCH_SIZE, EMBED_SHARD_SIZE, format_search_result, top_k_indices, DOCUMENT_PREVIEW_LENGTH, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_BATCH_WAIT_MS, DEFAULT_CHUNK_AGGREGATION, DEFAULT_CHUNK_TOP_N, ANN_CANDIDATE_MULTIPLIER
+from .ann import load_or_create_ivf, load_hnsw, build_hnsw
+from .embedding_cache import QueryEmbeddingCache
+from .batching import MicroBatcher
+from .encode_pool import EncodePool
+from .encode_planner import EncodePlanner
+from .docstore import DocStore
+from .quantization import QUANTIZATION_MODES, load_or_create_quantized_store
 from typing import List
 
 class SemanticSearch:
-    def __init__(self, model_name="all-MiniLM-L6-v2"):
-        self.document_map = {}
-        self.documents = None                               # Documents is a list of dictionaries, each representing a movie
-        self.embeddings = None
+    def __init__(self, model_name="all-MiniLM-L6-v2", quantization="none"):
+        if quantization not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization: {quantization} (expected one of {', '.join(QUANTIZATION_MODES)})")
+        self.quantization = quantization                    # "none" keeps embeddings in RAM; int8/binary keep quantized codes and memory-map the float32 rows
+        self.documents = None                               # DocStore (or list of movie dictionaries); row i is embedding row i
+        self.embeddings = None                              # L2-normalized float32 matrix (one row per document), memory-mapped when quantized
         self.embeddings_path = os.path.join(CACHE_PATH, "movie_embeddings.npy")
         self.embeddings_index_path = os.path.join(CACHE_PATH, "movie_embeddings_id_map.npy")
+        self.embeddings_manifest_path = os.path.join(CACHE_PATH, "movie_embeddings_manifest.json")
+        self.last_sync = None                               # Reused / encoded / dropped row counts of the last embeddings update
         self.id_to_index = {}                               # doc_id -> row index in embeddings        
-        self.model = SentenceTransformer(model_name)        # Load the model (downloads automatically the first time)
+        self.ann_index = None                               # Optional approximate nearest neighbour index over embeddings
+        self.ivf_path = os.path.join(CACHE_PATH, "movie_embeddings_ivf.npz")
+        self.hnsw_path = os.path.join(CACHE_PATH, "movie_embeddings_hnsw.npz")
+        self.model_name = model_name
+        self._model = None                                  # Loaded on first use, see the model property
+        self._model_lock = threading.Lock()
+        self.query_cache = QueryEmbeddingCache(model_name)  # Memory + on-disk cache of query embeddings, keyed by model and text
+        self.batcher = None                                 # Optional MicroBatcher coalescing concurrent queries, see enable_batching
+        self.encode_pool = None                             # Optional EncodePool of worker processes for embedding builds, see enable_encode_pool
+        self.encode_batch_size = ENCODE_BATCH_SIZE          # Texts per encode call when building embeddings
+
 
+    def build_embeddings(self, documents):
+        #Re-encode every document, ignoring whatever is cached
+        return self._update_embeddings(documents, reuse=False)
 
-    def build_embeddings(self, documents):        
+
+    def _update_embeddings(self, documents, reuse=True):
         self.documents = documents
 
-        doc_string_rep = []
+        #String representation of each movie, generated on the fly instead of kept in a list
+        doc_string_rep = TextStream(lambda: (f"{doc['title']}: {doc['description']}" for doc in documents))
 
-        
-        for doc in documents:
-            #Add each to self.document_map where the key is the ID and the value is the document
-            self.document_map[doc["id"]] = doc
-            #Add each to a list of string representations of the movies
-            doc_string_rep.append(f"{doc['title']}: {doc['description']}")
-    
-        #Use the model to encode the movie strings
-        embeddings = self.model.encode(doc_string_rep, show_progress_bar=True)
-        self.embeddings = embeddings 
+        #Encode only the movie strings whose content hash is not in the manifest yet
+        self.last_sync = sync_embeddings(self.embeddings_path, self.embeddings_manifest_path, doc_string_rep, self.model_name, self._encode_documents, reuse, batch_size=self.encode_batch_size)
 
         # map each doc_id to its row index in the embeddings array
-        self.id_to_index = {doc["id"]: i for i, doc in enumerate(documents)}
-
-        # save both embeddings and the id map
-        np.save(self.embeddings_path, embeddings)
+        ids = documents.ids.tolist() if isinstance(documents, DocStore) else [doc["id"] for doc in documents]
+        self.id_to_index = {doc_id: i for i, doc_id in enumerate(ids)}
+        #Always rewritten: reordered rows or renumbered movies change the map even when no embedding changed
         np.save(self.embeddings_index_path, self.id_to_index)
-   
+
+        self._open_embeddings()
         return self.embeddings
+
+
+    def _encode_documents(self, texts):
+        #Called once per encode_batch_size texts, so no per-call progress bar
+        if self.encode_pool is not None:
+            return self.encode_pool.encode(texts)
+        return self.model.encode(texts)
+
+
+    def enable_encode_pool(self, workers, batch_size=ENCODE_BATCH_SIZE, threads_per_worker=None):
+        #Spread every batch of an embedding build over `workers` processes, each with its own copy of the model
+        self.encode_batch_size = batch_size
+        if workers > 1:
+            self.encode_pool = EncodePool(self.model_name, workers, threads_per_worker)
+
+
+    def disable_encode_pool(self):
+        if self.encode_pool is not None:
+            self.encode_pool.close()
+            self.encode_pool = None
+
+
+    def _encode_queries(self, texts):
+        return self.model.encode(texts)
+
+
+    @property
+    def model(self):
+        #Importing sentence_transformers pulls in torch and takes seconds, and many commands never run
+        #the model (chunking, cached embeddings, cached query vectors), so both wait until first use
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)    # Downloads automatically the first time
+        return self._model
+
+
+    def _open_embeddings(self):
+        #Quantized modes hold only the compact codes in RAM and rescore candidates against the memory-mapped file
+        in_memory = self.quantization == "none"
+        self.embeddings = load_unit_rows(self.embeddings_path, in_memory)
+        if not in_memory:
+            self.ann_index = load_or_create_quantized_store(self.embeddings, self.embeddings_path, self.quantization)
     
 
 
     def generate_embedding(self, text):        
         if len(text.strip()) == 0:
             raise ValueError("text cannot be empty or white space")
-        
-        input_list = []  #The encode method expects a list of inputs
 
-        #For now, we only have a single term but add it to the list to allow .encode to operate
-        input_list.append(text)
+        if self.batcher is not None:
+            return self.batcher((text, None))
+        return self.encode_queries([text])[0]
+
 
-        return self.model.encode(input_list)[0]
+    def encode_queries(self, texts):
+        #Query embeddings, running the model only for texts that are not cached yet
+        return self.query_cache.get_or_encode(list(texts), self._encode_queries)
     
     def get_vector_for_id(self, doc_id):
         idx = self.id_to_index[doc_id]
@@ -64,164 +134,295 @@ class SemanticSearch:
    
 
     def search(self, query, limit):
-        if len(self.embeddings) == 0:
-            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+        if self.batcher is not None:
+            if len(query.strip()) == 0:
+                raise ValueError("text cannot be empty or white space")
+            return self.batcher((query, limit))
 
         #Generate embedding 
         query_embedding = self.generate_embedding(query)
+        return self.search_vectors(query_embedding[np.newaxis, :], limit)[0]
+
+
+    def search_many(self, queries, limit):
+        #Encode every query in one model call, then score them all together
+        if any(len(query.strip()) == 0 for query in queries):
+            raise ValueError("text cannot be empty or white space")
+        return self.search_vectors(self.encode_queries(queries), limit)
+
+
+    def search_vectors(self, query_embeddings, limit):
+        if self.embeddings is None or len(self.embeddings) == 0:
+            raise ValueError("No embeddings loaded. Call `load_or_create_embeddings` first.")
+
+        all_results = []
+        for ids, scores in self.nearest_rows(normalize_rows(query_embeddings), limit):
+            #Rows come back highest similarity first
+            results = []
+            for i, score in zip(ids, scores):
+                doc = self.documents[i]
+                results.append(
+                    {
+                        "score": float(score),
+                        "title": doc["title"],
+                        "description": doc["description"],
+                    }
+                )
+            all_results.append(results)
 
-        similarity_list = []
-
-        #Calculate cosine similarity between the query embedding and each document embedding
-        #for doc in self.documents:
-        #    doc_id = doc["id"]
-        #    doc_vec = self.get_vector_for_id(doc_id)
-        #    score = cosine_similarity(query_embedding, doc_vec)
-        #    #Create a list of (similarity_score, document) tuples
-        #    similarity_list.append(
-        #        {
-        #            "score": float(score),
-        #            "title": doc["title"],
-        #            "description": doc["description"],
-        #        }
-        #    )
-        #Sort by similarity, descending
-        #similarity_list.sort(key=lambda x: x["score"], reverse=True)
-        #Return top `limit` results
-        #return similarity_list[:limit]
-
-        for i, doc_embedding in enumerate(self.embeddings):
-            similarity = cosine_similarity(query_embedding, doc_embedding)
-            similarity_list.append((similarity, self.documents[i]))
-
-        #Sort by similarity, descending
-        similarity_list.sort(key=lambda x: x["score"], reverse=True)
+        return all_results
 
+
+    def nearest_rows(self, query_embeddings, limit):
+        #Top `limit` (row indices, scores) for each unit-length query vector
+        if self.ann_index is not None:
+            return [self.ann_index.search(self.embeddings, query, limit) for query in query_embeddings]
+
+        #Document rows are already unit length, so cosine similarity is a plain dot product:
+        #one (queries x dims) @ (dims x docs) matrix multiply scores every query against every document
+        similarities = query_embeddings @ self.embeddings.T
         results = []
-        for score, doc in similarity_list[:limit]:
-            results.append(
-                {
-                    "score": score,
-                    "title": doc["title"],
-                    "description": doc["description"],
-                }
-            )
+        for query_similarities in similarities:
+            ids = top_k_indices(query_similarities, limit)
+            results.append((ids, query_similarities[ids]))
+        return results
+
+
+    def enable_batching(self, max_batch=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_BATCH_WAIT_MS):
+        #Concurrent generate_embedding / search calls from other threads are queued and handled together:
+        #one model call encodes the whole batch and one matrix product scores its searches
+        self.batcher = MicroBatcher(self._run_batch, max_batch, max_wait_ms, name="query-batcher")
+        return self.batcher
+
+
+    def _run_batch(self, requests):
+        #requests are (text, limit) pairs; limit None asks for the embedding only
+        embeddings = self.encode_queries([text for text, _ in requests])
+        results = list(embeddings)
 
+        searches = [i for i, (_, limit) in enumerate(requests) if limit is not None]
+        if searches:
+            #Rank every search by the largest limit asked for and cut each one down to its own
+            found = self.search_vectors(embeddings[searches], max(requests[i][1] for i in searches))
+            for i, rows in zip(searches, found):
+                results[i] = rows[:requests[i][1]]
         return results
+
+
+    def disable_batching(self):
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+
+    def load_or_create_ivf(self, nlist=None):
+        #Approximate search over the movie embeddings through an IVF index cached next to them
+        self.ann_index = load_or_create_ivf(self.embeddings, self.embeddings_path, self.ivf_path, nlist)
+        return self.ann_index
+
+
+    def load_hnsw(self):
+        #Approximate search over the movie embeddings through the HNSW graph cached next to them (see build_hnsw)
+        self.ann_index = load_hnsw(self.embeddings, self.embeddings_path, self.hnsw_path)
+        return self.ann_index
+
+
+    def build_hnsw(self, m=None, ef_construction=None):
+        #Extend the cached HNSW graph with appended movies, or rebuild it if older rows or the parameters changed
+        self.ann_index = build_hnsw(self.embeddings, self.embeddings_path, self.hnsw_path, m, ef_construction)
+        return self.ann_index
         
     
     def load_or_create_embeddings(self, documents):
-        self.documents = documents
+        #Reuse cached rows whose content hash is unchanged; new or edited movies are encoded and spliced in
+        return self._update_embeddings(documents)
+    
 
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
+# Rows copied per step when splicing cached and re-encoded embeddings into a new matrix
+SPLICE_BLOCK_SIZE = 65536
+
+# sha256 digest of a text, as kept per row in embedding manifests and checkpoints
+HASH_DTYPE = np.dtype("S32")
+
+# Ways of turning a movie's chunk scores into one movie score
+CHUNK_AGGREGATIONS = ("max", "mean", "top_n_sum")
 
-        # Raise an error if the files don't exist
-        if os.path.exists(self.embeddings_path):
-            self.embeddings = np.load(self.embeddings_path)           
-            if len(self.embeddings) == len(documents):
-                self.id_to_index = np.load(self.embeddings_index_path, allow_pickle=True).item()
-                return self.embeddings
-        
-        # Length does not match, rebuild
-        return self.build_embeddings(documents)
-    
 
 class ChunkedSemanticSearch(SemanticSearch):
-    def __init__(self, model_name = "all-MiniLM-L6-v2") -> None:
-        super().__init__(model_name = model_name)
-        self.chunk_embeddings = None
-        self.chunk_metadata = None
+    def __init__(self, model_name = "all-MiniLM-L6-v2", quantization = "none") -> None:
+        super().__init__(model_name = model_name, quantization = quantization)
+        self.chunk_embeddings = None        # L2-normalized float32 matrix, rows grouped by movie (memory-mapped when quantized)
+        self.chunk_metadata = None          # "movie_idx", "chunk_idx" and "total_chunks" arrays, one entry per chunk row
+        # Parallel per-chunk arrays, sorted by (movie_idx, chunk_idx) so each movie's chunks are contiguous
+        self.chunk_movie_idx = None
+        self.chunk_idx = None
+        # One entry per movie that has chunks: first chunk row and the movie index
+        self.movie_chunk_starts = None
+        self.movie_chunk_movies = None
         self.chunk_embeddings_path = os.path.join(CACHE_PATH, "chunk_embeddings.npy")
         self.chunk_metadata_path = os.path.join(CACHE_PATH, "chunk_metadata.json")
+        self.chunk_manifest_path = os.path.join(CACHE_PATH, "chunk_embeddings_manifest.json")
+        self.chunk_ann_index = None         # Optional approximate nearest neighbour index over chunk_embeddings
+        self.chunk_ivf_path = os.path.join(CACHE_PATH, "chunk_embeddings_ivf.npz")
+        self.chunk_hnsw_path = os.path.join(CACHE_PATH, "chunk_embeddings_hnsw.npz")
 
 
-    def build_chunk_embeddings(self, documents):        
+    def build_chunk_embeddings(self, documents):
+        #Re-encode every chunk, ignoring whatever is cached
+        return self._update_chunk_embeddings(documents, reuse=False)
+
+
+    def _update_chunk_embeddings(self, documents, reuse=True):
         self.documents = documents
 
-        doc_string_rep = []
-        all_chunks = []     #list of all chunk strings across all documents
-        chunk_metadata = [] #list of dictionaries
-        
+        #One pass over the movies records where each chunk comes from and its content hash; the chunk strings
+        #themselves are regenerated by iter_chunks while encoding, so they are never all held in memory
+        movie_idx, chunk_idx, total_chunks = array("i"), array("i"), array("i")
+        hashes = bytearray()
+        for m, c, total, chunk in iter_chunks(documents):
+            movie_idx.append(m)
+            chunk_idx.append(c)
+            total_chunks.append(total)
+            hashes += content_hash(chunk)
+
+        #Use the model to encode the chunks that are new or changed since the last update
+        all_chunks = TextStream(lambda: (chunk for *_, chunk in iter_chunks(documents)))
+        self.last_sync = sync_embeddings(self.chunk_embeddings_path, self.chunk_manifest_path, all_chunks, self.model_name, self._encode_documents, reuse, np.frombuffer(hashes, dtype=HASH_DTYPE), self.encode_batch_size)
+
+        #Save the chunk metadata
+        self.chunk_metadata = {
+            "movie_idx": np.frombuffer(movie_idx, dtype=np.int32),
+            "chunk_idx": np.frombuffer(chunk_idx, dtype=np.int32),
+            "total_chunks": np.frombuffer(total_chunks, dtype=np.int32),
+        }
+        write_chunk_metadata(self.chunk_metadata_path, self.chunk_metadata)
+
+        self._open_chunk_embeddings()
+        return self.chunk_embeddings
 
-        # Documents is a list of dictionaries, each representing a movie
-        for movie_idx, doc in enumerate(documents):
-            description = doc["description"]
-            #If description is empty, skip this movie
-            if not description.strip():
-                continue
-
-            #4 sentence chunks, with 1 sentence overlap
-            chunks = semantic_chunk(description, 4, 1)
-
-            #For each chunk, add a dictionary to the chunk metadata list with:
-            for chunk_idx, chunk in enumerate(chunks):
-                all_chunks.append(chunk)
-                chunk_metadata.append({
-                    "movie_idx": movie_idx,
-                    "chunk_idx": chunk_idx,
-                    "total_chunks": len(chunks) #Total number of chunks in the document
-                })
-                
-            
-        #Use the model to encode the chunks                
-        self.chunk_embeddings = self.model.encode(all_chunks, show_progress_bar=True)
-        
-        #Save the chunk metadata 
-        self.chunk_metadata = chunk_metadata
 
-        # save both embeddings and the id map
-        np.save(self.chunk_embeddings_path, self.chunk_embeddings)
-        with open(self.chunk_metadata_path, "w") as f:
-            json.dump({"chunks": chunk_metadata, "total_chunks": len(all_chunks)}, f, indent=2)
+    def _open_chunk_embeddings(self):
+        in_memory = self.quantization == "none"
+        self._set_chunk_arrays(load_unit_rows(self.chunk_embeddings_path, in_memory), self.chunk_metadata)
+        if not in_memory:
+            self.chunk_ann_index = load_or_create_quantized_store(self.chunk_embeddings, self.chunk_embeddings_path, self.quantization)
 
-        return self.chunk_embeddings
+
+    def _set_chunk_arrays(self, chunk_embeddings, chunk_metadata):
+        movie_idx, chunk_idx = chunk_metadata["movie_idx"], chunk_metadata["chunk_idx"]
+
+        #Group each movie's chunks together (a no-op for files written by build_chunk_embeddings)
+        order = np.lexsort((chunk_idx, movie_idx))
+        self.chunk_movie_idx = movie_idx[order]
+        self.chunk_idx = chunk_idx[order]
+        if np.array_equal(order, np.arange(len(order))):
+            #Keep a memory-mapped matrix mapped instead of copying it
+            self.chunk_embeddings = chunk_embeddings
+        else:
+            self.chunk_embeddings = np.ascontiguousarray(chunk_embeddings[order])
+
+        #A new movie starts wherever movie_idx changes
+        is_start = np.ones(len(order), dtype=bool)
+        is_start[1:] = self.chunk_movie_idx[1:] != self.chunk_movie_idx[:-1]
+        self.movie_chunk_starts = np.flatnonzero(is_start)
+        self.movie_chunk_movies = self.chunk_movie_idx[self.movie_chunk_starts]
+
+
+    def load_or_create_chunk_ivf(self, nlist=None):
+        #Approximate search over the chunk embeddings through an IVF index cached next to them
+        self.chunk_ann_index = load_or_create_ivf(self.chunk_embeddings, self.chunk_embeddings_path, self.chunk_ivf_path, nlist)
+        return self.chunk_ann_index
+
+
+    def load_chunk_hnsw(self):
+        #Approximate search over the chunk embeddings through the HNSW graph cached next to them (see build_chunk_hnsw)
+        self.chunk_ann_index = load_hnsw(self.chunk_embeddings, self.chunk_embeddings_path, self.chunk_hnsw_path)
+        return self.chunk_ann_index
+
+
+    def build_chunk_hnsw(self, m=None, ef_construction=None):
+        #Extend the cached chunk HNSW graph with appended chunks, or rebuild it if older rows or the parameters changed
+        self.chunk_ann_index = build_hnsw(self.chunk_embeddings, self.chunk_embeddings_path, self.chunk_hnsw_path, m, ef_construction)
+        return self.chunk_ann_index
+
+
+    def aggregate_chunk_scores(self, chunk_scores, aggregation=DEFAULT_CHUNK_AGGREGATION, top_n=DEFAULT_CHUNK_TOP_N, starts=None):
+        #Segmented reduction of per-chunk scores into one score per movie (aligned with movie_chunk_movies,
+        #or with the given run starts when only some movies' chunks were scored)
+        if starts is None:
+            starts = self.movie_chunk_starts
+        if len(starts) == 0:
+            return np.zeros(0, dtype=chunk_scores.dtype)   #reduceat rejects an empty set of runs
+        if aggregation == "max":
+            return np.maximum.reduceat(chunk_scores, starts)
+
+        counts = np.diff(np.append(starts, len(chunk_scores)))
+        if aggregation == "mean":
+            return np.add.reduceat(chunk_scores, starts) / counts
+
+        if aggregation == "top_n_sum":
+            #Sort scores descending within each movie, then keep the first top_n of every run
+            movie_of_chunk = np.repeat(np.arange(len(starts)), counts)
+            order = np.lexsort((-chunk_scores, movie_of_chunk))
+            rank_in_movie = np.arange(len(chunk_scores)) - np.repeat(starts, counts)
+            kept = np.where(rank_in_movie < top_n, chunk_scores[order], 0)
+            return np.add.reduceat(kept, starts)
+
+        raise ValueError(f"Unknown chunk aggregation: {aggregation} (expected one of {', '.join(CHUNK_AGGREGATIONS)})")
     
 
-    def search_chunks(self, query: str, limit: int=10):
+    def search_chunks(self, query: str, limit: int=10, aggregation: str=DEFAULT_CHUNK_AGGREGATION, top_n: int=DEFAULT_CHUNK_TOP_N):
+        if self.chunk_embeddings is None or len(self.chunk_embeddings) == 0:
+            return []
+
         #Generate an embedding of the query using the method from SemanticSearch
         query_embedding = self.generate_embedding(query)
-        
-        #Populate an empty list to store chunk_score dictionaries
-        chunk_scores = []
-        
-        #For each chunk embedding
-        for i, chunk_embedding in enumerate(self.chunk_embeddings):
-            #Calculate the cosine similarity between the chunk embedding and the query embedding            
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-
-            chunk_metadata = self.chunk_metadata[i]
-
-            #Append a dictionary to the chunk score list with fields
-            chunk_scores.append({
-                "chunk_idx": chunk_metadata["chunk_idx"],
-                "movie_idx": chunk_metadata["movie_idx"],
-                "score": similarity         #Cosine similarity score
-             })
-
-        #Create an empty dictionary that maps movie indexes to their scores
-        movie_scores = {}
-
-        #For each chunk score 
-        for chunk_score in chunk_scores:
-            #if the movie-idx is not in the movie score dictionary yet, or the new score is higher than the existing one
-            #update the movie score dictionary with the new chunk score
-            movie_idx = chunk_score["movie_idx"]
-            score = chunk_score["score"]
-
-            if movie_idx not in movie_scores or score > movie_scores[movie_idx]:
-                movie_scores[movie_idx] = score
-
-        #Sort the movie scores by score, descending
-        sorted_movies = sorted(
-            movie_scores.items(),  # gives (movie_idx, score)
-            key=lambda item: item[1],  # sort by score
-            reverse=True,
-        )
-        
-        
+
+        query_embedding = normalize_rows(query_embedding)
+        return self.search_chunks_vector(query_embedding, limit, aggregation, top_n)
+
+
+    def search_chunks_many(self, queries, limit=10, aggregation=DEFAULT_CHUNK_AGGREGATION, top_n=DEFAULT_CHUNK_TOP_N):
+        #Encode every query in one model call; without an ANN index one matrix product scores every chunk against all of them
+        if self.chunk_embeddings is None or len(self.chunk_embeddings) == 0:
+            return [[] for _ in queries]
+        if any(len(query.strip()) == 0 for query in queries):
+            raise ValueError("text cannot be empty or white space")
+        query_embeddings = normalize_rows(self.encode_queries(queries))
+
+        if self.chunk_ann_index is not None:
+            return [self.search_chunks_vector(query_embedding, limit, aggregation, top_n) for query_embedding in query_embeddings]
+
+        movies = np.arange(len(self.movie_chunk_starts))
+        chunk_scores = self.chunk_embeddings @ query_embeddings.T   # (chunks x queries)
+        return [
+            self._movie_results(movies, self.aggregate_chunk_scores(np.ascontiguousarray(chunk_scores[:, j]), aggregation, top_n), limit)
+            for j in range(len(queries))
+        ]
+
+
+    def search_chunks_vector(self, query_embedding, limit=10, aggregation=DEFAULT_CHUNK_AGGREGATION, top_n=DEFAULT_CHUNK_TOP_N):
+        #search_chunks for an already encoded, unit-length query
+        if self.chunk_ann_index is not None:
+            #Only the movies owning the approximate nearest chunks are scored
+            candidate_rows, _ = self.chunk_ann_index.search(self.chunk_embeddings, query_embedding, limit * ANN_CANDIDATE_MULTIPLIER)
+            if len(candidate_rows) == 0:
+                return []   #e.g. IVF with every probed list empty
+            movies = np.unique(np.searchsorted(self.movie_chunk_starts, candidate_rows, side="right") - 1)
+        else:
+            movies = np.arange(len(self.movie_chunk_starts))
+        return self._movie_results(movies, self.score_movies(query_embedding, movies, aggregation, top_n), limit)
+
+
+    def _movie_results(self, movies, movie_scores, limit):
+        #Select the top `limit` movies by score, descending (ties go to the lower movie index)
+        top_movies = [
+            (int(self.movie_chunk_movies[movies[i]]), float(movie_scores[i]))
+            for i in top_k_indices(movie_scores, limit)
+        ]
+
         results = []
-        for movie_idx, score in sorted_movies[:limit]:
+        for movie_idx, score in top_movies:
             doc = self.documents[movie_idx]
             metadata = {}
 
@@ -241,26 +442,373 @@ class ChunkedSemanticSearch(SemanticSearch):
     
 
 
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        self.documents = documents
+    def score_movies(self, query_embedding, movies, aggregation=DEFAULT_CHUNK_AGGREGATION, top_n=DEFAULT_CHUNK_TOP_N):
+        #Exact aggregated score for the given movie runs (indices into movie_chunk_starts, ascending)
+        if len(movies) == len(self.movie_chunk_starts):
+            #Chunk rows are unit length, so one matrix-vector product gives every chunk's cosine similarity
+            chunk_scores = self.chunk_embeddings @ query_embedding
+            return self.aggregate_chunk_scores(chunk_scores, aggregation, top_n)
+
+        #Gather just the chunk rows of the selected movies; their runs stay contiguous
+        ends = np.append(self.movie_chunk_starts[1:], len(self.chunk_embeddings))
+        counts = ends[movies] - self.movie_chunk_starts[movies]
+        sub_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        rows = np.repeat(self.movie_chunk_starts[movies] - sub_starts, counts) + np.arange(counts.sum())
+        chunk_scores = self.chunk_embeddings[rows] @ query_embedding
+        return self.aggregate_chunk_scores(chunk_scores, aggregation, top_n, starts=sub_starts)
+
+
+    def load_or_create_chunk_embeddings(self, documents) -> np.ndarray:
+        #Chunking is cheap, so the chunks are always recomputed and checked against the manifest;
+        #only chunks whose text is not cached yet are encoded
+        return self._update_chunk_embeddings(documents)
+
 
-        for doc in documents:
-            #Add each to self.document_map where the key is the ID and the value is the document
-            self.document_map[doc["id"]] = doc
-        
-        #If the embeddings and metadata already exist, return them
-        if os.path.exists(self.chunk_embeddings_path) and os.path.exists(self.chunk_metadata_path):
-            self.chunk_embeddings = np.load(self.chunk_embeddings_path)           
-            with open(self.chunk_metadata_path, "r") as f:            
-                metadata_json = json.load(f)
-            
-            self.chunk_metadata = metadata_json["chunks"]
 
-            return self.chunk_embeddings
+def normalize_rows(matrix) -> np.ndarray:
+    #Scale every row to unit L2 norm and return a contiguous float32 matrix (all-zero rows stay zero)
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms)
 
-        #Files don't exist, rebuild the chunk embeddings and metadata
-        return self.build_chunk_embeddings(documents)
 
+def content_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+def content_hashes(texts) -> np.ndarray:
+    #Digests of all texts packed into one HASH_DTYPE array instead of a list of Python objects
+    packed = bytearray()
+    for text in texts:
+        packed += content_hash(text)
+    return np.frombuffer(packed, dtype=HASH_DTYPE)
+
+
+def find_rows(table, keys) -> np.ndarray:
+    #Row of `table` holding each key, or -1 where the key is not in it (a sort plus a binary search, no dict)
+    if not len(table):
+        return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(table, kind="stable")
+    pos = np.minimum(np.searchsorted(table[order], keys), len(table) - 1)
+    return np.where(table[order[pos]] == keys, order[pos], -1).astype(np.int64)
+
+
+class TextStream:
+    """Re-iterable texts produced on demand, so a corpus can be read more than once without a list of it"""
+
+    def __init__(self, make_iter):
+        self.make_iter = make_iter      # Returns a fresh iterator over the texts on every call
+
+    def __iter__(self):
+        return self.make_iter()
+
+
+def iter_chunks(documents):
+    #(movie_idx, chunk_idx, total_chunks, chunk) for every chunk of every movie, in order
+    for movie_idx, doc in enumerate(documents):
+        description = doc["description"]
+        #If description is empty, skip this movie
+        if not description.strip():
+            continue
+
+        #4 sentence chunks, with 1 sentence overlap
+        chunks = semantic_chunk(description, 4, 1)
+        for chunk_idx, chunk in enumerate(chunks):
+            yield movie_idx, chunk_idx, len(chunks), chunk
+
+
+def write_chunk_metadata(path, metadata):
+    #Write chunk_metadata.json one chunk at a time, in the layout json.dump(..., indent=2) produces.
+    #The new file only replaces the old one if its content differs.
+    count = len(metadata["movie_idx"])
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".json.tmp")
+    digest = hashlib.sha256()
+    try:
+        with os.fdopen(fd, "w") as f:
+            def write(text):
+                f.write(text)
+                digest.update(text.encode("utf-8"))
+
+            write('{\n  "chunks": [' if count else '{\n  "chunks": [],\n')
+            columns = zip(metadata["movie_idx"].tolist(), metadata["chunk_idx"].tolist(), metadata["total_chunks"].tolist())
+            for i, (movie_idx, chunk_idx, total) in enumerate(columns):
+                write(("," if i else "") + f'\n    {{\n      "movie_idx": {movie_idx},\n      "chunk_idx": {chunk_idx},\n      "total_chunks": {total}\n    }}')
+            write(f'\n  ],\n  "total_chunks": {count}\n}}' if count else f'  "total_chunks": {count}\n}}')
+
+        if file_digest(path) == digest.hexdigest():
+            os.unlink(tmp_path)
+            return
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def file_digest(path):
+    try:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except OSError:
+        return None
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class EmbeddingCheckpoint:
+    """Shards of newly encoded embeddings kept on disk while a build runs, so an interrupted build can resume
+
+    Every shard holds the unit vectors of a run of new texts (shard-NNNNN.npy) and their content hashes
+    (shard-NNNNN-hashes.npy); progress.json lists the completed shards and the model that encoded them. A
+    later build with the same model takes any text whose hash is in a completed shard from there instead of
+    encoding it again. The directory is removed once the final matrix has been written.
+    """
+
+    def __init__(self, directory, model_name):
+        self.directory = directory
+        self.model_name = model_name
+        self.shards = []        # Names of the completed shards, in order
+        self.vectors = []       # Memory-mapped matrix of each completed shard
+        self.hashes = []        # Memory-mapped content hashes of each completed shard, one per vector
+
+        progress = _read_json(self._path("progress.json"))
+        if progress and progress.get("model") == model_name:
+            try:
+                for name in progress["shards"]:
+                    self._add(name, np.load(self._path(f"{name}.npy"), mmap_mode="r"), np.load(self._path(f"{name}-hashes.npy"), mmap_mode="r"))
+            except (OSError, ValueError, TypeError):
+                self.clear()    #Damaged checkpoint: start over
+        elif os.path.exists(directory):
+            self.clear()
+
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _add(self, name, vectors, hashes):
+        if len(vectors) != len(hashes) or hashes.dtype != HASH_DTYPE:
+            raise ValueError(f"Shard {name} has {len(vectors)} vectors for {len(hashes)} hashes")
+        self.shards.append(name)
+        self.vectors.append(vectors)
+        self.hashes.append(hashes)
+
+    def dim(self):
+        return self.vectors[0].shape[1] if self.vectors else None
+
+    def locate(self, hashes) -> tuple[np.ndarray, np.ndarray]:
+        #(shard number, row in that shard) of each hash; shard is -1 where no completed shard holds it
+        found = find_rows(np.concatenate(self.hashes) if self.hashes else np.empty(0, dtype=HASH_DTYPE), hashes)
+        sizes = np.array([len(h) for h in self.hashes], dtype=np.int64)
+        ends = np.cumsum(sizes)
+        shards, rows = np.full(len(found), -1, dtype=np.int64), np.full(len(found), -1, dtype=np.int64)
+        hit = found >= 0
+        shards[hit] = np.searchsorted(ends, found[hit], side="right")
+        rows[hit] = found[hit] - (ends - sizes)[shards[hit]]
+        return shards, rows
+
+    def save_shard(self, vectors, hashes):
+        #Shard files first, then the progress file that makes the shard count as completed
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"shard-{len(self.shards):05d}"
+        save_npy(self._path(f"{name}.npy"), vectors)
+        save_npy(self._path(f"{name}-hashes.npy"), hashes)
+        self._add(name, np.load(self._path(f"{name}.npy"), mmap_mode="r"), np.load(self._path(f"{name}-hashes.npy"), mmap_mode="r"))
+        save_json(self._path("progress.json"), {"model": self.model_name, "shards": self.shards})
+
+    def clear(self):
+        self.shards, self.vectors, self.hashes = [], [], []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class EncodeProgress:
+    """Throughput and ETA of an embedding build, reported to stderr after every shard"""
+
+    def __init__(self, total, out=None):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+        self.out = out or sys.stderr
+
+    def update(self, count):
+        self.done += count
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        print(f"Encoded {self.done}/{self.total} texts ({rate:.1f} docs/s, ETA {time.strftime('%H:%M:%S', time.gmtime(eta))})", file=self.out, flush=True)
+
+
+def checkpoint_dir(path):
+    #Shards of an in-progress build of x.npy live in x_shards/
+    return os.path.splitext(path)[0] + "_shards"
+
+
+def manifest_hashes_path(manifest_path):
+    #Per-row content hashes of the manifest x.json live in x_hashes.npy
+    return os.path.splitext(manifest_path)[0] + "_hashes.npy"
+
+
+def load_manifest_hashes(manifest, manifest_path):
+    #Content hash of every row of the matrix a manifest describes, or None if they are missing or damaged
+    if isinstance(manifest.get("hashes"), list):
+        #Manifests of older builds listed the hashes inline, as hex
+        return np.array([bytes.fromhex(h) for h in manifest["hashes"]], dtype=HASH_DTYPE)
+    try:
+        hashes = np.load(manifest_hashes_path(manifest_path), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if hashes.dtype != HASH_DTYPE or hashlib.sha256(hashes).hexdigest() != manifest.get("hashes_digest"):
+        return None     #Not the hashes file this manifest was saved with
+    return hashes
+
+
+def sync_embeddings(path, manifest_path, texts, model_name, encode, reuse=True, hashes=None, batch_size=ENCODE_BATCH_SIZE, shard_size=EMBED_SHARD_SIZE) -> dict:
+    #Make the .npy at `path` hold the unit-length embedding of every text, in order.
+    #The manifest next to it records the model and dimension, and its hashes file the per-row content hash,
+    #so rows whose text is unchanged are copied from the existing matrix and only new or edited texts are encoded.
+    #`texts` is read twice (hashes, then the texts to encode) and may be a TextStream. Hashes are kept as
+    #one HASH_DTYPE array and matched by sorting, so bookkeeping costs 32 bytes and a few int64s per text.
+    #Repeated texts are encoded once; new texts are encoded batch_size at a time in length order (see
+    #EncodePlanner) and checkpointed every shard_size texts (see EmbeddingCheckpoint),
+    #so a killed build loses at most one shard of work. Checkpoints are used even when reuse=False:
+    #they only ever hold vectors this model encoded for those exact texts.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hashes = content_hashes(texts) if hashes is None else np.asarray(hashes, dtype=HASH_DTYPE)
+    manifest = _read_json(manifest_path) if reuse else None
+
+    old = old_hashes = None
+    if manifest and manifest.get("model") == model_name and os.path.exists(path):
+        old = np.load(path, mmap_mode="r")
+        old_hashes = load_manifest_hashes(manifest, manifest_path)
+        if old_hashes is None or len(old) != len(old_hashes) or old.ndim != 2 or old.shape[1] != manifest["dim"]:
+            old = old_hashes = None     #Manifest and matrix disagree: trust neither
+        elif np.array_equal(old_hashes, hashes):
+            shutil.rmtree(checkpoint_dir(path), ignore_errors=True)     #Left behind if the last build stopped right after finishing
+            return {"reused": len(hashes), "encoded": 0, "dropped": 0, "resumed": 0}
+
+    #Embeddings depend only on the text, so any old row with the same hash can be reused
+    sources = find_rows(old_hashes, hashes) if old is not None else np.full(len(hashes), -1, dtype=np.int64)
+    missing = np.flatnonzero(sources < 0)
+    _, first = np.unique(hashes[missing], return_index=True)
+    new_rows = np.sort(missing[first])      #First occurrence of every hash that has to come from somewhere else
+
+    #Texts encoded by an interrupted earlier build are taken from its checkpoint
+    checkpoint = EmbeddingCheckpoint(checkpoint_dir(path), model_name)
+    pending = new_rows[checkpoint.locate(hashes[new_rows])[0] < 0]
+    resumed = len(new_rows) - len(pending)
+    if resumed:
+        print(f"Resuming: {resumed} of {len(new_rows)} new texts already encoded in {len(checkpoint.shards)} shards", file=sys.stderr)
+
+    #Encode the pending rows, shard_size texts at a time; the planner encodes each shard in
+    #length-sorted batches to cut padding
+    progress = EncodeProgress(len(pending))
+    planner = EncodePlanner(batch_size)
+    planner.add_duplicates(len(missing) - len(new_rows))
+    todo = iter(pending.tolist())
+    target = next(todo, None)
+    shard_texts, shard_rows = [], []
+    for row, text in enumerate(texts if target is not None else ()):
+        if row != target:
+            continue
+        shard_texts.append(text)
+        shard_rows.append(row)
+        target = next(todo, None)
+        if len(shard_texts) == shard_size or target is None:
+            checkpoint.save_shard(normalize_rows(planner.encode(shard_texts, encode)), hashes[shard_rows])
+            progress.update(len(shard_texts))
+            progress.report()
+            shard_texts, shard_rows = [], []
+        if target is None:
+            break
+    if len(pending):
+        planner.report()
+
+    #Assemble reused rows from the old matrix and new rows from the shards into a new file, then swap it in
+    dim = old.shape[1] if old is not None else checkpoint.dim() or 0
+    shards, shard_offsets = checkpoint.locate(hashes[missing])
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy.tmp")
+    os.close(fd)
+    try:
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(hashes), dim))
+        for start in range(0, len(hashes), SPLICE_BLOCK_SIZE):
+            block = sources[start:start + SPLICE_BLOCK_SIZE]
+            reused = block >= 0
+            if reused.any():
+                matrix[start:start + len(block)][reused] = old[block[reused]]
+            lo, hi = np.searchsorted(missing, [start, start + len(block)])
+            for shard in np.unique(shards[lo:hi]).tolist():
+                take = lo + np.flatnonzero(shards[lo:hi] == shard)
+                matrix[missing[take]] = checkpoint.vectors[shard][shard_offsets[take]]
+        matrix.flush()
+        del matrix
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    #Hashes file first: the manifest's digest of it is what makes it count as this matrix's hashes
+    save_npy(manifest_hashes_path(manifest_path), hashes)
+    save_json(manifest_path, {"model": model_name, "dim": dim, "hashes_digest": hashlib.sha256(hashes).hexdigest()})
+    checkpoint.clear()
+    return {
+        "reused": int((sources >= 0).sum()),
+        "encoded": len(new_rows),
+        #Old rows whose text is gone from the new texts, i.e. embeddings thrown away
+        "dropped": int((find_rows(hashes, old_hashes) < 0).sum()) if old is not None else 0,
+        "resumed": resumed,
+    }
+
+
+def save_json(path, data):
+    #Atomic replace, like save_npy
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".json.tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def has_unit_rows(matrix, sample_size=64) -> bool:
+    #Spot-check the first rows: embeddings written by older builds were stored unnormalized
+    norms = np.linalg.norm(np.asarray(matrix[:sample_size], dtype=np.float32), axis=-1)
+    return bool(np.all((np.abs(norms - 1) < 1e-3) | (norms == 0)))
+
+
+def save_npy(path, array):
+    #Write to a temporary file and rename it into place, so readers never see a partial file and
+    #existing memory maps of the old file stay valid
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_unit_rows(path, in_memory=True) -> np.ndarray:
+    #L2-normalized float32 rows from an .npy file, either copied into RAM or left memory-mapped
+    matrix = np.load(path, mmap_mode="r")
+    if matrix.dtype != np.float32 or not has_unit_rows(matrix):
+        #Upgrade an older cache file in place once, so later loads can map it directly
+        save_npy(path, normalize_rows(matrix))
+        matrix = np.load(path, mmap_mode="r")
+    return np.ascontiguousarray(matrix) if in_memory else matrix
 
 
 def cosine_similarity(vec1, vec2):
@@ -290,22 +838,22 @@ def semantic_chunk(text, max_chunk_size, overlap) -> list[str]:
     if len(sentences) == 1 and not text.endswith((".", "!", "?")):
         sentences = [text]
 
-        chunks = []
-        i = 0
-        n_sentences = len(sentences)
-
-        while i < n_sentences:
-            chunk_sentences = sentences[i : i + max_chunk_size]
-            if chunks and len(chunk_sentences) <= overlap:
-                break
-
-            cleaned_sentences = []
-            for chunk_sentence in chunk_sentences:
-                cleaned_sentences.append(chunk_sentence.strip())
-            if not cleaned_sentences:
-                continue
-            chunk = " ".join(cleaned_sentences)
-            chunks.append(chunk)
-            i += max_chunk_size - overlap
-
-        return chunks
\ No newline at end of file
+    chunks = []
+    i = 0
+    n_sentences = len(sentences)
+
+    while i < n_sentences:
+        chunk_sentences = sentences[i : i + max_chunk_size]
+        if chunks and len(chunk_sentences) <= overlap:
+            break
+
+        cleaned_sentences = []
+        for chunk_sentence in chunk_sentences:
+            cleaned_sentences.append(chunk_sentence.strip())
+        if not cleaned_sentences:
+            continue
+        chunk = " ".join(cleaned_sentences)
+        chunks.append(chunk)
+        i += max_chunk_size - overlap
+
+    return chunks
\ No newline at end of file
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.search_client import SearchClient, UNIX_PREFIX
+from lib.search_server import SearchService, make_server
+from lib.quantization import QUANTIZATION_MODES
+from lib.search_utils import DEFAULT_SERVER_ADDRESS, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_BATCH_WAIT_MS, DEFAULT_SEARCH_LIMIT
+
+def main():
+    parser = argparse.ArgumentParser(description="Search Server CLI")
+    subparsers = parser.add_subparsers(dest="command", help="Available commands")
+
+    serve_parser = subparsers.add_parser("serve", help="Load the index, model and embeddings once and answer search requests until interrupted")
+    serve_parser.add_argument("--address", type=str, default=DEFAULT_SERVER_ADDRESS, help=f"host:port or {UNIX_PREFIX}/path/to/socket (default: {DEFAULT_SERVER_ADDRESS})",)
+    serve_parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="none", help="Keep int8 or binary codes in memory and rescore against the memory-mapped float32 vectors (default: none)",)
+    serve_parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH_SIZE, help=f"Most concurrent queries encoded together, 1 disables batching (default: {DEFAULT_MAX_BATCH_SIZE})",)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_BATCH_WAIT_MS, help=f"Longest a query waits for others to join its batch (default: {DEFAULT_MAX_BATCH_WAIT_MS})",)
+
+    health_parser = subparsers.add_parser("health", help="Show what a running server has loaded and how many requests it has answered")
+    health_parser.add_argument("--address", type=str, default=DEFAULT_SERVER_ADDRESS, help=f"host:port or {UNIX_PREFIX}/path/to/socket (default: {DEFAULT_SERVER_ADDRESS})",)
+
+    load_parser = subparsers.add_parser("load_test", help="Send semantic queries from several concurrent clients and report throughput and batching")
+    load_parser.add_argument("queries", type=str, nargs="+", help="Queries to cycle through")
+    load_parser.add_argument("--address", type=str, default=DEFAULT_SERVER_ADDRESS, help=f"host:port or {UNIX_PREFIX}/path/to/socket (default: {DEFAULT_SERVER_ADDRESS})",)
+    load_parser.add_argument("--clients", type=int, default=16, help="Concurrent connections (default: 16)",)
+    load_parser.add_argument("--requests", type=int, default=50, help="Requests sent per client (default: 50)",)
+    load_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Results per query (default: {DEFAULT_SEARCH_LIMIT})",)
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "serve":
+            print("Loading index, model and embeddings")
+            try:
+                service = SearchService(args.quantization, args.max_batch, args.max_wait_ms)
+            except FileNotFoundError:
+                print("Index not found, run build first")
+                sys.exit(1)
+            server = make_server(args.address, service)
+            print(f"Loaded in {service.load_seconds:.1f} s, serving on {args.address}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+
+        case "health":
+            client = SearchClient(args.address)
+            try:
+                print(json.dumps(client.health(), indent=2))
+            except OSError as e:
+                print(f"Search server not reachable at {args.address}: {e}")
+                sys.exit(1)
+            finally:
+                client.close()
+
+        case "load_test":
+            def run_client(client_num):
+                client = SearchClient(args.address)
+                try:
+                    for i in range(args.requests):
+                        # Offset per client so concurrent requests are mostly for different queries
+                        client.semantic_search(args.queries[(client_num + i) % len(args.queries)], limit=args.limit)
+                finally:
+                    client.close()
+
+            start = time.perf_counter()
+            try:
+                with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                    list(pool.map(run_client, range(args.clients)))
+            except OSError as e:
+                print(f"Search server not reachable at {args.address}: {e}")
+                sys.exit(1)
+            elapsed = time.perf_counter() - start
+            total = args.clients * args.requests
+            print(f"{total} requests from {args.clients} clients in {elapsed:.2f} s: {total / elapsed:.1f} queries/s")
+
+            client = SearchClient(args.address)
+            batching = client.health()["batching"]
+            client.close()
+            if batching is None:
+                print("Server batching is disabled")
+            else:
+                print(f"Mean batch size {batching['mean_batch_size']:.2f} over {batching['batches']} batches")
+                print(f"Batch sizes:  {batching['batch_size_histogram']}")
+                print(f"Queue depths: {batching['queue_depth_histogram']}")
+
+        case _:
+            parser.print_help()
+
+if __name__ == "__main__":
+    main()
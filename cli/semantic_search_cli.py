@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
-from lib.semantic_cmds import cmd_chunk, cmd_embed_chunks, cmd_embed_query_text, cmd_embed_text, cmd_search, cmd_search_chunked, cmd_semantic_chunk, cmd_verify_model, cmd_verify_embeddings
-from lib.search_utils import DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_LIMIT, DEFAULT_CHUNK_OVERLAP, DEFAULT_SEMANTIC_CHUNK_SIZE
+import sys
+from lib.semantic_cmds import cmd_batch, cmd_build_hnsw, cmd_build_ivf, cmd_chunk, cmd_embed_chunks, cmd_embed_query_text, cmd_embed_text, cmd_hnsw_recall, cmd_ivf_recall, cmd_quantized_recall, cmd_query_cache, cmd_search, cmd_search_chunked, cmd_semantic_chunk, cmd_verify_model, cmd_verify_embeddings
+from lib.semantic_search import CHUNK_AGGREGATIONS
+from lib.ann import ANN_METHODS
+from lib.quantization import QUANTIZATION_MODES
+from lib.search_utils import ENCODE_BATCH_SIZE, DEFAULT_SERVER_ADDRESS, DEFAULT_QUERY_BATCH_SIZE, DEFAULT_SEARCH_LIMIT, DEFAULT_CHUNK_LIMIT, DEFAULT_CHUNK_OVERLAP, DEFAULT_SEMANTIC_CHUNK_SIZE, DEFAULT_CHUNK_AGGREGATION, DEFAULT_CHUNK_TOP_N, DEFAULT_IVF_NPROBE, DEFAULT_HNSW_M, DEFAULT_HNSW_EF_CONSTRUCTION, DEFAULT_HNSW_EF_SEARCH, DEFAULT_RECALL_K, DEFAULT_RECALL_QUERIES, DEFAULT_RESCORE_OVERSAMPLE
 
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
@@ -10,12 +14,44 @@ def main():
     
     
     #Add the standalone commands to the CLI interpreter
-    subparsers.add_parser("embed_chunks", help="Create embeddings for document chunks")
     subparsers.add_parser("verify", help="Verify the LLM model")
 
     # Remember when adding additional commands, that if we are only registering the command we don't need to set a variable equal to the subparsers.add_parser
     # variable = subparsers.add_parser is needed when we need subsequent lines to add parameters via .add_argument
 
+    build_ivf_parser = subparsers.add_parser("build_ivf", help="Build the IVF approximate nearest neighbour index over the cached embeddings")
+    build_ivf_parser.add_argument("--chunks", action="store_true", help="Index the chunk embeddings instead of the movie embeddings")
+    build_ivf_parser.add_argument("--nlist", type=int, default=None, help="Number of k-means cells (default: sqrt of the number of vectors)")
+
+    ivf_recall_parser = subparsers.add_parser("ivf_recall", help="Report IVF recall@k and latency against exact search for several nprobe values")
+    ivf_recall_parser.add_argument("--chunks", action="store_true", help="Evaluate the chunk embeddings instead of the movie embeddings")
+    ivf_recall_parser.add_argument("--k", type=int, default=DEFAULT_RECALL_K, help=f"Number of neighbours compared (default: {DEFAULT_RECALL_K})")
+    ivf_recall_parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="nprobe values to evaluate (default: 1 2 4 8 16)")
+    ivf_recall_parser.add_argument("--queries", type=int, default=DEFAULT_RECALL_QUERIES, help=f"Number of sampled query vectors (default: {DEFAULT_RECALL_QUERIES})")
+    ivf_recall_parser.add_argument("--nlist", type=int, default=None, help="Number of k-means cells if the index has to be (re)built")
+
+    build_hnsw_parser = subparsers.add_parser("build_hnsw", help="Build the HNSW graph index over the cached embeddings, or extend it with rows appended since the last build")
+    build_hnsw_parser.add_argument("--chunks", action="store_true", help="Index the chunk embeddings instead of the movie embeddings")
+    build_hnsw_parser.add_argument("--m", type=int, default=DEFAULT_HNSW_M, help=f"Links per node, 2 * M on layer 0 (default: {DEFAULT_HNSW_M})")
+    build_hnsw_parser.add_argument("--ef-construction", type=int, default=DEFAULT_HNSW_EF_CONSTRUCTION, help=f"Beam width while inserting (default: {DEFAULT_HNSW_EF_CONSTRUCTION})")
+
+    hnsw_recall_parser = subparsers.add_parser("hnsw_recall", help="Report HNSW recall@k and latency against exact search for several ef_search values")
+    hnsw_recall_parser.add_argument("--chunks", action="store_true", help="Evaluate the chunk embeddings instead of the movie embeddings")
+    hnsw_recall_parser.add_argument("--k", type=int, default=DEFAULT_RECALL_K, help=f"Number of neighbours compared (default: {DEFAULT_RECALL_K})")
+    hnsw_recall_parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 20, 50, 100, 200], help="ef_search values to evaluate (default: 10 20 50 100 200)")
+    hnsw_recall_parser.add_argument("--queries", type=int, default=DEFAULT_RECALL_QUERIES, help=f"Number of sampled query vectors (default: {DEFAULT_RECALL_QUERIES})")
+
+    quantized_recall_parser = subparsers.add_parser("quantized_recall", help="Report quantized search recall@k, latency and memory against exact search for several oversampling factors")
+    quantized_recall_parser.add_argument("mode", choices=QUANTIZATION_MODES[1:], help="Quantized store to evaluate")
+    quantized_recall_parser.add_argument("--chunks", action="store_true", help="Evaluate the chunk embeddings instead of the movie embeddings")
+    quantized_recall_parser.add_argument("--k", type=int, default=DEFAULT_RECALL_K, help=f"Number of neighbours compared (default: {DEFAULT_RECALL_K})")
+    quantized_recall_parser.add_argument("--oversample", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="Oversampling factors to evaluate (default: 1 2 4 8 16)")
+    quantized_recall_parser.add_argument("--queries", type=int, default=DEFAULT_RECALL_QUERIES, help=f"Number of sampled query vectors (default: {DEFAULT_RECALL_QUERIES})")
+
+    query_cache_parser = subparsers.add_parser("query_cache", help="Show or clear the query embedding cache")
+    query_cache_parser.add_argument("queries", type=str, nargs="*", help="Optionally embed these queries and report cache hits and misses")
+    query_cache_parser.add_argument("--clear", action="store_true", help="Remove every cached query embedding")
+
     chunk_parser = subparsers.add_parser("chunk", help="Implement fixed-size chunking to split long text for embedding")
     chunk_parser.add_argument("text", type=str, help="chunk text position")
     chunk_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_LIMIT, help=f"Optionally specify the chunk size (default: {DEFAULT_CHUNK_LIMIT})",)
@@ -30,17 +66,45 @@ def main():
     search_parser = subparsers.add_parser("search", help="Use semantic search to find movies by meaning")
     search_parser.add_argument("query", type=str, help="search query")
     search_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    search_parser.add_argument("--ann", choices=ANN_METHODS, default="exact", help="Exact search or an approximate nearest neighbour index (default: exact)",)
+    search_parser.add_argument("--nprobe", type=int, default=DEFAULT_IVF_NPROBE, help=f"IVF cells scanned per query (default: {DEFAULT_IVF_NPROBE})",)
+    search_parser.add_argument("--ef-search", type=int, default=DEFAULT_HNSW_EF_SEARCH, help=f"HNSW beam width per query (default: {DEFAULT_HNSW_EF_SEARCH})",)
+    search_parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="none", help="Keep int8 or binary codes in memory and rescore against the memory-mapped float32 vectors (default: none)",)
+    search_parser.add_argument("--oversample", type=int, default=DEFAULT_RESCORE_OVERSAMPLE, help=f"Quantized candidates rescored per result (default: {DEFAULT_RESCORE_OVERSAMPLE})",)
+    search_parser.add_argument("--server", type=str, nargs="?", const=DEFAULT_SERVER_ADDRESS, default=None, help=f"Send the query to a running search server instead of loading the model (default address: {DEFAULT_SERVER_ADDRESS})",)
 
     search_chunked_parser = subparsers.add_parser("search_chunked", help="Query against chunk embeddings and aggregate results")
     search_chunked_parser.add_argument("query", type=str, help="search query")
     search_chunked_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    search_chunked_parser.add_argument("--aggregation", choices=CHUNK_AGGREGATIONS, default=DEFAULT_CHUNK_AGGREGATION, help=f"How chunk scores are combined into a movie score (default: {DEFAULT_CHUNK_AGGREGATION})",)
+    search_chunked_parser.add_argument("--top-n", type=int, default=DEFAULT_CHUNK_TOP_N, help=f"Number of best chunks summed by top_n_sum (default: {DEFAULT_CHUNK_TOP_N})",)
+    search_chunked_parser.add_argument("--ann", choices=ANN_METHODS, default="exact", help="Exact search or an approximate nearest neighbour index (default: exact)",)
+    search_chunked_parser.add_argument("--nprobe", type=int, default=DEFAULT_IVF_NPROBE, help=f"IVF cells scanned per query (default: {DEFAULT_IVF_NPROBE})",)
+    search_chunked_parser.add_argument("--ef-search", type=int, default=DEFAULT_HNSW_EF_SEARCH, help=f"HNSW beam width per query (default: {DEFAULT_HNSW_EF_SEARCH})",)
+    search_chunked_parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="none", help="Keep int8 or binary codes in memory and rescore against the memory-mapped float32 vectors (default: none)",)
+    search_chunked_parser.add_argument("--oversample", type=int, default=DEFAULT_RESCORE_OVERSAMPLE, help=f"Quantized candidates rescored per result (default: {DEFAULT_RESCORE_OVERSAMPLE})",)
+    search_chunked_parser.add_argument("--server", type=str, nargs="?", const=DEFAULT_SERVER_ADDRESS, default=None, help=f"Send the query to a running search server instead of loading the model (default address: {DEFAULT_SERVER_ADDRESS})",)
+
+    batch_parser = subparsers.add_parser("batch", help="Search every query in a file (one per line, or JSON objects with a query field) and stream JSONL results")
+    batch_parser.add_argument("input", type=str, nargs="?", default="-", help="Query file, - for stdin (default: -)")
+    batch_parser.add_argument("--limit", type=int, default=DEFAULT_SEARCH_LIMIT, help=f"Optionally limit the results (default: {DEFAULT_SEARCH_LIMIT})",)
+    batch_parser.add_argument("--chunks", action="store_true", help="Search the chunk embeddings instead of the movie embeddings")
+    batch_parser.add_argument("--aggregation", choices=CHUNK_AGGREGATIONS, default=DEFAULT_CHUNK_AGGREGATION, help=f"How chunk scores are combined into a movie score (default: {DEFAULT_CHUNK_AGGREGATION})",)
+    batch_parser.add_argument("--top-n", type=int, default=DEFAULT_CHUNK_TOP_N, help=f"Number of best chunks summed by top_n_sum (default: {DEFAULT_CHUNK_TOP_N})",)
+    batch_parser.add_argument("--batch-size", type=int, default=DEFAULT_QUERY_BATCH_SIZE, help=f"Queries encoded and scored together (default: {DEFAULT_QUERY_BATCH_SIZE})",)
+    batch_parser.add_argument("--quantization", choices=QUANTIZATION_MODES, default="none", help="Keep int8 or binary codes in memory and rescore against the memory-mapped float32 vectors (default: none)",)
 
     semantic_chunk_parser = subparsers.add_parser("semantic_chunk", help="Implement semantic based chunking to split long text for embedding")
     semantic_chunk_parser.add_argument("text", type=str, help="chunk text")
     semantic_chunk_parser.add_argument("--max-chunk-size", type=int, default=DEFAULT_SEMANTIC_CHUNK_SIZE, help=f"Optionally specify the chunk size (default: {DEFAULT_SEMANTIC_CHUNK_SIZE})",)
     semantic_chunk_parser.add_argument("--overlap", type=int, default=DEFAULT_CHUNK_OVERLAP, help=f"Optionally specify the chunk overlap (default: {DEFAULT_CHUNK_OVERLAP})",)
 
-    subparsers.add_parser("verify_embeddings", help="Verify the embedded values")
+    #Commands that (re)build embeddings can spread the encoding over several worker processes
+    embed_chunks_parser = subparsers.add_parser("embed_chunks", help="Create embeddings for document chunks")
+    verify_embeddings_parser = subparsers.add_parser("verify_embeddings", help="Verify the embedded values")
+    for embed_parser in (embed_chunks_parser, verify_embeddings_parser):
+        embed_parser.add_argument("--workers", type=int, default=1, help="Encoding worker processes, each with its own model copy and an even share of the CPUs (default: 1, encode in this process)")
+        embed_parser.add_argument("--batch-size", type=int, default=ENCODE_BATCH_SIZE, help=f"Texts per encode call, split across the workers (default: {ENCODE_BATCH_SIZE})")
     
 
 
@@ -52,13 +116,29 @@ def main():
 
 
     args = parser.parse_args()
+    if getattr(args, "quantization", "none") != "none" and getattr(args, "ann", "exact") != "exact":
+        parser.error("--quantization cannot be combined with --ann")
+    if getattr(args, "server", None) and (args.ann != "exact" or args.quantization != "none"):
+        #The server searches with the settings it was started with
+        parser.error("--ann and --quantization cannot be combined with --server")
+    if args.command == "build_hnsw" and args.m < 2:
+        parser.error("--m must be at least 2")
 
     match args.command:
+        case "batch":
+            cmd_batch(args.input, args.limit, args.chunks, args.aggregation, args.top_n, args.batch_size, args.quantization)
+
+        case "build_hnsw":
+            cmd_build_hnsw(args.chunks, args.m, args.ef_construction)
+
+        case "build_ivf":
+            cmd_build_ivf(args.chunks, args.nlist)
+
         case "chunk":
             cmd_chunk(args.text, args.chunk_size, args.overlap)
         
         case "embed_chunks":
-            cmd_embed_chunks()
+            cmd_embed_chunks(args.workers, args.batch_size)
 
         case "embed_text":
             cmd_embed_text(args.text)
@@ -66,11 +146,23 @@ def main():
         case "embedquery":
             cmd_embed_query_text(args.query)
 
+        case "hnsw_recall":
+            cmd_hnsw_recall(args.chunks, args.k, args.ef_search, args.queries)
+
+        case "ivf_recall":
+            cmd_ivf_recall(args.chunks, args.k, args.nprobe, args.queries, args.nlist)
+
+        case "quantized_recall":
+            cmd_quantized_recall(args.chunks, args.mode, args.k, args.oversample, args.queries)
+
+        case "query_cache":
+            cmd_query_cache(args.clear, args.queries)
+
         case "search":
-            cmd_search(args.query, args.limit)
+            sys.exit(cmd_search(args.query, args.limit, args.ann, args.nprobe, args.ef_search, args.quantization, args.oversample, args.server))
 
         case "search_chunked":
-            cmd_search_chunked(args.query, args.limit)
+            sys.exit(cmd_search_chunked(args.query, args.limit, args.aggregation, args.top_n, args.ann, args.nprobe, args.ef_search, args.quantization, args.oversample, args.server))
 
         case "semantic_chunk":
             cmd_semantic_chunk(args.text, args.max_chunk_size, args.overlap)
@@ -79,7 +171,7 @@ def main():
             cmd_verify_model()
 
         case "verify_embeddings":            
-            cmd_verify_embeddings()
+            cmd_verify_embeddings(args.workers, args.batch_size)
 
         case _:
             parser.print_help()